@@ -1,111 +1,1711 @@
 import os
+import sys
 import uuid
 import json
+import re
 import random
-from datetime import datetime
-from flask import Flask, render_template_string, request, redirect, url_for, session, jsonify, send_from_directory
+import queue
+import bisect
+import threading
+import atexit
+import time
+import click
+import hashlib
+import mimetypes
+import sqlite3
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, date
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from flask import Flask, Blueprint, Response, current_app, g, got_request_exception, has_request_context, render_template_string, request, redirect, url_for, session, jsonify, send_file, send_from_directory
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import ClosingIterator
+from urllib.parse import quote
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
 import base64
+from msgbus import create_bus
+from notify import create_notifier
+import moderation
 
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
+try:
+    import fcntl
+except ImportError:  # Windows: shard locks are process-local only
+    fcntl = None
+
+bp = Blueprint('chat', __name__, cli_group=None)
 
 # Configuration
 UPLOAD_FOLDER = 'static/pfp'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 MAX_FILE_SIZE = 2 * 1024 * 1024  # 2MB
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
-# Ensure directories exist
-os.makedirs('data', exist_ok=True)
-os.makedirs('data/private_msgs', exist_ok=True)
-os.makedirs('static/pfp', exist_ok=True)
+ATTACHMENT_FOLDER = 'data/attachments'
+UPLOAD_TMP_FOLDER = 'data/uploads'
+MAX_ATTACHMENT_SIZE = 100 * 1024 * 1024  # 100MB
+MAX_ATTACHMENTS = 10  # per message
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes per PATCH from the browser
+UPLOAD_BLOCK_SIZE = 64 * 1024  # bytes read from the request at a time
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_WORKERS = 2
+UPLOAD_EXPIRY = 24 * 3600  # seconds a partial upload is kept without new chunks
+UPLOAD_SWEEP_INTERVAL = 3600  # seconds between sweeps for expired uploads
+READ_STATE_FILE = 'data/read_state.json'
+READ_FLUSH_DELAY = 2.0  # seconds to coalesce mark-read writes
+ROOMS_FILE = 'data/rooms.json'
+ROOM_FOLDER = 'data/rooms'
+PATCH_FOLDER = 'data/patches'
+DEFAULT_ROOM = 'general'
+ROOM_NAME_PATTERN = re.compile(r'^[a-z0-9_-]{1,32}$')
+PRIVATE_PAGE_SIZE = 50
+ROOM_PAGE_SIZE = 50
+HOT_WINDOW_SIZE = 200  # newest messages kept in memory per conversation
+USER_PAGE_SIZE = 20
+TAIL_BLOCK_SIZE = 64 * 1024
+TIME_CACHE_SIZE = 65536  # (timezone, minute) pairs with formatted times
+STREAM_QUEUE_SIZE = 100
+STREAM_KEEPALIVE = 15  # seconds
+STREAM_RETRY = 1000  # milliseconds a browser waits before reconnecting a stream
+STREAM_REPLAY_LIMIT = 500  # missed messages sent to a reconnecting stream
+TYPING_THROTTLE = 2.0  # seconds between typing events from one user in one conversation
+TYPING_TTL = 6.0  # seconds a typing indicator stays up without a refresh
+TYPING_IDLE = 3.0  # seconds without keystrokes before the client says it stopped
+MESSAGE_BUS_URL = os.environ.get('CHAT_BUS_URL', 'memory://')
+PREWARM_CACHES = os.environ.get('CHAT_PREWARM') == '1'
+NODE_ID = uuid.uuid4().hex
+EXPORT_VERSION = 1
+PROGRESS_INTERVAL = 1.0  # seconds between progress lines
+DIGEST_DB = 'data/digests.db'
+DIGEST_NOTIFIER = os.environ.get('CHAT_DIGEST_NOTIFIER', 'file://data/digests.ndjson')
+DIGEST_WORKERS = int(os.environ.get('CHAT_DIGEST_WORKERS', '2'))
+DIGEST_DISPATCHER = os.environ.get('CHAT_DIGEST_DISPATCHER') == '1'  # lifecycle workers and `python app.py` turn it on
+DIGEST_DELAY = 300.0  # seconds a private message has to be read before it goes in a digest
+DIGEST_POLL = 1.0  # seconds between looks for due digests when the queue is idle
+DIGEST_LEASE = 60.0  # seconds a claimed digest is reserved for its worker
+DIGEST_RETRY_DELAY = 30.0  # doubled per failed attempt, up to DIGEST_RETRY_MAX
+DIGEST_RETRY_MAX = 3600.0
+DIGEST_MAX_ATTEMPTS = 8
+DIGEST_PREVIEWS = 5  # newest unread messages quoted per conversation
+DIGEST_PREVIEW_LENGTH = 200
+DIGEST_METRICS_WINDOW = 3600.0  # seconds of deliveries kept for latency figures
+MODERATION_FILE = 'data/moderation.json'
+MODERATION_RELOAD_INTERVAL = 2.0  # seconds between checks of the rules file for changes
+SECRET_KEY_FILE = 'data/secret_key'
+CONFIG_FILE = os.environ.get('CHAT_CONFIG')  # optional JSON file of config overrides
+DRAIN_TIMEOUT = 30.0  # seconds requests get to finish when shutting down
+
+# Startup hooks
+# Importing this module does no I/O. create_app() runs the hooks in
+# startup_hooks (bottom of the file) in order, each called with the app.
+def ensure_directories(app):
+    os.makedirs('data', exist_ok=True)
+    os.makedirs('data/private_msgs', exist_ok=True)
+    os.makedirs(ROOM_FOLDER, exist_ok=True)
+    os.makedirs(PATCH_FOLDER, exist_ok=True)
+    os.makedirs(ATTACHMENT_FOLDER, exist_ok=True)
+    os.makedirs(UPLOAD_TMP_FOLDER, exist_ok=True)
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # Initialize data files
-def init_data_files():
+def init_data_files(app=None):
     data_files = {
         'users.json': {'users': []},
-        'msgs.json': {'messages': []}
+        'rooms.json': {'rooms': [{'name': DEFAULT_ROOM, 'created_by': None,
+                                  'created_at': datetime.now().isoformat(), 'members': []}]}
     }
     for filename, default_data in data_files.items():
         if not os.path.exists(f'data/{filename}'):
             with open(f'data/{filename}', 'w') as f:
                 json.dump(default_data, f)
-
-init_data_files()
+    
+    # The old single public room becomes the shard of the default room
+    if os.path.exists('data/msgs.json') and not os.path.exists(room_file(DEFAULT_ROOM)):
+        with open('data/msgs.json', 'r') as f:
+            messages = json.load(f)['messages']
+        with open(room_file(DEFAULT_ROOM), 'w') as f:
+            for message in messages:
+                f.write(json.dumps(message) + '\n')
+        os.replace('data/msgs.json', 'data/msgs.json.migrated')
+    
+    # Private conversations move from one JSON document to an append-only shard
+    for filename in os.listdir('data/private_msgs'):
+        if filename.endswith('.json'):
+            conversation = filename[:-5]
+            with open(f'data/private_msgs/{filename}', 'r') as f:
+                data = json.load(f)
+            with open(private_conversation_file(conversation), 'w') as f:
+                for message in data['messages']:
+                    f.write(json.dumps(message) + '\n')
+            conversation_joined(conversation, data['participants'])
+            os.replace(f'data/private_msgs/{filename}', f'data/private_msgs/{filename}.migrated')
 
 # Helper functions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def get_user_by_email(email):
-    with open('data/users.json', 'r') as f:
-        users_data = json.load(f)
-    return next((user for user in users_data['users'] if user['email'] == email), None)
+    return unit_of_work().lookup('users', 'email', email)
 
 def get_user_by_username(username):
-    with open('data/users.json', 'r') as f:
-        users_data = json.load(f)
-    return next((user for user in users_data['users'] if user['username'] == username), None)
+    return unit_of_work().lookup('users', 'username', username)
 
 def save_user(user):
-    with open('data/users.json', 'r+') as f:
-        users_data = json.load(f)
-        users_data['users'].append(user)
-        f.seek(0)
-        json.dump(users_data, f, indent=2)
+    unit_of_work().put('users', user)
 
 def update_user(original_email, updated_user):
-    with open('data/users.json', 'r+') as f:
-        users_data = json.load(f)
-        users_data['users'] = [u if u['email'] != original_email else updated_user for u in users_data['users']]
-        f.seek(0)
-        json.dump(users_data, f, indent=2)
-
-def get_public_messages():
-    with open('data/msgs.json', 'r') as f:
-        return json.load(f)['messages']
-
-def add_public_message(message):
-    with open('data/msgs.json', 'r+') as f:
-        data = json.load(f)
-        data['messages'].append(message)
-        f.seek(0)
-        json.dump(data, f, indent=2)
+    unit_of_work().put('users', updated_user, original_email)
+
+def users_committed(changes):
+    # Called after users.json is written with (old record or None, new record)
+    renamed = False
+    for old, new in changes:
+        if old is None or (old['username'], old['email']) != (new['username'], new['email']):
+            if old is not None:
+                directory_remove(old)
+            directory_insert(new)
+            renamed = True
+    if renamed:
+        bus.publish('$users', {'origin': NODE_ID})
+
+# Request-scoped unit of work
+# Each request gets one UnitOfWork (on g). A JSON store is read the first time
+# the request needs it and indexed per field on demand, so later lookups in
+# the same request don't touch the file. Changed records are remembered and
+# written back once, after the view returns. A view that raises commits
+# nothing: Flask still runs after_request for the error page outside debug
+# mode, so the changes are dropped when the exception is signalled. Outside a
+# request every change is committed immediately.
+#
+# The commit writes the request's copy straight back if the file is unchanged
+# since it was read, and otherwise re-reads it under the shard lock and
+# reapplies only the changed records, so writes from other processes survive.
+# If another process has meanwhile created the same key or taken one of the
+# store's unique values, nothing is written and StoreConflict is raised; views
+# that create or rename records commit themselves so they can report it.
+STORES = {
+    'users': {'path': 'data/users.json', 'collection': 'users', 'key': 'email', 'unique': ('email', 'username'),
+              'on_commit': users_committed},
+}
+
+class StoreConflict(Exception):
+    pass
+
+class UnitOfWork:
+    def __init__(self, autocommit=False):
+        self.autocommit = autocommit
+        self.stores = {}   # name -> records as read (and changed) by this request
+        self.stamps = {}   # name -> (inode, mtime, size) of the file when read
+        self.indexes = {}  # (name, field) -> {value: record}
+        self.dirty = {}    # name -> {key: (old record or None, new record)}
+        self.reads = 0
+        self.writes = 0
+
+    def load(self, name):
+        if name not in self.stores:
+            store = STORES[name]
+            with open(store['path'], 'rb') as f:
+                stat = os.fstat(f.fileno())
+                self.stores[name] = json.load(f)[store['collection']]
+            self.stamps[name] = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self.reads += 1
+        return self.stores[name]
+
+    def lookup(self, name, field, value):
+        index = self.indexes.get((name, field))
+        if index is None:
+            index = self.indexes[(name, field)] = {record[field]: record for record in self.load(name)}
+        return index.get(value)
+
+    def put(self, name, record, original_key=None):
+        key = STORES[name]['key']
+        original_key = original_key or record[key]
+        records = self.load(name)
+        position = next((i for i, r in enumerate(records) if r[key] == original_key), None)
+        old = None if position is None else records[position]
+        if position is None:
+            records.append(record)
+        else:
+            records[position] = record
+        dirty = self.dirty.setdefault(name, {})
+        dirty[original_key] = (dirty.pop(original_key, (old, None))[0], record)
+        self.indexes = {k: v for k, v in self.indexes.items() if k[0] != name}
+        if self.autocommit:
+            self.commit()
+
+    def commit(self):
+        for name, changes in list(self.dirty.items()):
+            del self.dirty[name]
+            store = STORES[name]
+            key = store['key']
+            with shard_lock(store['path']):
+                stat = os.stat(store['path'])
+                records = self.stores[name]
+                if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self.stamps[name]:
+                    # Someone else wrote the store since this request read it
+                    with open(store['path'], 'r') as f:
+                        records = json.load(f)[store['collection']]
+                    self.reads += 1
+                    positions = {r[key]: i for i, r in enumerate(records)}
+                    conflict = False
+                    for original_key, (old, record) in changes.items():
+                        if original_key not in positions:
+                            records.append(record)
+                        elif old is not None:
+                            records[positions[original_key]] = record
+                        else:
+                            conflict = True  # created by someone else too
+                    for field in store.get('unique', ()):
+                        taken = Counter(r[field] for r in records)
+                        conflict = conflict or any(taken[record[field]] > 1 for _, record in changes.values())
+                    if conflict:
+                        # The request's copy is stale; a later lookup reads the file again
+                        del self.stores[name], self.stamps[name]
+                        self.indexes = {k: v for k, v in self.indexes.items() if k[0] != name}
+                        raise StoreConflict(f"{store['path']} changed underneath this request")
+                tmp_file = store['path'] + '.tmp'
+                with open(tmp_file, 'w') as f:
+                    json.dump({store['collection']: records}, f, indent=2)
+                os.replace(tmp_file, store['path'])
+                stat = os.stat(store['path'])
+            self.stores[name] = records
+            self.stamps[name] = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self.writes += 1
+            store['on_commit'](list(changes.values()))
+
+def unit_of_work():
+    if not has_request_context():
+        return UnitOfWork(autocommit=True)
+    if 'unit_of_work' not in g:
+        g.unit_of_work = UnitOfWork()
+    return g.unit_of_work
+
+# Store reads and writes per endpoint, for finding routes that hit the
+# stores more often than they should. Also sent as X-Store-Reads.
+store_stats = {}
+store_stats_lock = threading.Lock()
+
+def discard_unit_of_work(sender, exception, **extra):
+    work = g.get('unit_of_work')
+    if work:
+        work.dirty = {}
+
+got_request_exception.connect(discard_unit_of_work)
+
+@bp.after_app_request
+def commit_unit_of_work(response):
+    work = g.pop('unit_of_work', None)
+    if work:
+        work.commit()
+    reads, writes = (work.reads, work.writes) if work else (0, 0)
+    with store_stats_lock:
+        stats = store_stats.setdefault(request.endpoint or 'unknown', {'requests': 0, 'reads': 0, 'writes': 0})
+        stats['requests'] += 1
+        stats['reads'] += reads
+        stats['writes'] += writes
+    response.headers['X-Store-Reads'] = str(reads)
+    return response
+
+# User directory
+# A list of (lowercased username, username, email) kept sorted, so a prefix
+# search is a bisect to the first match plus a short scan. Built once from
+# users.json and then updated in place whenever user changes are committed; other
+# processes' changes arrive as '$users' bus events and trigger a rebuild.
+# Usernames are also indexed by email, for naming senders outside a request.
+user_directory = []
+user_names = {}  # email -> username
+user_directory_lock = threading.Lock()
+user_directory_loaded = False
+
+def load_user_directory(reload=False):
+    global user_directory_loaded
+    if user_directory_loaded and not reload:
+        return
+    with open('data/users.json', 'r') as f:
+        users = json.load(f)['users']
+    user_directory[:] = sorted((u['username'].lower(), u['username'], u['email']) for u in users)
+    user_names.clear()
+    user_names.update((u['email'], u['username']) for u in users)
+    user_directory_loaded = True
+
+def directory_insert(user):
+    with user_directory_lock:
+        if user_directory_loaded:
+            bisect.insort(user_directory, (user['username'].lower(), user['username'], user['email']))
+            user_names[user['email']] = user['username']
+
+def directory_remove(user):
+    with user_directory_lock:
+        if user_directory_loaded:
+            entry = (user['username'].lower(), user['username'], user['email'])
+            i = bisect.bisect_left(user_directory, entry)
+            if i < len(user_directory) and user_directory[i] == entry:
+                del user_directory[i]
+            if user_names.get(user['email']) == user['username']:
+                del user_names[user['email']]
+
+def username_for(email):
+    with user_directory_lock:
+        load_user_directory()
+        return user_names.get(email)
+
+def search_users(prefix='', after=None, limit=USER_PAGE_SIZE, exclude=None):
+    # Users whose name starts with `prefix` (case-insensitive), in name order,
+    # starting after the username `after`. Also returns the cursor for the
+    # next page, or None on the last page.
+    prefix = prefix.lower()
+    with user_directory_lock:
+        load_user_directory()
+        if after:
+            start = bisect.bisect_right(user_directory, (after.lower(), after, '\U0010ffff'))
+        else:
+            start = bisect.bisect_left(user_directory, (prefix,))
+        results = []
+        for entry in user_directory[start:]:
+            if not entry[0].startswith(prefix):
+                return results, None
+            if entry[2] == exclude:
+                continue
+            if len(results) == limit:
+                return results, results[-1]['username']
+            results.append({'username': entry[1], 'email': entry[2]})
+        return results, None
+
+# Message storage
+# Every room and private conversation is its own shard with its own lock, so
+# writers in one conversation never wait on another. Shards are append-only
+# NDJSON files: appending never reads the shard, readers skip a trailing
+# partial line instead of locking, and the newest messages can be read from
+# the end of the file without reading the rest.
+shard_locks = {}
+
+@contextmanager
+def shard_lock(path):
+    lock = shard_locks.setdefault(path, threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        with open(path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_records(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.endswith('\n')]
+
+def read_tail(path, limit, before=None):
+    # Up to `limit` records ending at byte offset `before` (end of file by
+    # default), read backwards in blocks. Also returns the offset of the first
+    # record returned, which is the `before` for the next older page.
+    lines, first = read_tail_lines(path, limit, before)
+    return [json.loads(line) for line in lines], first
+
+def read_tail_lines(path, limit, before=None):
+    # read_tail without parsing: the raw lines, without their newlines
+    if not os.path.exists(path):
+        return [], 0
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END) if before is None else before
+        start = end
+        data = b''
+        while start > 0 and data.count(b'\n') <= limit:
+            size = min(TAIL_BLOCK_SIZE, start)
+            start -= size
+            f.seek(start)
+            data = f.read(size) + data
+    data = data[:data.rfind(b'\n') + 1]
+    lines = data.split(b'\n')[:-1]
+    if start > 0:
+        lines = lines[1:]  # may be cut off at the block boundary
+    lines = lines[-limit:]
+    first = start + len(data) - sum(len(line) + 1 for line in lines)
+    return lines, first
+
+def room_file(name):
+    return f"{ROOM_FOLDER}/{name}.ndjson"
+
+def conversation_file(conversation):
+    if ROOM_NAME_PATTERN.match(conversation):
+        return room_file(conversation)
+    return private_conversation_file(conversation)
+
+def get_page(conversation, limit, before=None):
+    # The newest `limit` messages before byte offset `before`, and the offset
+    # of the first of them for the next older page. The newest page comes
+    # from the hot window.
+    if before is None and limit <= HOT_WINDOW_SIZE:
+        messages, before = recent_messages(conversation, limit)
+    else:
+        messages, before = read_tail(conversation_file(conversation), limit, before)
+    return apply_patches(conversation, messages), before
+
+def get_room_page(name, limit=ROOM_PAGE_SIZE, before=None):
+    return get_page(name, limit, before)
+
+def add_room_message(name, message, event=None):
+    append_message(name, message, event)
+
+def append_message(conversation, message, event=None):
+    # The event is published while the shard lock is held so that the bus
+    # order of a conversation always matches its storage order.
+    path = conversation_file(conversation)
+    line = (json.dumps(message) + '\n').encode()
+    with shard_lock(path):
+        with open(path, 'ab') as f:
+            offset = f.tell()
+            f.write(line)
+        index = message_index.get(conversation)
+        if index and index['offset'] == offset:
+            index['ids'][message['id']] = offset
+            index['offset'] = offset + len(line)
+        with hot_windows_lock:
+            window = hot_windows.get(conversation)
+            if window and window['offset'] == offset:
+                window['messages'].append(CompactMessage(message, offset))
+                window['offset'] = offset + len(line)
+        if event:
+            bus.publish(conversation, event)
+
+# Message index
+# Maps message id -> byte offset of its record in a conversation's shard.
+# Built lazily per conversation and caught up incrementally from the last
+# offset scanned, so a lookup only reads lines appended since the previous one
+# (including appends by other processes). Mutated under the shard lock.
+message_index = {}
+
+def message_offset(conversation, message_id):
+    # Caller holds the shard lock
+    path = conversation_file(conversation)
+    index = message_index.setdefault(conversation, {'offset': 0, 'ids': {}})
+    if message_id not in index['ids'] and os.path.exists(path):
+        with open(path, 'rb') as f:
+            f.seek(index['offset'])
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                index['ids'][json.loads(line)['id']] = index['offset']
+                index['offset'] += len(line)
+    return index['ids'].get(message_id)
+
+def find_message(conversation, message_id):
+    # Call with the conversation's shard lock held
+    offset = message_offset(conversation, message_id)
+    if offset is None:
+        return None
+    with open(conversation_file(conversation), 'rb') as f:
+        f.seek(offset)
+        message = json.loads(f.readline())
+    return apply_patches(conversation, [message])[0]
+
+def messages_after(conversation, message_id, limit):
+    # Up to `limit` messages stored after `message_id`, oldest first
+    path = conversation_file(conversation)
+    with shard_lock(path):
+        offset = message_offset(conversation, message_id)
+        if offset is None:
+            return []
+        messages = []
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            f.readline()
+            for line in f:
+                if not line.endswith(b'\n') or len(messages) == limit:
+                    break
+                messages.append(json.loads(line))
+    return apply_patches(conversation, messages)
+
+# Hot window
+# The newest HOT_WINDOW_SIZE messages of each conversation that has been
+# viewed stay in memory, in a ring buffer of CompactMessage records: slots
+# instead of a dict, the UUID as an int, the timestamp as a datetime and the
+# author as an interned string shared by all of that author's messages. Each
+# is only stored compactly when it converts back to exactly the same value,
+# and fields without a slot are kept aside, so to_dict() returns the record
+# as read_tail would. A window is filled from the end of the shard on first
+# use, then extended by append_message and caught up from its offset like the
+# message index.
+class CompactMessage:
+    __slots__ = ('id', 'author', 'timestamp', 'ts', 'content', 'edited', 'attachments', 'extra', 'offset')
+    FIELDS = frozenset(__slots__) - {'extra', 'offset'}
+
+    def __init__(self, message, offset):
+        try:
+            id_int = uuid.UUID(message['id']).int
+            self.id = id_int if str(uuid.UUID(int=id_int)) == message['id'] else message['id']
+        except ValueError:
+            self.id = message['id']
+        self.timestamp = message.get('timestamp')
+        try:
+            parsed = datetime.fromisoformat(self.timestamp)
+            if parsed.isoformat() == self.timestamp:
+                self.timestamp = parsed
+        except (TypeError, ValueError):
+            pass
+        self.ts = message.get('ts')
+        self.author = sys.intern(message['author'])
+        self.content = message['content']
+        self.edited = message.get('edited')
+        self.attachments = message.get('attachments')
+        self.extra = {k: v for k, v in message.items() if k not in self.FIELDS} or None
+        self.offset = offset  # of the record in the shard
+
+    def to_dict(self):
+        message = {
+            'id': str(uuid.UUID(int=self.id)) if isinstance(self.id, int) else self.id,
+            'author': self.author,
+            'content': self.content
+        }
+        if self.timestamp is not None:
+            message['timestamp'] = self.timestamp.isoformat() if isinstance(self.timestamp, datetime) else self.timestamp
+        for field in ('ts', 'edited', 'attachments'):
+            if getattr(self, field) is not None:
+                message[field] = getattr(self, field)
+        if self.extra:
+            message.update(self.extra)
+        return message
+
+hot_windows = {}
+hot_windows_lock = threading.Lock()
+
+def recent_messages(conversation, limit):
+    # The newest `limit` (at most HOT_WINDOW_SIZE) messages and the offset of
+    # the first one, like read_tail(path, limit)
+    path = conversation_file(conversation)
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    with hot_windows_lock:
+        window = hot_windows.get(conversation)
+        if window is None or size < window['offset']:
+            window = hot_windows[conversation] = {'offset': 0, 'messages': deque(maxlen=HOT_WINDOW_SIZE)}
+            # Only complete lines are read, so a record still being appended
+            # is picked up by the catch-up below once it is finished
+            lines, offset = read_tail_lines(path, HOT_WINDOW_SIZE, size)
+            for line in lines:
+                window['messages'].append(CompactMessage(json.loads(line), offset))
+                offset += len(line) + 1
+            window['offset'] = offset
+        if size > window['offset']:
+            with open(path, 'rb') as f:
+                f.seek(window['offset'])
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    window['messages'].append(CompactMessage(json.loads(line), window['offset']))
+                    window['offset'] += len(line)
+        messages = list(window['messages'])[-limit:]
+    return [m.to_dict() for m in messages], messages[0].offset if messages else 0
+
+# Edits and deletes
+# Messages are never rewritten in place. An edit or delete appends a small
+# patch record to the conversation's patch log, and patches are applied when
+# messages are read. Deleted messages stay as tombstones so that positions
+# (and therefore read cursors) don't shift.
+patch_cache = {}
+patch_cache_lock = threading.Lock()
+
+def patch_file(conversation):
+    return f"{PATCH_FOLDER}/{conversation}.ndjson"
+
+def add_patch(conversation, patch, event=None, author=None):
+    # With `author`, the patch is only written if the message is theirs and
+    # not deleted. That is checked under the same lock as the write, so a
+    # delete can't land between the check and an edit. Returns whether the
+    # patch was written.
+    path = patch_file(conversation)
+    # Same lock as the conversation's messages, so deltas and new messages
+    # reach the bus in storage order
+    with shard_lock(conversation_file(conversation)):
+        if author is not None:
+            message = find_message(conversation, patch['id'])
+            if not message or message['author'] != author or message.get('deleted'):
+                return False
+        with open(path, 'a') as f:
+            f.write(json.dumps(patch) + '\n')
+        if event:
+            bus.publish(conversation, event)
+    return True
+
+def get_patches(conversation):
+    path = patch_file(conversation)
+    with patch_cache_lock:
+        cache = patch_cache.setdefault(conversation, {'offset': 0, 'patches': {}})
+        if os.path.exists(path) and os.path.getsize(path) > cache['offset']:
+            with open(path, 'rb') as f:
+                f.seek(cache['offset'])
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    patch = json.loads(line)
+                    cache['patches'][patch['id']] = patch
+                    cache['offset'] += len(line)
+        return cache['patches']
+
+def apply_patches(conversation, messages):
+    patches = get_patches(conversation)
+    if not patches:
+        return messages
+    patched = []
+    for message in messages:
+        patch = patches.get(message['id'])
+        if patch is None:
+            patched.append(message)
+        elif patch['op'] == 'delete':
+            patched.append({**message, 'content': '', 'deleted': True})
+        else:
+            patched.append({**message, 'content': patch['content'], 'edited': True})
+    return patched
 
-def get_private_messages(user1, user2):
+def private_conversation_id(user1, user2):
     participants = sorted([user1, user2])
-    filename = f"data/private_msgs/{participants[0]}-{participants[1]}.json"
-    if os.path.exists(filename):
-        with open(filename, 'r') as f:
-            return json.load(f)['messages']
-    return []
+    return f"{participants[0]}-{participants[1]}"
+
+def private_conversation_file(conversation):
+    return f"data/private_msgs/{conversation}.ndjson"
+
+def get_private_messages(user1, user2):
+    conversation = private_conversation_id(user1, user2)
+    return apply_patches(conversation, read_records(private_conversation_file(conversation)))
 
-def add_private_message(user1, user2, message):
+def get_private_page(user1, user2, limit=PRIVATE_PAGE_SIZE, before=None):
+    return get_page(private_conversation_id(user1, user2), limit, before)
+
+def add_private_message(user1, user2, message, event=None):
     participants = sorted([user1, user2])
-    filename = f"data/private_msgs/{participants[0]}-{participants[1]}.json"
-    if os.path.exists(filename):
-        with open(filename, 'r+') as f:
-            data = json.load(f)
-            data['messages'].append(message)
-            f.seek(0)
-            json.dump(data, f, indent=2)
+    conversation = private_conversation_id(user1, user2)
+    append_message(conversation, message, event and {**event, 'participants': participants})
+    conversation_joined(conversation, participants)
+    # The message is stored by now; a digest database that stays locked past
+    # its busy timeout only costs the recipient this digest entry
+    try:
+        queue_digest(user2 if message['author'] == user1 else user1, conversation, message)
+    except sqlite3.Error as e:
+        count_digest('unqueued')
+        print(f"Could not queue digest for {conversation}: {e}", file=sys.stderr, flush=True)
+
+# Read receipts
+# Cursors are stored as the number of messages a user has read in each
+# conversation, so the unread count is just total - cursor. Totals are counted
+# incrementally from the shard offset counted so far, which also picks up
+# appends made by other processes. Cursors, private conversation membership
+# and the (total, offset) pairs are persisted, so a restart resumes counting
+# where it left off instead of rescanning every shard.
+read_state = {'cursors': {}, 'conversations': {}}
+message_counts = {}
+count_offsets = {}
+read_state_lock = threading.Lock()
+read_state_loaded = False
+read_flush_timer = None
+
+def load_read_state():
+    global read_state, read_state_loaded
+    if read_state_loaded:
+        return
+    if os.path.exists(READ_STATE_FILE):
+        with open(READ_STATE_FILE, 'r') as f:
+            read_state = json.load(f)
+        for conversation, (count, offset) in read_state.pop('counts', {}).items():
+            message_counts[conversation] = count
+            count_offsets[conversation] = offset
+    read_state_loaded = True
+
+def count_messages(conversation):
+    # Caller holds read_state_lock
+    path = conversation_file(conversation)
+    count = message_counts.get(conversation, 0)
+    offset = count_offsets.get(conversation, 0)
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size < offset:
+        count = offset = 0  # shard was replaced, count it again
+    if size > offset:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                count += 1
+                offset += len(line)
+    message_counts[conversation] = count
+    count_offsets[conversation] = offset
+    return count
+
+def conversation_joined(conversation, participants):
+    with read_state_lock:
+        load_read_state()
+        for email in participants:
+            conversations = read_state['conversations'].setdefault(email, [])
+            if conversation not in conversations:
+                conversations.append(conversation)
+                schedule_read_state_flush()
+
+def mark_read(email, conversation, position=None):
+    with read_state_lock:
+        load_read_state()
+        total = count_messages(conversation)
+        position = total if position is None else max(0, min(int(position), total))
+        moved = advance_cursor(email, conversation, position)
+        unread = total - read_state['cursors'][email].get(conversation, 0)
+    if moved:
+        bus.publish('$read', {'origin': NODE_ID, 'email': email,
+                              'conversation': conversation, 'position': position})
+    return unread
+
+def advance_cursor(email, conversation, position):
+    # Caller holds read_state_lock
+    cursors = read_state['cursors'].setdefault(email, {})
+    if position <= cursors.get(conversation, 0):
+        return False
+    cursors[conversation] = position
+    schedule_read_state_flush()
+    return True
+
+def unread_counts(email, only=None):
+    # Every conversation the user is in, or just those of them in `only`
+    with read_state_lock:
+        load_read_state()
+        cursors = read_state['cursors'].get(email, {})
+        conversations = rooms_for_user(email) + read_state['conversations'].get(email, [])
+        if only is not None:
+            conversations = [c for c in conversations if c in only]
+        return {c: count_messages(c) - cursors.get(c, 0) for c in conversations}
+
+def schedule_read_state_flush():
+    # Caller holds read_state_lock. Rapid cursor moves share one pending write.
+    global read_flush_timer
+    if read_flush_timer is None:
+        read_flush_timer = threading.Timer(READ_FLUSH_DELAY, flush_read_state)
+        read_flush_timer.daemon = True
+        read_flush_timer.start()
+
+def flush_read_state():
+    global read_flush_timer
+    with read_state_lock:
+        if read_flush_timer is not None:
+            read_flush_timer.cancel()
+            read_flush_timer = None
+        if not read_state_loaded:
+            return
+        counts = {c: [message_counts[c], count_offsets[c]] for c in message_counts}
+        # Every worker flushes on exit, so writers in other processes share the tmp file
+        with shard_lock(READ_STATE_FILE):
+            tmp_file = READ_STATE_FILE + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({**read_state, 'counts': counts}, f, separators=(',', ':'))
+            os.replace(tmp_file, READ_STATE_FILE)
+
+atexit.register(flush_read_state)
+
+# Offline digests
+# Every private message is also queued for its recipient in a small SQLite
+# database, so the queue survives restarts and is shared by every process.
+# Messages to one user are batched into a single job that falls due
+# DIGEST_DELAY after the oldest of them. A background dispatcher claims due
+# jobs with a lease and delivers them on a thread pool: each digest lists the
+# conversations the user still hasn't read, going by the read cursors, so
+# someone who was online and read the messages gets nothing. A failed send is
+# retried with jittered exponential backoff and given up on after
+# DIGEST_MAX_ATTEMPTS; the next message to that user re-arms it.
+DIGEST_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS digest_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL,
+    conversation TEXT NOT NULL,
+    message TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS digest_items_email ON digest_items (email, id);
+CREATE TABLE IF NOT EXISTS digest_jobs (
+    email TEXT PRIMARY KEY,
+    due REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    leased_until REAL NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS digest_jobs_due ON digest_jobs (failed, due);
+CREATE TABLE IF NOT EXISTS digest_deliveries (
+    delivered REAL NOT NULL,
+    age REAL NOT NULL,
+    lag REAL NOT NULL,
+    attempts INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS digest_deliveries_delivered ON digest_deliveries (delivered);
+'''
+digest_local = threading.local()  # one connection per thread
+digest_write_lock = threading.Lock()
+digest_stats = {'queued': 0, 'unqueued': 0, 'delivered': 0, 'skipped': 0, 'retried': 0, 'failed': 0}
+digest_stats_lock = threading.Lock()
+digest_dispatcher = None  # (thread, stop event)
+
+def digest_db():
+    db = getattr(digest_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(DIGEST_DB, timeout=10, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(DIGEST_SCHEMA)
+        digest_local.db = db
+    return db
+
+@contextmanager
+def digest_transaction():
+    # Writers in this process take turns on a lock; only writers in other
+    # processes wait in SQLite's busy handler, which sleeps in whole
+    # milliseconds between attempts
+    db = digest_db()
+    with digest_write_lock:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+def count_digest(outcome):
+    with digest_stats_lock:
+        digest_stats[outcome] += 1
+
+def queue_digest(email, conversation, message):
+    now = time.time()
+    item = json.dumps({
+        'author': message['author'],
+        'content': message['content'][:DIGEST_PREVIEW_LENGTH],
+        'attachments': len(message.get('attachments', ())),
+        'ts': message.get('ts')
+    })
+    with digest_transaction() as db:
+        db.execute('INSERT INTO digest_items (email, conversation, message, created) VALUES (?, ?, ?, ?)',
+                   (email, conversation, item, now))
+        # Joins the user's pending job if there is one; revives a failed one
+        db.execute('INSERT INTO digest_jobs (email, due) VALUES (?, ?) '
+                   'ON CONFLICT (email) DO UPDATE SET failed = 0, attempts = 0, due = excluded.due '
+                   'WHERE failed = 1', (email, now + DIGEST_DELAY))
+    count_digest('queued')
+
+def claim_digest_jobs(limit):
+    now = time.time()
+    with digest_transaction() as db:
+        jobs = db.execute('SELECT email, attempts, due FROM digest_jobs '
+                          'WHERE failed = 0 AND due <= ? AND leased_until <= ? ORDER BY due LIMIT ?',
+                          (now, now, limit)).fetchall()
+        db.executemany('UPDATE digest_jobs SET leased_until = ? WHERE email = ?',
+                       [(now + DIGEST_LEASE, email) for email, _, _ in jobs])
+    return jobs
+
+def build_digest(email, items):
+    # The queued messages of each conversation are the newest ones the user
+    # was sent, so all but the last `unread` of them have been read since
+    queued = {}
+    for _, conversation, message, _ in items:
+        queued.setdefault(conversation, []).append(json.loads(message))
+    with read_state_lock:
+        load_read_state()
+        cursors = read_state['cursors'].get(email, {})
+        unread = {c: count_messages(c) - cursors.get(c, 0) for c in queued}
+    
+    names = {}
+    conversations = []
+    for conversation, messages in queued.items():
+        if unread[conversation] <= 0:
+            continue
+        pending = messages[-unread[conversation]:]
+        for author in {m['author'] for m in pending} - names.keys():
+            names[author] = username_for(author) or author
+        conversations.append({
+            'conversation': conversation,
+            'from': names[pending[-1]['author']],
+            'unread': unread[conversation],
+            'messages': [{**m, 'author': names[m['author']]} for m in pending[-DIGEST_PREVIEWS:]]
+        })
+    if not conversations:
+        return None
+    return {'created_at': datetime.now().isoformat(), 'conversations': conversations}
+
+def deliver_digest(notifier, email, attempts, due):
+    items = digest_db().execute('SELECT id, conversation, message, created FROM digest_items '
+                                'WHERE email = ? ORDER BY id', (email,)).fetchall()
+    digest = build_digest(email, items) if items else None
+    if digest:
+        try:
+            notifier.send(email, digest)
+        except Exception as e:  # whatever the notifier's transport raises
+            retry_digest(email, attempts + 1, f"{type(e).__name__}: {e}")
+            return
+    
+    now = time.time()
+    with digest_transaction() as db:
+        if items:
+            db.execute('DELETE FROM digest_items WHERE email = ? AND id <= ?', (email, items[-1][0]))
+        # Messages queued while this one was being sent start a new batch
+        newer = db.execute('SELECT MIN(created) FROM digest_items WHERE email = ?', (email,)).fetchone()[0]
+        if newer is None:
+            db.execute('DELETE FROM digest_jobs WHERE email = ?', (email,))
+        else:
+            db.execute('UPDATE digest_jobs SET due = ?, attempts = 0, leased_until = 0, last_error = NULL '
+                       'WHERE email = ?', (newer + DIGEST_DELAY, email))
+        if digest:
+            db.execute('INSERT INTO digest_deliveries (delivered, age, lag, attempts) VALUES (?, ?, ?, ?)',
+                       (now, now - items[0][3], now - due, attempts + 1))
+            db.execute('DELETE FROM digest_deliveries WHERE delivered < ?', (now - DIGEST_METRICS_WINDOW,))
+    count_digest('delivered' if digest else 'skipped')
+
+def retry_digest(email, attempts, error):
+    with digest_transaction() as db:
+        if attempts >= DIGEST_MAX_ATTEMPTS:
+            db.execute('UPDATE digest_jobs SET attempts = ?, failed = 1, leased_until = 0, last_error = ? '
+                       'WHERE email = ?', (attempts, error, email))
+        else:
+            # Jittered, so digests that failed together don't all retry together
+            delay = min(DIGEST_RETRY_DELAY * 2 ** (attempts - 1), DIGEST_RETRY_MAX) * random.uniform(0.5, 1)
+            db.execute('UPDATE digest_jobs SET attempts = ?, due = ?, leased_until = 0, last_error = ? '
+                       'WHERE email = ?', (attempts, time.time() + delay, error, email))
+    count_digest('failed' if attempts >= DIGEST_MAX_ATTEMPTS else 'retried')
+
+def run_digest_dispatcher(notifier, workers, stop):
+    # Keeps up to two jobs per worker claimed, topping up as each finishes,
+    # so one slow send doesn't hold up the rest. A job whose worker dies keeps
+    # its lease until DIGEST_LEASE runs out and is then claimed again, here or
+    # by another process, as does one whose delivery raised.
+    in_flight = {}  # future -> email
+    with ThreadPoolExecutor(workers, thread_name_prefix='digest') as pool:
+        while not stop.is_set():
+            free = workers * 2 - len(in_flight)
+            try:
+                jobs = claim_digest_jobs(free) if free > 0 else []
+            except sqlite3.OperationalError:
+                jobs = []  # database busy; try again after the poll interval
+            for job in jobs:
+                in_flight[pool.submit(deliver_digest, notifier, *job)] = job[0]
+            if in_flight:
+                done, _ = wait(in_flight, timeout=DIGEST_POLL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    email = in_flight.pop(future)
+                    if future.exception() is not None:
+                        print(f"Digest for {email} not delivered: {future.exception()!r}", file=sys.stderr, flush=True)
+            else:
+                stop.wait(DIGEST_POLL)
+    notifier.close()
+
+def start_digest_worker(app):
+    global digest_dispatcher
+    # Only processes that serve the app deliver digests; the CLI commands,
+    # scripts and benchmarks that also call create_app() leave the queue alone
+    stop_digest_worker()
+    if not app.config['DIGEST_DISPATCHER'] or app.config['DIGEST_WORKERS'] <= 0:
+        return
+    notifier = create_notifier(app.config['DIGEST_NOTIFIER'])
+    stop = threading.Event()
+    thread = threading.Thread(target=run_digest_dispatcher, args=(notifier, app.config['DIGEST_WORKERS'], stop),
+                              name='digest-dispatcher', daemon=True)
+    thread.start()
+    digest_dispatcher = (thread, stop)
+
+def stop_digest_worker():
+    global digest_dispatcher
+    if digest_dispatcher is not None:
+        thread, stop = digest_dispatcher
+        stop.set()
+        thread.join()
+        digest_dispatcher = None
+
+def digest_metrics():
+    # Queue depth comes from the database and so covers every process;
+    # the outcome counters are this process's own
+    now = time.time()
+    db = digest_db()
+    jobs, due, failed = db.execute('SELECT COUNT(*), COALESCE(SUM(failed = 0 AND due <= ?), 0), '
+                                   'COALESCE(SUM(failed), 0) FROM digest_jobs', (now,)).fetchone()
+    messages, oldest = db.execute('SELECT COUNT(*), MIN(created) FROM digest_items').fetchone()
+    deliveries = db.execute('SELECT age, lag FROM digest_deliveries WHERE delivered >= ?',
+                            (now - DIGEST_METRICS_WINDOW,)).fetchall()
+    ages = sorted(age for age, _ in deliveries)
+    lags = sorted(lag for _, lag in deliveries)
+    
+    def percentile(values, p):
+        return round(values[min(len(values) - 1, int(len(values) * p / 100))], 3) if values else None
+    
+    with digest_stats_lock:
+        process = dict(digest_stats)
+    return {
+        'jobs': jobs,
+        'jobs_due': due,
+        'jobs_failed': failed,
+        'messages': messages,
+        'oldest_message_age': round(now - oldest, 3) if oldest is not None else None,
+        'delivered': len(deliveries),
+        'age_p50': percentile(ages, 50),
+        'age_p99': percentile(ages, 99),
+        'lag_p50': percentile(lags, 50),
+        'lag_p99': percentile(lags, 99),
+        'process': process
+    }
+
+# Rooms
+# Room metadata lives in one small file and is indexed in memory: rooms by
+# name, a sorted name list for listing, and each user's joined rooms. Every
+# user is implicitly a member of the default room.
+rooms_index = {}
+room_names = []
+user_rooms = {}
+rooms_lock = threading.Lock()
+rooms_loaded = False
+
+def load_rooms(reload=False):
+    global rooms_loaded
+    if rooms_loaded and not reload:
+        return
+    rooms_index.clear()
+    user_rooms.clear()
+    with open(ROOMS_FILE, 'r') as f:
+        for room in json.load(f)['rooms']:
+            room['members'] = set(room['members'])
+            rooms_index[room['name']] = room
+            for email in room['members']:
+                user_rooms.setdefault(email, set()).add(room['name'])
+    if DEFAULT_ROOM not in rooms_index:
+        rooms_index[DEFAULT_ROOM] = {'name': DEFAULT_ROOM, 'created_by': None,
+                                     'created_at': datetime.now().isoformat(), 'members': set()}
+    room_names[:] = sorted(rooms_index)
+    rooms_loaded = True
+
+def save_rooms():
+    rooms = [{**rooms_index[name], 'members': sorted(rooms_index[name]['members'])} for name in room_names]
+    tmp_file = ROOMS_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'rooms': rooms}, f, indent=2)
+    os.replace(tmp_file, ROOMS_FILE)
+
+def get_room(name):
+    with rooms_lock:
+        load_rooms()
+        return rooms_index.get(name)
+
+def list_rooms():
+    with rooms_lock:
+        load_rooms()
+        return [rooms_index[name] for name in room_names]
+
+def rooms_for_user(email):
+    with rooms_lock:
+        load_rooms()
+        return [DEFAULT_ROOM] + sorted(user_rooms.get(email, ()))
+
+def is_room_member(name, email):
+    return name == DEFAULT_ROOM or name in rooms_for_user(email)
+
+# Mutations re-read the file under its shard lock so that processes sharing
+# data/ don't overwrite each other, then tell the other processes to reload.
+def create_room(name, email):
+    with rooms_lock, shard_lock(ROOMS_FILE):
+        load_rooms(reload=True)
+        if name in rooms_index:
+            return None
+        room = {
+            'name': name,
+            'created_by': email,
+            'created_at': datetime.now().isoformat(),
+            'members': {email}
+        }
+        rooms_index[name] = room
+        bisect.insort(room_names, name)
+        user_rooms.setdefault(email, set()).add(name)
+        save_rooms()
+    bus.publish('$rooms', {'origin': NODE_ID})
+    return room
+
+def join_room(name, email):
+    with rooms_lock, shard_lock(ROOMS_FILE):
+        load_rooms(reload=True)
+        rooms_index[name]['members'].add(email)
+        user_rooms.setdefault(email, set()).add(name)
+        save_rooms()
+    bus.publish('$rooms', {'origin': NODE_ID})
+
+def leave_room(name, email):
+    with rooms_lock, shard_lock(ROOMS_FILE):
+        load_rooms(reload=True)
+        rooms_index[name]['members'].discard(email)
+        user_rooms.get(email, set()).discard(name)
+        save_rooms()
+    bus.publish('$rooms', {'origin': NODE_ID})
+
+# Realtime fan-out
+# Each room (or conversation) is its own fan-out group with its own lock, so
+# publishing to one never contends with subscribers of another. Slow
+# subscribers drop events rather than block the sender.
+class FanoutGroup:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = set()
+
+fanout_groups = {}
+STREAM_CLOSED = object()  # queued to end a stream
+
+def subscribe(group_name):
+    group = fanout_groups.setdefault(group_name, FanoutGroup())
+    subscriber = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    with group.lock:
+        group.queues.add(subscriber)
+    return subscriber
+
+def unsubscribe(group_name, subscriber):
+    group = fanout_groups.get(group_name)
+    if group:
+        with group.lock:
+            group.queues.discard(subscriber)
+
+def publish_event(group_name, event):
+    group = fanout_groups.get(group_name)
+    if not group:
+        return
+    with group.lock:
+        subscribers = list(group.queues)
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            pass
+
+def publish_ephemeral(group_name, event):
+    # Best-effort: an ephemeral event only takes a queue slot while at least
+    # half the queue is free, so a burst of them can never crowd out messages
+    group = fanout_groups.get(group_name)
+    if not group:
+        return
+    with group.lock:
+        subscribers = list(group.queues)
+    for subscriber in subscribers:
+        if subscriber.qsize() < STREAM_QUEUE_SIZE // 2:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                pass
+
+def event_stream(group_name, last_event_id=None):
+    # Message events carry the message id as their SSE id, so a browser that
+    # reconnects (after a network blip, or because this worker is shutting
+    # down) sends the last one it got and is first sent what it missed.
+    # Missed edits, deletes and typing events are not replayed. A browser that
+    # missed more than STREAM_REPLAY_LIMIT messages is told to reload instead.
+    if shutting_down.is_set():
+        # Send the browser straight to another worker on a new connection
+        return Response(f"retry: {STREAM_RETRY}\n\n", mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    subscriber = subscribe(group_name)
+    replay = []
+    if last_event_id:
+        replay = messages_after(group_name, last_event_id, STREAM_REPLAY_LIMIT + 1)
+        if len(replay) > STREAM_REPLAY_LIMIT:
+            unsubscribe(group_name, subscriber)
+            return Response(f"retry: {STREAM_RETRY}\ndata: {json.dumps({'type': 'reload'})}\n\n",
+                            mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    
+    def generate():
+        try:
+            yield f"retry: {STREAM_RETRY}\n\n"
+            for message in replay:
+                shown = display_message(message, username_for(message['author']) or 'Unknown')
+                yield f"id: {message['id']}\ndata: {json.dumps({'type': 'message', 'message': shown})}\n\n"
+            replayed = {message['id'] for message in replay}
+            while True:
+                try:
+                    event = subscriber.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    event = None
+                if event is STREAM_CLOSED or shutting_down.is_set():
+                    return
+                if event is None:
+                    yield ': keepalive\n\n'
+                elif event.get('type') == 'message':
+                    if event['message']['id'] not in replayed:
+                        yield f"id: {event['message']['id']}\ndata: {json.dumps(event)}\n\n"
+                else:
+                    yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            unsubscribe(group_name, subscriber)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def close_streams():
+    # Ends every stream. Each browser reconnects with the last message id it
+    # got (to another worker once shutting_down is set) and is sent what it
+    # missed, so this also resyncs streams after events may have been lost.
+    for group in list(fanout_groups.values()):
+        with group.lock:
+            subscribers = list(group.queues)
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(STREAM_CLOSED)
+                    break
+                except queue.Full:
+                    try:
+                        subscriber.get_nowait()  # ending anyway; missed messages are replayed
+                    except queue.Empty:
+                        pass
+
+# Cross-process delivery
+# Stream clients are fed only from the bus, never directly by the sender, so
+# every process delivers a conversation's events in the bus order. Topics
+# starting with '$' carry state changes made by other processes, and topics
+# starting with EPHEMERAL_PREFIX belong to the ephemeral bus.
+EPHEMERAL_PREFIX = '~'
+
+def handle_bus_event(topic, seq, event):
+    remote = event.get('origin') != NODE_ID
+    if topic.startswith(EPHEMERAL_PREFIX):
+        return
+    if topic == '$rooms':
+        if remote:
+            with rooms_lock:
+                load_rooms(reload=True)
+    elif topic == '$users':
+        if remote:
+            with user_directory_lock:
+                load_user_directory(reload=True)
+    elif topic == '$read':
+        if remote:
+            with read_state_lock:
+                load_read_state()
+                advance_cursor(event['email'], event['conversation'], event['position'])
     else:
-        with open(filename, 'w') as f:
-            json.dump({
-                'participants': participants,
-                'messages': [message]
-            }, f, indent=2)
+        if remote and 'participants' in event:
+            conversation_joined(topic, event['participants'])
+        publish_event(topic, event)
+
+bus = None
+ephemeral_bus = None
+
+def start_bus(app):
+    # With a broker URL each connection waits up to msgbus.CONNECT_TIMEOUT
+    # for the broker, so a broker that is down delays startup by twice that;
+    # the app then starts anyway and the buses keep reconnecting.
+    global bus, ephemeral_bus
+    for old in (bus, ephemeral_bus):
+        if old is not None:
+            old.close()
+    bus = create_bus(app.config['MESSAGE_BUS_URL'])
+    bus.subscribe(handle_bus_event)
+    # Events published while this process was disconnected never reach it
+    bus.on_reconnect(close_streams)
+    # Ephemeral events get their own bus connection, so their traffic never
+    # queues behind or in front of messages on the way to the broker. Both
+    # connections see every topic from a broker, so each keeps to its prefix.
+    ephemeral_bus = create_bus(app.config['MESSAGE_BUS_URL'])
+    ephemeral_bus.subscribe(handle_ephemeral_event)
+
+def handle_ephemeral_event(topic, seq, event):
+    if topic.startswith(EPHEMERAL_PREFIX):
+        publish_ephemeral(topic[len(EPHEMERAL_PREFIX):], event)
+
+# Ephemeral events
+# Typing indicators go from /typing straight to the ephemeral bus and on to
+# the conversation's stream clients. They are never stored and never pass
+# through the send path. Each user is throttled to one "typing" event per
+# conversation every TYPING_THROTTLE seconds; clients drop an indicator that
+# isn't refreshed within TYPING_TTL, so a lost "stopped" event only leaves it
+# up briefly.
+typing_sent = {}  # (email, conversation) -> when the last typing event went out
+typing_lock = threading.Lock()
+
+def publish_typing(email, username, conversation, typing):
+    now = time.monotonic()
+    key = (email, conversation)
+    with typing_lock:
+        last = typing_sent.get(key)
+        if typing:
+            if last is not None and now - last < TYPING_THROTTLE:
+                return False
+            typing_sent[key] = now
+        else:
+            if last is None or now - last > TYPING_TTL:
+                return False  # no indicator is up
+            del typing_sent[key]
+        if len(typing_sent) > 10000:
+            for stale in [k for k, sent in typing_sent.items() if now - sent > TYPING_TTL]:
+                del typing_sent[stale]
+    ephemeral_bus.publish(EPHEMERAL_PREFIX + conversation, {'origin': NODE_ID, 'type': 'typing', 'user': username,
+                                                            'typing': typing, 'ttl': TYPING_TTL})
+    return True
+
+# Moderation
+# Blocked words, links and patterns are kept in MODERATION_FILE:
+#
+#   {"rules": {"*": ["spam", "link:bad.example"], "dev": ["re:\\bdrop table\\b"]}}
+#
+# Rules under "*" apply to every room and private conversation; a room's own
+# rules are added to them. Each list is compiled once into a
+# moderation.RuleSet, so a message is checked with a single regex search.
+# The send path looks at the file's stamp at most every
+# MODERATION_RELOAD_INTERVAL seconds. A changed file is compiled in a
+# background thread while senders keep using the current rule sets, then
+# swapped in with one assignment; a file that fails to compile is reported
+# and the current rules stay.
+moderation_rules = {'*': moderation.EMPTY}
+moderation_stamp = None
+moderation_checked = 0.0
+moderation_reloading = False
+moderation_lock = threading.Lock()
+
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def compile_moderation(stamp):
+    if stamp is None:
+        return {'*': moderation.EMPTY}
+    return moderation.load_rule_sets(MODERATION_FILE)
+
+def load_moderation(app=None):
+    # Startup hook: compiles in the calling thread, so no message is sent
+    # before the rules are in place. A broken file stops the app starting.
+    global moderation_rules, moderation_stamp
+    stamp = file_stamp(MODERATION_FILE)
+    moderation_rules = compile_moderation(stamp)
+    moderation_stamp = stamp
+
+def reload_moderation(stamp):
+    global moderation_rules, moderation_stamp, moderation_reloading
+    try:
+        moderation_rules = compile_moderation(stamp)
+    except (OSError, moderation.RuleError) as e:
+        print(f"Moderation rules not reloaded: {e}", file=sys.stderr, flush=True)
+    finally:
+        # Not retried until the file changes again
+        moderation_stamp = stamp
+        moderation_reloading = False
+
+def rules_for(conversation):
+    global moderation_checked, moderation_reloading
+    now = time.monotonic()
+    if now - moderation_checked > MODERATION_RELOAD_INTERVAL:
+        moderation_checked = now
+        stamp = file_stamp(MODERATION_FILE)
+        if stamp != moderation_stamp:
+            with moderation_lock:
+                if not moderation_reloading:
+                    moderation_reloading = True
+                    threading.Thread(target=reload_moderation, args=(stamp,), daemon=True).start()
+    rules = moderation_rules
+    return rules.get(conversation) or rules['*']
+
+def moderate(conversation, content):
+    # The error to send back if the content breaks a rule, else None
+    result = rules_for(conversation).check(content)
+    return moderation.KINDS[result[0]] if result else None
+
+# Attachments
+# Files are uploaded in chunks: POST /uploads declares a name and size and
+# returns an upload id, then each PATCH /uploads/<id> appends the bytes at the
+# offset in its Upload-Offset header, copied from the request to the partial
+# file UPLOAD_BLOCK_SIZE at a time. GET /uploads/<id> says how much has
+# arrived, so an interrupted upload resumes there, even in another process.
+# A finished file is stored under its SHA-256, so identical content is kept
+# once, and images get a thumbnail from a small background pool.
+# Each blob has a small JSON record next to it with who uploaded it and the
+# conversations it was sent to. A hash can only be attached by a user who
+# uploaded those bytes, and only downloaded by its uploaders and members of
+# those conversations. Partial uploads left alone for UPLOAD_EXPIRY are
+# removed by a sweep that runs, at most every UPLOAD_SWEEP_INTERVAL, when a
+# new upload starts.
+# Only raster images recognised from their stored bytes are shown inline;
+# anything else (an SVG or HTML page included) is sent as a download, and
+# every attachment response forbids sniffing and scripts.
+INLINE_IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+ATTACHMENT_HEADERS = {
+    'X-Content-Type-Options': 'nosniff',
+    'Content-Security-Policy': "default-src 'none'; sandbox",
+}
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+upload_hashes = {}  # upload id -> (bytes hashed, running sha256)
+upload_hashes_lock = threading.Lock()
+uploads_swept = 0.0
+thumbnail_pool = None
+thumbnail_pool_lock = threading.Lock()
+
+def blob_path(sha256):
+    return f"{ATTACHMENT_FOLDER}/{sha256[:2]}/{sha256}"
+
+def thumbnail_path(sha256):
+    return blob_path(sha256) + '.thumb.png'
+
+def attachment_record_path(sha256):
+    return blob_path(sha256) + '.json'
+
+def attachment_record(sha256):
+    try:
+        with open(attachment_record_path(sha256), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'uploaders': [], 'conversations': []}
+
+def record_attachment(sha256, uploader=None, conversation=None):
+    path = attachment_record_path(sha256)
+    with shard_lock(path):
+        record = attachment_record(sha256)
+        changed = False
+        for key, value in (('uploaders', uploader), ('conversations', conversation)):
+            if value and value not in record[key]:
+                record[key].append(value)
+                changed = True
+        if changed:
+            tmp_file = path + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(record, f)
+            os.replace(tmp_file, path)
+
+def can_view_conversation(conversation, email):
+    if get_room(conversation):
+        return is_room_member(conversation, email)
+    with read_state_lock:
+        load_read_state()
+        return conversation in read_state['conversations'].get(email, [])
+
+def can_view_attachment(sha256, email):
+    record = attachment_record(sha256)
+    return email in record['uploaders'] or \
+        any(can_view_conversation(conversation, email) for conversation in record['conversations'])
+
+def upload_paths(upload_id):
+    return f"{UPLOAD_TMP_FOLDER}/{upload_id}.json", f"{UPLOAD_TMP_FOLDER}/{upload_id}.part"
+
+@lru_cache(maxsize=4096)
+def inline_image_type(sha256):
+    # The image type of a stored blob if it may be shown inline, else None.
+    # Blobs never change under their hash, so the answer can be cached.
+    with open(blob_path(sha256), 'rb') as f:
+        head = f.read(12)
+    for signature, mimetype in INLINE_IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def attachment_info(sha256, name):
+    return {
+        'sha256': sha256,
+        'name': name,
+        'size': os.path.getsize(blob_path(sha256)),
+        'type': mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    }
 
-def format_time(timestamp):
+def create_upload(email, name, size):
+    expire_uploads()
+    upload_id = uuid.uuid4().hex
+    meta, part = upload_paths(upload_id)
+    open(part, 'wb').close()
+    with open(meta, 'w') as f:
+        json.dump({'email': email, 'name': name, 'size': size,
+                   'created_at': datetime.now().isoformat()}, f)
+    return upload_id
+
+def expire_uploads():
+    global uploads_swept
+    now = time.time()
+    if now - uploads_swept < UPLOAD_SWEEP_INTERVAL:
+        return
+    uploads_swept = now
+    for entry in os.scandir(UPLOAD_TMP_FOLDER):
+        if not entry.name.endswith('.json'):
+            continue
+        upload_id = entry.name[:-len('.json')]
+        meta, part = upload_paths(upload_id)
+        with shard_lock(part):
+            try:
+                last_write = os.path.getmtime(part)
+            except FileNotFoundError:
+                last_write = 0
+            if now - last_write < UPLOAD_EXPIRY:
+                continue
+            for path in (meta, part):
+                if os.path.exists(path):
+                    os.remove(path)
+            with upload_hashes_lock:
+                upload_hashes.pop(upload_id, None)
+        shard_locks.pop(part, None)
+        if os.path.exists(part + '.lock'):
+            os.remove(part + '.lock')
+
+def get_upload(upload_id):
+    if not UPLOAD_ID_PATTERN.match(upload_id):
+        return None
+    meta, part = upload_paths(upload_id)
     try:
-        dt = datetime.fromisoformat(timestamp)
-        return dt.strftime("%I:%M %p").lower().replace(" 0", " ")
-    except:
-        return timestamp
+        with open(meta, 'r') as f:
+            upload = json.load(f)
+        upload['offset'] = os.path.getsize(part)
+    except FileNotFoundError:
+        return None  # unknown, or finished in the meantime
+    return upload
+
+def write_chunk(upload_id, upload, offset, stream):
+    # Appends the request body at `offset` and returns (accepted, new offset,
+    # attachment info once the upload is complete). The offset must be where
+    # the partial file ends; otherwise nothing is written.
+    meta, part = upload_paths(upload_id)
+    with shard_lock(part):
+        if not os.path.exists(meta):
+            return False, upload['size'], None  # finished by another request
+        current = os.path.getsize(part)
+        if offset != current:
+            return False, current, None
+        with upload_hashes_lock:
+            hashed, digest = upload_hashes.pop(upload_id, (0, None))
+        if digest is None or hashed != current:
+            # Resumed in a new process, or after a failed chunk: rehash
+            digest = hashlib.sha256()
+            with open(part, 'rb') as f:
+                for block in iter(lambda: f.read(UPLOAD_BLOCK_SIZE), b''):
+                    digest.update(block)
+        remaining = upload['size'] - current
+        with open(part, 'ab') as f:
+            while remaining > 0:
+                block = stream.read(min(UPLOAD_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                f.write(block)
+                digest.update(block)
+                remaining -= len(block)
+            current = f.tell()
+        if current < upload['size']:
+            with upload_hashes_lock:
+                upload_hashes[upload_id] = (current, digest)
+            return True, current, None
+        
+        sha256 = digest.hexdigest()
+        path = blob_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(part)  # already stored
+        else:
+            os.replace(part, path)
+        os.remove(meta)
+    # The upload is gone, so its lock is no longer needed; a request still
+    # waiting on it finds the metadata missing and stops there
+    shard_locks.pop(part, None)
+    if os.path.exists(part + '.lock'):
+        os.remove(part + '.lock')
+    record_attachment(sha256, uploader=upload['email'])
+    info = attachment_info(sha256, upload['name'])
+    schedule_thumbnail(info)
+    return True, current, info
+
+def schedule_thumbnail(info):
+    global thumbnail_pool
+    if not info['type'].startswith('image/') or os.path.exists(thumbnail_path(info['sha256'])):
+        return
+    with thumbnail_pool_lock:
+        if thumbnail_pool is None:
+            thumbnail_pool = ThreadPoolExecutor(THUMBNAIL_WORKERS, thread_name_prefix='thumbnail')
+    thumbnail_pool.submit(make_thumbnail, info['sha256'])
+
+def make_thumbnail(sha256):
+    # Runs in the thumbnail pool; Pillow is only imported once it's needed
+    from PIL import Image
+    
+    target = thumbnail_path(sha256)
+    tmp_file = f"{target}.{uuid.uuid4().hex}.tmp"
+    try:
+        with Image.open(blob_path(sha256)) as image:
+            image.thumbnail(THUMBNAIL_SIZE)
+            if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                image = image.convert('RGB')
+            image.save(tmp_file, 'PNG')
+        os.replace(tmp_file, target)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # Not an image Pillow can read: it is served without a thumbnail
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def message_attachments(items, email):
+    # Attachments named in a send request, or None if any is invalid or was
+    # not uploaded by `email`
+    if not isinstance(items, list) or len(items) > MAX_ATTACHMENTS:
+        return None
+    attachments = []
+    for item in items:
+        sha256 = item.get('sha256', '') if isinstance(item, dict) else ''
+        if not SHA256_PATTERN.match(sha256) or not os.path.exists(blob_path(sha256)) \
+                or email not in attachment_record(sha256)['uploaders']:
+            return None
+        attachments.append(attachment_info(sha256, secure_filename(item.get('name') or '') or 'file'))
+    return attachments
+
+def display_attachment(attachment):
+    return {
+        'name': attachment['name'],
+        'size': attachment['size'],
+        'url': f"/attachments/{attachment['sha256']}?name={quote(attachment['name'])}",
+        'thumbnail': (f"/attachments/{attachment['sha256']}/thumbnail"
+                      if attachment['type'].startswith('image/') else None)
+    }
+
+def render_attachments(attachments):
+    return ''.join(
+        f'<a class="attachment" href="{a["url"]}" target="_blank">'
+        + (f'<img src="{a["thumbnail"]}" alt="{a["name"]}" onerror="this.remove()">' if a['thumbnail'] else '')
+        + f'<span>{a["name"]} ({a["size"] // 1024 + 1} KB)</span></a>'
+        for a in attachments)
+
+# Message times
+# Messages are written with 'ts', epoch seconds, next to the ISO 'timestamp'.
+# Older records only have 'timestamp', which message_epoch parses; one that
+# doesn't parse is shown as stored. Rendering a time is then a cache lookup
+# per (timezone, minute), so a page of messages from the same hours formats
+# each minute once, in whatever timezone the viewer has chosen (None is the
+# server's local time).
+def message_epoch(message):
+    if 'ts' in message:
+        return message['ts']
+    try:
+        return int(datetime.fromisoformat(message['timestamp']).timestamp())
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def valid_timezone(name):
+    try:
+        ZoneInfo(name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+@lru_cache(maxsize=TIME_CACHE_SIZE)
+def local_minute(tz_name, minute):
+    # Clock time, local date and that date as a string, for the minute
+    # starting at epoch minute * 60
+    dt = datetime.fromtimestamp(minute * 60, ZoneInfo(tz_name) if tz_name else None)
+    return dt.strftime("%I:%M %p").lower().lstrip("0"), dt.date(), dt.date().isoformat()
+
+def local_today(tz_name):
+    return datetime.now(ZoneInfo(tz_name) if tz_name else None).date()
+
+@lru_cache(maxsize=1024)
+def day_label(day, today):
+    # Relative bucket for a day: Today, Yesterday, a weekday in the last
+    # week, or the date
+    days = (today - day).days
+    if days == 0:
+        return 'Today'
+    if days == 1:
+        return 'Yesterday'
+    if 1 < days < 7:
+        return day.strftime('%A')
+    return f"{day.strftime('%B')} {day.day}, {day.year}"
 
 def format_message(text):
     return (text.replace('**', '<strong>', 1)
@@ -114,6 +1714,9 @@ def format_message(text):
              .replace('*', '</em>', 1))
 
 def generate_avatar(username, size=100):
+    # Pillow is only imported once an avatar is actually drawn
+    from PIL import Image, ImageDraw, ImageFont
+    
     random.seed(username)
     color = (random.randint(50, 200), random.randint(50, 200), random.randint(50, 200))
     img = Image.new('RGB', (size, size), color)
@@ -146,6 +1749,49 @@ def get_user_color(username):
               '#98D8C8', '#F06292', '#7986CB', '#9575CD']
     return colors[ord(username[0]) % len(colors)] if username else '#CCCCCC'
 
+def display_message(message, author_name, own=False, tz=None, today=None):
+    # `today` (in tz) may be passed in when displaying many messages at once
+    deleted = message.get('deleted', False)
+    epoch = message_epoch(message)
+    if epoch is None:
+        clock, day, day_key = message.get('timestamp', ''), None, ''
+    else:
+        clock, day, day_key = local_minute(tz, epoch // 60)
+    return {
+        'id': message['id'],
+        'author': author_name,
+        'content': '<em class="message-deleted">This message was deleted</em>' if deleted else format_message(message['content']),
+        'timestamp': clock,
+        'ts': epoch,
+        'day': day_key,
+        'day_label': day_label(day, today or local_today(tz)) if day else '',
+        'edited': message.get('edited', False) and not deleted,
+        'deleted': deleted,
+        'own': own and not deleted,
+        'attachments': [] if deleted else [display_attachment(a) for a in message.get('attachments', ())]
+    }
+
+def render_messages(messages):
+    return ' '.join(f'''
+                {'<div class="day-separator" data-day="' + msg['day'] + '">' + msg['day_label'] + '</div>' if msg['day'] and (i == 0 or messages[i - 1]['day'] != msg['day']) else ''}
+                <div class="message-container" data-id="{msg['id']}" data-day="{msg['day']}">
+                    <div class="message-header">
+                        <div class="avatar" style="background-color: {get_user_color(msg['author'])}">
+                            {msg['author'][0].upper()}
+                        </div>
+                        <span>{msg['author']}</span>
+                    </div>
+                    <div class="message-content">{msg['content']}</div>
+                    {'<div class="attachments">' + render_attachments(msg['attachments']) + '</div>' if msg['attachments'] else ''}
+                    <div class="message-time">
+                        {'<span class="message-edited">(edited)</span>' if msg['edited'] else ''}
+                        {msg['timestamp']}
+                        {'<button class="message-action" onclick="editMessage(`' + msg['id'] + '`)">Edit</button><button class="message-action" onclick="deleteMessage(`' + msg['id'] + '`)">Delete</button>' if msg['own'] else ''}
+                    </div>
+                </div>
+                {'<div class="separator"></div>' if i < len(messages)-1 else ''}
+                ''' for i, msg in enumerate(messages))
+
 # HTML Template
 def base_html(content):
     dark_mode = session.get('dark_mode', False)
@@ -282,10 +1928,48 @@ def base_html(content):
             margin-left: 5px;
         }}
 
+        .message-deleted {{
+            color: #666;
+        }}
+
+        .message-action {{
+            background: none;
+            border: none;
+            color: var(--link-color);
+            cursor: pointer;
+            font-size: 12px;
+            padding: 0 0 0 8px;
+        }}
+
+        .load-older {{
+            display: block;
+            margin: 0 auto 15px;
+            background: none;
+            border: 1px solid var(--separator-color);
+            border-radius: 4px;
+            color: var(--link-color);
+            cursor: pointer;
+            padding: 5px 10px;
+        }}
+
         .separator {{
             height: 15px;
         }}
 
+        .typing-indicator {{
+            height: 18px;
+            font-size: 12px;
+            font-style: italic;
+            color: #666;
+        }}
+
+        .day-separator {{
+            text-align: center;
+            font-size: 12px;
+            color: #666;
+            margin: 10px 0;
+        }}
+
         .input-area {{
             display: flex;
             gap: 10px;
@@ -318,6 +2002,33 @@ def base_html(content):
             background-color: var(--button-hover);
         }}
 
+        .attachments {{
+            display: flex;
+            flex-wrap: wrap;
+            gap: 8px;
+            margin-top: 6px;
+        }}
+
+        .attachment {{
+            display: flex;
+            flex-direction: column;
+            gap: 4px;
+            color: var(--text-color);
+            font-size: 13px;
+        }}
+
+        .attachment img {{
+            max-width: 160px;
+            max-height: 160px;
+            border-radius: 6px;
+        }}
+
+        .pending-attachments {{
+            font-size: 13px;
+            color: #666;
+            margin-bottom: 6px;
+        }}
+
         .formatting-buttons {{
             display: flex;
             gap: 5px;
@@ -514,6 +2225,16 @@ def base_html(content):
             padding: 0;
         }}
 
+        .user-search {{
+            width: 100%;
+            box-sizing: border-box;
+            padding: 5px;
+            border: 1px solid var(--input-border);
+            border-radius: 4px;
+            background-color: var(--input-bg);
+            color: var(--text-color);
+        }}
+
         .user-item {{
             display: flex;
             align-items: center;
@@ -553,6 +2274,58 @@ def base_html(content):
             cursor: pointer;
         }}
 
+        .unread-badge {{
+            margin-left: 8px;
+            background-color: var(--error-color);
+            color: #ffffff;
+            border-radius: 10px;
+            padding: 1px 7px;
+            font-size: 12px;
+            font-weight: bold;
+        }}
+
+        .room-list {{
+            list-style: none;
+            padding: 0;
+        }}
+
+        .room-item {{
+            padding: 6px 10px;
+            border-radius: 4px;
+        }}
+
+        .room-item a {{
+            color: var(--link-color);
+            text-decoration: none;
+        }}
+
+        .room-item.active {{
+            background-color: var(--msg-bubble);
+            font-weight: bold;
+        }}
+
+        .room-join {{
+            display: flex;
+            gap: 5px;
+            margin-bottom: 20px;
+        }}
+
+        .room-join input {{
+            flex: 1;
+            min-width: 0;
+            padding: 5px;
+            border: 1px solid var(--input-border);
+            border-radius: 4px;
+            background-color: var(--input-bg);
+            color: var(--text-color);
+        }}
+
+        .room-header {{
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+        }}
+
         .start-chat:hover {{
             background-color: var(--button-hover);
         }}
@@ -625,40 +2398,416 @@ def base_html(content):
                 }});
             }}
             
+            // The page is either a room (data-room) or a private chat (data-recipient)
+            const messagesDiv = document.getElementById('messages');
+            const currentRoom = messagesDiv ? messagesDiv.dataset.room : null;
+            const recipient = messagesDiv ? messagesDiv.dataset.recipient : null;
+            const currentUser = messagesDiv ? messagesDiv.dataset.user : null;
+            const timeZone = messagesDiv && messagesDiv.dataset.tz ? messagesDiv.dataset.tz : undefined;
+            
+            // Times arrive in server time; a viewer with a timezone set gets
+            // them re-rendered from the message's epoch seconds
+            function formatTime(message) {{
+                if (!message.ts || !timeZone) return message.timestamp;
+                return new Date(message.ts * 1000).toLocaleTimeString('en-US',
+                    {{ hour: 'numeric', minute: '2-digit', timeZone: timeZone }}).toLowerCase();
+            }}
+            
+            function dayOf(ts) {{
+                return new Date(ts * 1000).toLocaleDateString('en-CA', {{ timeZone: timeZone }});
+            }}
+            
+            function daySeparator(day, label) {{
+                const separator = document.createElement('div');
+                separator.className = 'day-separator';
+                separator.dataset.day = day;
+                separator.textContent = label;
+                return separator;
+            }}
+            
+            function conversation() {{
+                return recipient ? {{ recipient: recipient }} : {{ room: currentRoom }};
+            }}
+            
+            function renderAttachments(attachments) {{
+                if (!attachments || !attachments.length) return '';
+                return '<div class="attachments">' + attachments.map(a =>
+                    `<a class="attachment" href="${{a.url}}" target="_blank">` +
+                    (a.thumbnail ? `<img src="${{a.thumbnail}}" alt="${{a.name}}" onerror="this.remove()">` : '') +
+                    `<span>${{a.name}} (${{Math.floor(a.size / 1024) + 1}} KB)</span></a>`).join('') + '</div>';
+            }}
+            
+            function buildMessage(message) {{
+                const newMsg = document.createElement('div');
+                newMsg.className = 'message-container';
+                newMsg.dataset.id = message.id;
+                newMsg.dataset.day = message.ts && timeZone ? dayOf(message.ts) : (message.day || '');
+                const actions = message.author === currentUser && !message.deleted
+                    ? `<button class="message-action" onclick="editMessage('${{message.id}}')">Edit</button><button class="message-action" onclick="deleteMessage('${{message.id}}')">Delete</button>`
+                    : '';
+                newMsg.innerHTML = `
+                    <div class="message-header">
+                        <div class="avatar" style="background-color: ${{getUserColor(message.author)}}">
+                            ${{message.author[0].toUpperCase()}}
+                        </div>
+                        <span>${{message.author}}</span>
+                    </div>
+                    <div class="message-content">${{message.content}}</div>
+                    ${{renderAttachments(message.attachments)}}
+                    <div class="message-time">
+                        ${{message.edited ? '<span class="message-edited">(edited)</span>' : ''}}
+                        ${{formatTime(message)}}
+                        ${{actions}}
+                    </div>
+                `;
+                return newMsg;
+            }}
+            
+            function appendMessage(message) {{
+                // The sender gets its own message both from the response and the stream
+                if (document.querySelector(`[data-id="${{message.id}}"]`)) return;
+                const built = buildMessage(message);
+                const containers = messagesDiv.querySelectorAll('.message-container');
+                const last = containers[containers.length - 1];
+                if (built.dataset.day && (!last || last.dataset.day !== built.dataset.day)) {{
+                    messagesDiv.appendChild(daySeparator(built.dataset.day, 'Today'));
+                }}
+                messagesDiv.appendChild(built);
+                messagesDiv.scrollTop = messagesDiv.scrollHeight;
+            }}
+            
+            // Older pages of a room or private chat are fetched on demand
+            window.loadOlder = function() {{
+                const before = messagesDiv.dataset.before;
+                if (!before || before === '0') return;
+                const url = messagesDiv.dataset.room
+                    ? `/room/${{encodeURIComponent(messagesDiv.dataset.room)}}/messages`
+                    : `/chat/${{encodeURIComponent(messagesDiv.dataset.peer)}}/messages`;
+                fetch(`${{url}}?before=${{before}}`)
+                .then(response => response.json())
+                .then(data => {{
+                    if (data.status !== 'success') return;
+                    const button = document.getElementById('load-older');
+                    let anchor = button.nextElementSibling;
+                    const height = messagesDiv.scrollHeight;
+                    const page = document.createDocumentFragment();
+                    let lastDay = null;
+                    data.messages.forEach(message => {{
+                        if (document.querySelector(`[data-id="${{message.id}}"]`)) return;
+                        if (message.day && message.day !== lastDay) {{
+                            page.appendChild(daySeparator(message.day, message.day_label));
+                            lastDay = message.day;
+                        }}
+                        page.appendChild(buildMessage(message));
+                    }});
+                    // The page may end on the same day the shown messages start
+                    if (anchor && anchor.classList.contains('day-separator') && anchor.dataset.day === lastDay) {{
+                        const next = anchor.nextElementSibling;
+                        anchor.remove();
+                        anchor = next;
+                    }}
+                    messagesDiv.insertBefore(page, anchor);
+                    messagesDiv.scrollTop += messagesDiv.scrollHeight - height;
+                    messagesDiv.dataset.before = data.before;
+                    if (!data.before) button.remove();
+                }});
+            }};
+            
+            window.startPrivateChat = function(username) {{
+                window.location = `/chat/${{encodeURIComponent(username)}}`;
+            }};
+            
+            // User directory: one page at a time, filtered as you type
+            const userList = document.getElementById('user-list');
+            const userSearch = document.getElementById('user-search');
+            let usersNext = null;
+            let searchTimer = null;
+            
+            window.loadUsers = function(reset) {{
+                const params = new URLSearchParams({{ prefix: userSearch.value.trim() }});
+                if (!reset && usersNext) params.set('after', usersNext);
+                fetch(`/users?${{params}}`)
+                .then(response => response.json())
+                .then(data => {{
+                    if (data.status !== 'success') return;
+                    if (reset) userList.innerHTML = '';
+                    data.users.forEach(user => {{
+                        const item = document.createElement('li');
+                        item.className = 'user-item';
+                        item.innerHTML = `
+                            <div class="avatar" style="background-color: ${{getUserColor(user.username)}}">
+                                ${{user.username[0].toUpperCase()}}
+                            </div>
+                            <span class="user-name">${{user.username}}</span>
+                            ${{user.unread ? `<span class="unread-badge">${{user.unread}}</span>` : ''}}
+                            <button class="start-chat">Chat</button>
+                        `;
+                        item.querySelector('button').addEventListener('click', () => startPrivateChat(user.username));
+                        userList.appendChild(item);
+                    }});
+                    usersNext = data.next;
+                    document.getElementById('more-users').style.display = usersNext ? 'block' : 'none';
+                }});
+            }};
+            
+            if (userList) {{
+                userSearch.addEventListener('input', function() {{
+                    clearTimeout(searchTimer);
+                    searchTimer = setTimeout(() => loadUsers(true), 150);
+                }});
+                loadUsers(true);
+            }}
+            
+            // Typing indicators: at most one "typing" per throttle window while
+            // keys are pressed, and "stopped" after a pause or on send
+            const messageInput = document.getElementById('message-input');
+            let typingSentAt = 0;
+            let typingIdle = null;
+            
+            function sendTyping(typing) {{
+                fetch('/typing', {{
+                    method: 'POST',
+                    headers: {{ 'Content-Type': 'application/json' }},
+                    body: JSON.stringify(Object.assign({{ typing: typing }}, conversation()))
+                }});
+            }}
+            
+            function stopTyping() {{
+                clearTimeout(typingIdle);
+                if (typingSentAt) sendTyping(false);
+                typingSentAt = 0;
+            }}
+            
+            if (messageInput && messagesDiv) {{
+                messageInput.addEventListener('input', function() {{
+                    const now = Date.now();
+                    if (now - typingSentAt > {TYPING_THROTTLE * 1000:.0f}) {{
+                        sendTyping(true);
+                        typingSentAt = now;
+                    }}
+                    clearTimeout(typingIdle);
+                    typingIdle = setTimeout(stopTyping, {TYPING_IDLE * 1000:.0f});
+                }});
+            }}
+            
+            const typers = {{}};
+            
+            function showTypers() {{
+                const indicator = document.getElementById('typing-indicator');
+                if (!indicator) return;
+                const names = Object.keys(typers);
+                indicator.textContent = names.length === 0 ? ''
+                    : names.length === 1 ? `${{names[0]}} is typing...`
+                    : names.length === 2 ? `${{names[0]}} and ${{names[1]}} are typing...`
+                    : 'Several people are typing...';
+            }}
+            
+            function typingEvent(event) {{
+                if (event.user === currentUser) return;
+                clearTimeout(typers[event.user]);
+                delete typers[event.user];
+                if (event.typing) {{
+                    typers[event.user] = setTimeout(() => {{
+                        delete typers[event.user];
+                        showTypers();
+                    }}, event.ttl * 1000);
+                }}
+                showTypers();
+            }}
+            
+            // Attachments upload in chunks before the message is sent. A chunk
+            // that fails asks the server how far it got and carries on from there.
+            const pendingAttachments = [];
+            let uploadsInFlight = 0;
+            
+            function showPendingAttachments(status) {{
+                const pending = document.getElementById('pending-attachments');
+                if (!pending) return;
+                const names = pendingAttachments.map(a => a.name).join(', ');
+                pending.textContent = status || (names ? 'Attached: ' + names : '');
+            }}
+            
+            async function sha256Hex(file) {{
+                // Only small files are hashed up front; large ones skip the dedup check
+                if (!window.crypto || !crypto.subtle || file.size > 16 * 1024 * 1024) return null;
+                const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+                return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+            }}
+            
+            async function uploadFile(file) {{
+                const start = await fetch('/uploads', {{
+                    method: 'POST',
+                    headers: {{ 'Content-Type': 'application/json' }},
+                    body: JSON.stringify({{ name: file.name, size: file.size, sha256: await sha256Hex(file) }})
+                }}).then(response => response.json());
+                if (start.status !== 'success') throw new Error(start.message);
+                if (start.attachment) return start.attachment;
+                
+                let offset = start.offset;
+                let failures = 0;
+                while (true) {{
+                    showPendingAttachments(`Uploading ${{file.name}}: ${{Math.floor(offset * 100 / file.size)}}%`);
+                    let data;
+                    try {{
+                        data = await fetch('/uploads/' + start.id, {{
+                            method: 'PATCH',
+                            headers: {{ 'Upload-Offset': String(offset), 'Content-Type': 'application/octet-stream' }},
+                            body: file.slice(offset, offset + start.chunk_size)
+                        }}).then(response => response.json());
+                    }} catch (err) {{
+                        data = {{ status: 'error' }};
+                    }}
+                    if (data.status !== 'success') {{
+                        if (++failures > 5) throw new Error('Upload failed');
+                        await new Promise(resolve => setTimeout(resolve, 500 * failures));
+                        const status = await fetch('/uploads/' + start.id).then(response => response.json());
+                        if (status.status !== 'success') throw new Error(status.message);
+                        offset = status.offset;
+                        continue;
+                    }}
+                    failures = 0;
+                    offset = data.offset;
+                    if (data.attachment) return data.attachment;
+                }}
+            }}
+            
+            window.attachFiles = async function(input) {{
+                const files = Array.from(input.files);
+                input.value = '';
+                for (const file of files) {{
+                    uploadsInFlight++;
+                    try {{
+                        pendingAttachments.push(await uploadFile(file));
+                    }} catch (err) {{
+                        alert(`Could not upload ${{file.name}}: ${{err.message}}`);
+                    }} finally {{
+                        uploadsInFlight--;
+                    }}
+                    showPendingAttachments();
+                }}
+            }};
+            
             // Message sending
             window.sendMessage = function() {{
                 const input = document.getElementById('message-input');
                 const message = input.value.trim();
-                if (!message) return;
+                if ((!message && !pendingAttachments.length) || uploadsInFlight) return;
+                stopTyping();
                 
+                const attachments = pendingAttachments.map(a => ({{ sha256: a.sha256, name: a.name }}));
                 fetch('/send-message', {{
                     method: 'POST',
                     headers: {{ 'Content-Type': 'application/json' }},
-                    body: JSON.stringify({{ content: message }})
+                    body: JSON.stringify(Object.assign({{ content: message, attachments: attachments }},
+                        recipient ? {{ is_private: true, recipient: recipient }} : {{ room: currentRoom }}))
                 }})
                 .then(response => response.json())
                 .then(data => {{
                     if (data.status === 'success') {{
-                        const messagesDiv = document.getElementById('messages');
-                        const newMsg = document.createElement('div');
-                        newMsg.className = 'message-container';
-                        newMsg.innerHTML = `
-                            <div class="message-header">
-                                <div class="avatar" style="background-color: ${{getUserColor(data.message.author)}}">
-                                    ${{data.message.author[0].toUpperCase()}}
-                                </div>
-                                <span>${{data.message.author}}</span>
-                            </div>
-                            <div class="message-content">${{data.message.content}}</div>
-                            <div class="message-time">${{data.message.timestamp}}</div>
-                        `;
-                        messagesDiv.appendChild(newMsg);
+                        appendMessage(data.message);
                         input.value = '';
-                        messagesDiv.scrollTop = messagesDiv.scrollHeight;
+                        pendingAttachments.length = 0;
+                        showPendingAttachments();
+                    }} else {{
+                        alert(data.message);
                     }}
                 }});
             }};
             
+            // Edits and deletes arrive as small deltas against a rendered message
+            function applyDelta(event) {{
+                const container = document.querySelector(`[data-id="${{event.id}}"]`);
+                if (!container) return;
+                const content = container.querySelector('.message-content');
+                const time = container.querySelector('.message-time');
+                if (event.type === 'delete') {{
+                    content.innerHTML = '<em class="message-deleted">This message was deleted</em>';
+                    container.querySelectorAll('.attachments').forEach(el => el.remove());
+                    time.querySelectorAll('.message-action, .message-edited').forEach(el => el.remove());
+                }} else {{
+                    content.innerHTML = event.content;
+                    if (!time.querySelector('.message-edited')) {{
+                        time.insertAdjacentHTML('afterbegin', '<span class="message-edited">(edited)</span>');
+                    }}
+                }}
+            }}
+            
+            window.editMessage = function(id) {{
+                const content = prompt('Edit message');
+                if (!content || !content.trim()) return;
+                fetch('/edit-message', {{
+                    method: 'POST',
+                    headers: {{ 'Content-Type': 'application/json' }},
+                    body: JSON.stringify(Object.assign({{ id: id, content: content.trim() }}, conversation()))
+                }})
+                .then(response => response.json())
+                .then(data => {{
+                    if (data.status === 'success') applyDelta(data.delta);
+                    else alert(data.message);
+                }});
+            }};
+            
+            window.deleteMessage = function(id) {{
+                if (!confirm('Delete this message?')) return;
+                fetch('/delete-message', {{
+                    method: 'POST',
+                    headers: {{ 'Content-Type': 'application/json' }},
+                    body: JSON.stringify(Object.assign({{ id: id }}, conversation()))
+                }})
+                .then(response => response.json())
+                .then(data => {{ if (data.status === 'success') applyDelta(data.delta); }});
+            }};
+            
+            // Live messages for the room or chat on screen
+            if (messagesDiv && messagesDiv.dataset.stream) {{
+                const events = new EventSource(messagesDiv.dataset.stream);
+                events.onmessage = function(e) {{
+                    const event = JSON.parse(e.data);
+                    if (event.type === 'message') {{
+                        appendMessage(event.message);
+                        fetch('/mark-read', {{
+                            method: 'POST',
+                            headers: {{ 'Content-Type': 'application/json' }},
+                            body: JSON.stringify(conversation())
+                        }});
+                    }} else if (event.type === 'edit' || event.type === 'delete') {{
+                        applyDelta(event);
+                    }} else if (event.type === 'typing') {{
+                        typingEvent(event);
+                    }} else if (event.type === 'reload') {{
+                        // Missed too much to catch up message by message
+                        events.close();
+                        location.reload();
+                    }}
+                }};
+            }}
+            
+            window.joinRoom = function() {{
+                const name = document.getElementById('room-name').value.trim().toLowerCase();
+                if (!name) return;
+                fetch(`/rooms/${{name}}/join`, {{ method: 'POST' }})
+                .then(response => response.status === 404
+                    ? fetch('/rooms', {{
+                        method: 'POST',
+                        headers: {{ 'Content-Type': 'application/json' }},
+                        body: JSON.stringify({{ name: name }})
+                    }})
+                    : response)
+                .then(response => response.json())
+                .then(data => {{
+                    if (data.status === 'success') {{
+                        window.location = `/room/${{name}}`;
+                    }} else {{
+                        alert(data.message);
+                    }}
+                }});
+            }};
+            
+            window.leaveRoom = function() {{
+                fetch(`/rooms/${{currentRoom}}/leave`, {{ method: 'POST' }})
+                .then(() => {{ window.location = '/'; }});
+            }};
+            
             function getUserColor(username) {{
                 const colors = [
                     '#FF6B6B', '#4ECDC4', '#45B7D1', '#FFA07A',
@@ -669,7 +2818,6 @@ def base_html(content):
             }}
             
             // Auto-scroll to bottom of messages
-            const messagesDiv = document.getElementById('messages');
             if (messagesDiv) {{
                 messagesDiv.scrollTop = messagesDiv.scrollHeight;
             }}
@@ -689,8 +2837,9 @@ def base_html(content):
 """
 
 # Routes
-@app.route('/')
-def index():
+@bp.route('/')
+@bp.route('/room/<room>')
+def index(room=DEFAULT_ROOM):
     if 'email' not in session:
         return redirect('/login')
     
@@ -699,52 +2848,64 @@ def index():
         session.clear()
         return redirect('/login')
     
-    messages = get_public_messages()
-    for message in messages:
+    if not get_room(room):
+        return "Room not found", 404
+    if not is_room_member(room, session['email']):
+        join_room(room, session['email'])
+    
+    tz = session.get('timezone')
+    today = local_today(tz)
+    page, before = get_room_page(room)
+    messages = []
+    for message in page:
         user = get_user_by_email(message['author'])
-        message['author'] = user['username'] if user else 'Unknown'
-        message['content'] = format_message(message['content'])
-        message['timestamp'] = format_time(message['timestamp'])
+        messages.append(display_message(message, user['username'] if user else 'Unknown',
+                                        message['author'] == session['email'], tz, today))
     
-    with open('data/users.json', 'r') as f:
-        users = json.load(f)['users']
+    # Everything in this room is on screen now
+    mark_read(session['email'], room)
+    unread = unread_counts(session['email'])
+    joined_rooms = rooms_for_user(session['email'])
     
     content = f"""
     <div class="chat-container">
         <div class="sidebar">
-            <h3>Online Users</h3>
-            <ul class="user-list">
+            <h3>Rooms</h3>
+            <ul class="room-list">
                 {' '.join(f'''
-                <li class="user-item">
-                    <div class="avatar" style="background-color: {get_user_color(user['username'])}">
-                        {user['username'][0].upper()}
-                    </div>
-                    <span class="user-name">{user['username']}</span>
-                    <button class="start-chat" onclick="startPrivateChat('{user['email']}')">Chat</button>
+                <li class="room-item{' active' if name == room else ''}">
+                    <a href="/room/{name}"># {name}</a>
+                    {'<span class="unread-badge">' + str(unread[name]) + '</span>' if unread.get(name) and name != room else ''}
                 </li>
-                ''' for user in users if user['email'] != session['email'])}
+                ''' for name in joined_rooms)}
             </ul>
+            <div class="room-join">
+                <input type="text" id="room-name" placeholder="Join or create a room">
+                <button class="start-chat" onclick="joinRoom()">Join</button>
+            </div>
+            <h3>Users</h3>
+            <input type="text" class="user-search" id="user-search" placeholder="Search users to chat with">
+            <ul class="user-list" id="user-list"></ul>
+            <button class="load-older" id="more-users" style="display: none" onclick="loadUsers(false)">More users</button>
         </div>
         <div class="chat-area">
-            <div class="messages" id="messages">
-                {' '.join(f'''
-                <div class="message-container">
-                    <div class="message-header">
-                        <div class="avatar" style="background-color: {get_user_color(msg['author'])}">
-                            {msg['author'][0].upper()}
-                        </div>
-                        <span>{msg['author']}</span>
-                    </div>
-                    <div class="message-content">{msg['content']}</div>
-                    <div class="message-time">{msg['timestamp']}</div>
-                </div>
-                {'<div class="separator"></div>' if i < len(messages)-1 else ''}
-                ''' for i, msg in enumerate(messages))}
+            <div class="room-header">
+                <h3># {room}</h3>
+                {'' if room == DEFAULT_ROOM else f'<button class="start-chat" onclick="leaveRoom()">Leave</button>'}
             </div>
+            <div class="messages" id="messages" data-room="{room}" data-user="{current_user['username']}"
+                 data-before="{before}" data-tz="{session.get('timezone') or ''}" data-stream="/stream/{room}">
+                {'<button class="load-older" id="load-older" onclick="loadOlder()">Load older messages</button>' if before else ''}
+                {render_messages(messages)}
+            </div>
+            <div class="typing-indicator" id="typing-indicator"></div>
             <div class="formatting-buttons">
                 <button type="button" class="format-button" id="bold-btn">Bold</button>
                 <button type="button" class="format-button" id="italic-btn">Italic</button>
+                <button type="button" class="format-button" onclick="document.getElementById('attach-input').click()">Attach</button>
+                <input type="file" id="attach-input" multiple style="display: none" onchange="attachFiles(this)">
             </div>
+            <div class="pending-attachments" id="pending-attachments"></div>
             <div class="input-area">
                 <textarea class="message-input" id="message-input" placeholder="Type your message..."></textarea>
                 <button class="send-button" onclick="sendMessage()">Send</button>
@@ -754,7 +2915,128 @@ def index():
     """
     return render_template_string(base_html(content))
 
-@app.route('/login', methods=['GET', 'POST'])
+# Private chat
+# Only the newest page is rendered; older pages are read backwards from the
+# end of the conversation's shard on demand, so neither depends on how long
+# the conversation is.
+@bp.route('/chat/<username>')
+def private_chat(username):
+    if 'email' not in session:
+        return redirect('/login')
+    
+    current_user = get_user_by_email(session['email'])
+    if not current_user:
+        session.clear()
+        return redirect('/login')
+    
+    other = get_user_by_username(username)
+    if not other or other['email'] == current_user['email']:
+        return "User not found", 404
+    
+    names = {current_user['email']: current_user['username'], other['email']: other['username']}
+    page, before = get_private_page(current_user['email'], other['email'])
+    tz = session.get('timezone')
+    today = local_today(tz)
+    messages = [display_message(m, names.get(m['author'], 'Unknown'), m['author'] == current_user['email'], tz, today)
+                for m in page]
+    mark_read(current_user['email'], private_conversation_id(current_user['email'], other['email']))
+    
+    content = f"""
+    <div class="chat-container">
+        <div class="chat-area">
+            <div class="room-header">
+                <h3>@ {other['username']}</h3>
+                <button class="start-chat" onclick="window.location = '/'">Back</button>
+            </div>
+            <div class="messages" id="messages" data-recipient="{other['email']}" data-peer="{other['username']}"
+                 data-user="{current_user['username']}" data-before="{before}" data-tz="{session.get('timezone') or ''}"
+                 data-stream="/stream/chat/{other['username']}">
+                {'<button class="load-older" id="load-older" onclick="loadOlder()">Load older messages</button>' if before else ''}
+                {render_messages(messages)}
+            </div>
+            <div class="typing-indicator" id="typing-indicator"></div>
+            <div class="formatting-buttons">
+                <button type="button" class="format-button" id="bold-btn">Bold</button>
+                <button type="button" class="format-button" id="italic-btn">Italic</button>
+                <button type="button" class="format-button" onclick="document.getElementById('attach-input').click()">Attach</button>
+                <input type="file" id="attach-input" multiple style="display: none" onchange="attachFiles(this)">
+            </div>
+            <div class="pending-attachments" id="pending-attachments"></div>
+            <div class="input-area">
+                <textarea class="message-input" id="message-input" placeholder="Message {other['username']}..."></textarea>
+                <button class="send-button" onclick="sendMessage()">Send</button>
+            </div>
+        </div>
+    </div>
+    """
+    return render_template_string(base_html(content))
+
+def page_args(conversation, page_size):
+    # (limit, before) for a request for an older page of a conversation, or
+    # None if `before` isn't a byte offset into its shard, as handed out by
+    # earlier pages
+    limit = max(1, min(request.args.get('limit', page_size, type=int), page_size * 4))
+    before = request.args.get('before')
+    if before is not None:
+        path = conversation_file(conversation)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if not (before.isascii() and before.isdigit()) or int(before) > size:
+            return None
+        before = int(before)
+    return limit, before
+
+@bp.route('/chat/<username>/messages')
+def private_chat_messages(username):
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    other = get_user_by_username(username)
+    if not other or other['email'] == session['email']:
+        return jsonify({'status': 'error', 'message': 'User not found'}), 404
+    
+    args = page_args(private_conversation_id(session['email'], other['email']), PRIVATE_PAGE_SIZE)
+    if args is None:
+        return jsonify({'status': 'error', 'message': 'Invalid before offset'}), 400
+    limit, before = args
+    if before == 0:
+        return jsonify({'status': 'success', 'messages': [], 'before': 0})
+    
+    names = {session['email']: session['username'], other['email']: other['username']}
+    page, before = get_private_page(session['email'], other['email'], limit, before)
+    tz = session.get('timezone')
+    today = local_today(tz)
+    return jsonify({
+        'status': 'success',
+        'messages': [display_message(m, names.get(m['author'], 'Unknown'), m['author'] == session['email'], tz, today)
+                     for m in page],
+        'before': before
+    })
+
+@bp.route('/room/<room>/messages')
+def room_messages(room):
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    if not get_room(room) or not is_room_member(room, session['email']):
+        return jsonify({'status': 'error', 'message': 'Not a member of this room'}), 403
+    
+    args = page_args(room, ROOM_PAGE_SIZE)
+    if args is None:
+        return jsonify({'status': 'error', 'message': 'Invalid before offset'}), 400
+    limit, before = args
+    if before == 0:
+        return jsonify({'status': 'success', 'messages': [], 'before': 0})
+    
+    page, before = get_room_page(room, limit, before)
+    tz = session.get('timezone')
+    today = local_today(tz)
+    messages = []
+    for message in page:
+        user = get_user_by_email(message['author'])
+        messages.append(display_message(message, user['username'] if user else 'Unknown',
+                                        message['author'] == session['email'], tz, today))
+    return jsonify({'status': 'success', 'messages': messages, 'before': before})
+
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if 'email' in session:
         return redirect('/')
@@ -771,6 +3053,7 @@ def login():
             session['email'] = email
             session['username'] = user['username']
             session['dark_mode'] = user['settings']['dark_mode']
+            session['timezone'] = user['settings'].get('timezone')
             return redirect('/')
     
     content = f"""
@@ -795,7 +3078,7 @@ def login():
     """
     return render_template_string(base_html(content))
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if 'email' in session:
         return redirect('/')
@@ -820,7 +3103,7 @@ def register():
                     error = "Invalid file type (only JPG, PNG, GIF allowed)"
                 else:
                     filename = secure_filename(f"{username}.{profile_pic.filename.rsplit('.', 1)[1].lower()}")
-                    profile_pic.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                    profile_pic.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
                     avatar_path = f"/pfp/{filename}"
             
             if not error:
@@ -838,9 +3121,15 @@ def register():
                     }
                 }
                 save_user(new_user)
-                session['email'] = email
-                session['username'] = username
-                return redirect('/')
+                try:
+                    unit_of_work().commit()
+                except StoreConflict:
+                    # Someone signed up with the same email or username meanwhile
+                    error = "Email or username already taken"
+                else:
+                    session['email'] = email
+                    session['username'] = username
+                    return redirect('/')
     
     content = f"""
     <div class="register-container">
@@ -872,12 +3161,12 @@ def register():
     """
     return render_template_string(base_html(content))
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.clear()
     return redirect('/login')
 
-@app.route('/settings')
+@bp.route('/settings')
 def settings():
     if 'email' not in session:
         return redirect('/login')
@@ -908,6 +3197,11 @@ def settings():
                 <label for="profile_pic">Profile Picture</label>
                 <input type="file" id="profile_pic" name="profile_pic" accept="image/*">
             </div>
+            <div class="settings-option">
+                <label for="timezone">Time Zone</label>
+                <input type="text" id="timezone" name="timezone" value="{current_user['settings'].get('timezone') or ''}"
+                       placeholder="Server time, or e.g. Europe/London">
+            </div>
             <div class="settings-option theme-toggle">
                 <label>Dark Mode</label>
                 <label class="switch">
@@ -923,7 +3217,7 @@ def settings():
     """
     return render_template_string(base_html(content))
 
-@app.route('/update-profile', methods=['POST'])
+@bp.route('/update-profile', methods=['POST'])
 def update_profile():
     if 'email' not in session:
         return redirect('/login')
@@ -936,6 +3230,9 @@ def update_profile():
     
     username = request.form.get('username')
     profile_pic = request.files.get('profile_pic')
+    timezone = request.form.get('timezone', '').strip() or None
+    if timezone and not valid_timezone(timezone):
+        return "Unknown time zone", 400
     
     # Check if username is taken by another user
     existing_user = get_user_by_username(username)
@@ -955,7 +3252,7 @@ def update_profile():
             os.remove(avatar_path.lstrip('/'))
         
         filename = secure_filename(f"{username}.{profile_pic.filename.rsplit('.', 1)[1].lower()}")
-        profile_pic.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        profile_pic.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
         avatar_path = f"/pfp/{filename}"
     
     # Update user data
@@ -965,14 +3262,23 @@ def update_profile():
         'profile': {
             **current_user['profile'],
             'avatar': avatar_path
+        },
+        'settings': {
+            **current_user['settings'],
+            'timezone': timezone
         }
     }
     
     update_user(current_email, updated_user)
+    try:
+        unit_of_work().commit()
+    except StoreConflict:
+        return "Username already taken", 400
     session['username'] = username
+    session['timezone'] = timezone
     return redirect('/settings')
 
-@app.route('/toggle-theme', methods=['POST'])
+@bp.route('/toggle-theme', methods=['POST'])
 def toggle_theme():
     if 'email' not in session:
         return jsonify({'status': 'error'}), 401
@@ -989,7 +3295,7 @@ def toggle_theme():
     
     return jsonify({'status': 'success'})
 
-@app.route('/info')
+@bp.route('/info')
 def info():
     if 'email' not in session:
         return redirect('/login')
@@ -1027,11 +3333,91 @@ def info():
     """
     return render_template_string(base_html(content))
 
-@app.route('/pfp/<filename>')
+@bp.route('/pfp/<filename>')
 def serve_pfp(filename):
     return send_from_directory('static/pfp', filename)
 
-@app.route('/send-message', methods=['POST'])
+@bp.route('/uploads', methods=['POST'])
+def start_upload():
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    data = request.get_json() or {}
+    name = secure_filename(data.get('name') or '') or 'file'
+    size = data.get('size')
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        return jsonify({'status': 'error', 'message': 'File size required'}), 400
+    if size > MAX_ATTACHMENT_SIZE:
+        return jsonify({'status': 'error', 'message': 'File too large (max 100MB)'}), 413
+    
+    # Content this user has uploaded before needs no transfer
+    sha256 = data.get('sha256') or ''
+    if SHA256_PATTERN.match(sha256) and os.path.exists(blob_path(sha256)) \
+            and os.path.getsize(blob_path(sha256)) == size \
+            and session['email'] in attachment_record(sha256)['uploaders']:
+        return jsonify({'status': 'success', 'offset': size, 'attachment': attachment_info(sha256, name)})
+    
+    upload_id = create_upload(session['email'], name, size)
+    return jsonify({'status': 'success', 'id': upload_id, 'offset': 0, 'chunk_size': UPLOAD_CHUNK_SIZE})
+
+@bp.route('/uploads/<upload_id>')
+def upload_status(upload_id):
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    upload = get_upload(upload_id)
+    if not upload or upload['email'] != session['email']:
+        return jsonify({'status': 'error', 'message': 'Upload not found'}), 404
+    return jsonify({'status': 'success', 'offset': upload['offset'], 'size': upload['size']})
+
+@bp.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    upload = get_upload(upload_id)
+    if not upload or upload['email'] != session['email']:
+        return jsonify({'status': 'error', 'message': 'Upload not found'}), 404
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'status': 'error', 'message': 'Upload-Offset required'}), 400
+    
+    accepted, current, attachment = write_chunk(upload_id, upload, offset, request.stream)
+    if not accepted:
+        return jsonify({'status': 'error', 'message': 'Offset mismatch', 'offset': current}), 409
+    return jsonify({'status': 'success', 'offset': current, 'attachment': attachment})
+
+@bp.route('/attachments/<sha256>')
+def download_attachment(sha256):
+    if 'email' not in session:
+        return redirect('/login')
+    if not SHA256_PATTERN.match(sha256) or not os.path.exists(blob_path(sha256)) \
+            or not can_view_attachment(sha256, session['email']):
+        return "Attachment not found", 404
+    
+    # Content never changes under a hash, so it can be cached for good;
+    # conditional=True answers Range requests with 206 partial content.
+    # The type comes from the bytes, never from the name the client sent.
+    name = secure_filename(request.args.get('name', '')) or sha256
+    mimetype = inline_image_type(sha256)
+    response = send_file(os.path.abspath(blob_path(sha256)), mimetype=mimetype or 'application/octet-stream',
+                         download_name=name, as_attachment=mimetype is None, conditional=True, max_age=31536000)
+    response.headers.update(ATTACHMENT_HEADERS)
+    return response
+
+@bp.route('/attachments/<sha256>/thumbnail')
+def attachment_thumbnail(sha256):
+    if 'email' not in session:
+        return redirect('/login')
+    if not SHA256_PATTERN.match(sha256) or not os.path.exists(thumbnail_path(sha256)) \
+            or not can_view_attachment(sha256, session['email']):
+        return "Thumbnail not found", 404
+    response = send_file(os.path.abspath(thumbnail_path(sha256)), mimetype='image/png',
+                         conditional=True, max_age=31536000)
+    response.headers.update(ATTACHMENT_HEADERS)
+    return response
+
+@bp.route('/send-message', methods=['POST'])
 def send_message():
     if 'email' not in session:
         return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
@@ -1040,35 +3426,571 @@ def send_message():
     content = data.get('content')
     is_private = data.get('is_private', False)
     recipient = data.get('recipient')
+    room = data.get('room') or DEFAULT_ROOM
     
-    if not content:
+    attachments = message_attachments(data.get('attachments', []), session['email'])
+    if attachments is None:
+        return jsonify({'status': 'error', 'message': 'Unknown attachment'}), 400
+    if not content and not attachments:
         return jsonify({'status': 'error', 'message': 'Message content required'}), 400
     
+    if not (is_private and recipient) and not is_room_member(room, session['email']):
+        return jsonify({'status': 'error', 'message': 'Not a member of this room'}), 403
+    if is_private and recipient and not valid_recipient(recipient):
+        return jsonify({'status': 'error', 'message': 'Recipient not found'}), 404
+    
+    blocked = moderate(None if is_private and recipient else room, content)
+    if blocked:
+        return jsonify({'status': 'error', 'message': blocked}), 400
+    
     user = get_user_by_email(session['email'])
     if not user:
         return jsonify({'status': 'error', 'message': 'User not found'}), 404
     
+    now = datetime.now()
     message = {
         'id': str(uuid.uuid4()),
         'author': session['email'],
-        'content': content,
-        'timestamp': datetime.now().isoformat(),
+        'content': content or '',
+        'timestamp': now.isoformat(),
+        'ts': int(now.timestamp()),
         'edited': False
     }
+    if attachments:
+        message['attachments'] = attachments
+        # Recorded first, so no member sees the message before it can download them
+        conversation = private_conversation_id(session['email'], recipient) if is_private and recipient else room
+        for attachment in attachments:
+            record_attachment(attachment['sha256'], conversation=conversation)
+    
+    # Shown in server time; viewers with a timezone re-render it from 'ts'
+    shown = display_message(message, user['username'])
     
     if is_private and recipient:
-        add_private_message(session['email'], recipient, message)
+        add_private_message(session['email'], recipient, message,
+                            {'origin': NODE_ID, 'type': 'message', 'message': shown})
+        mark_read(session['email'], private_conversation_id(session['email'], recipient))
     else:
-        add_public_message(message)
+        add_room_message(room, message,
+                         {'origin': NODE_ID, 'type': 'message', 'room': room, 'message': shown})
+        mark_read(session['email'], room)
     
     return jsonify({
         'status': 'success',
-        'message': {
-            'author': user['username'],
-            'content': format_message(content),
-            'timestamp': format_time(message['timestamp'])
-        }
+        'message': {**shown, 'own': True}
     })
 
+def valid_recipient(recipient):
+    # A recipient names a shard file, a bus topic and a digest mailbox, so it
+    # has to be someone else who actually has an account
+    return isinstance(recipient, str) and recipient != session['email'] and get_user_by_email(recipient) is not None
+
+def request_conversation(data):
+    # The conversation a JSON request refers to: a private conversation with
+    # `recipient`, otherwise `room`. None if there is no such user or the
+    # user isn't in that room.
+    if data.get('recipient'):
+        return private_conversation_id(session['email'], data['recipient']) if valid_recipient(data['recipient']) else None
+    room = data.get('room') or DEFAULT_ROOM
+    return room if isinstance(room, str) and is_room_member(room, session['email']) else None
+
+def conversation_error(data):
+    # The response for a request_conversation() that came back None
+    if data.get('recipient'):
+        return jsonify({'status': 'error', 'message': 'Recipient not found'}), 404
+    return jsonify({'status': 'error', 'message': 'Not a member of this room'}), 403
+
+def message_target(data):
+    # The conversation and id of the message a JSON request refers to, or
+    # (None, None). Whether it is the user's own is checked by add_patch.
+    conversation = request_conversation(data)
+    if not conversation or not data.get('id') or not isinstance(data['id'], str):
+        return None, None
+    return conversation, data['id']
+
+@bp.route('/edit-message', methods=['POST'])
+def edit_message():
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    data = request.get_json() or {}
+    content = data.get('content')
+    if not content:
+        return jsonify({'status': 'error', 'message': 'Message content required'}), 400
+    
+    conversation, message_id = message_target(data)
+    if not message_id:
+        return jsonify({'status': 'error', 'message': 'Message not found'}), 404
+    blocked = moderate(conversation, content)
+    if blocked:
+        return jsonify({'status': 'error', 'message': blocked}), 400
+    
+    delta = {'type': 'edit', 'id': message_id, 'content': format_message(content)}
+    if not add_patch(conversation, {
+        'op': 'edit',
+        'id': message_id,
+        'content': content,
+        'at': datetime.now().isoformat()
+    }, {'origin': NODE_ID, **delta}, author=session['email']):
+        return jsonify({'status': 'error', 'message': 'Message not found'}), 404
+    return jsonify({'status': 'success', 'delta': delta})
+
+@bp.route('/delete-message', methods=['POST'])
+def delete_message():
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    conversation, message_id = message_target(request.get_json() or {})
+    if not message_id:
+        return jsonify({'status': 'error', 'message': 'Message not found'}), 404
+    
+    delta = {'type': 'delete', 'id': message_id}
+    if not add_patch(conversation, {
+        'op': 'delete',
+        'id': message_id,
+        'at': datetime.now().isoformat()
+    }, {'origin': NODE_ID, **delta}, author=session['email']):
+        return jsonify({'status': 'error', 'message': 'Message not found'}), 404
+    return jsonify({'status': 'success', 'delta': delta})
+
+@bp.route('/mark-read', methods=['POST'])
+def mark_read_route():
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    data = request.get_json() or {}
+    conversation = request_conversation(data)
+    if not conversation:
+        return conversation_error(data)
+    
+    position = data.get('position')
+    if position is not None and (not isinstance(position, int) or isinstance(position, bool)):
+        return jsonify({'status': 'error', 'message': 'Position must be an integer'}), 400
+    
+    unread = mark_read(session['email'], conversation, position)
+    return jsonify({'status': 'success', 'conversation': conversation, 'unread': unread})
+
+@bp.route('/typing', methods=['POST'])
+def typing():
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    data = request.get_json() or {}
+    conversation = request_conversation(data)
+    if not conversation:
+        return conversation_error(data)
+    sent = publish_typing(session['email'], session['username'], conversation, bool(data.get('typing', True)))
+    return jsonify({'status': 'success', 'sent': sent})
+
+@bp.route('/unread')
+def unread_route():
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    return jsonify({'status': 'success', 'unread': unread_counts(session['email'])})
+
+@bp.route('/users')
+def users():
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    limit = max(1, min(request.args.get('limit', USER_PAGE_SIZE, type=int), 100))
+    found, next_cursor = search_users(request.args.get('prefix', ''), request.args.get('after'),
+                                      limit, exclude=session['email'])
+    # Only the conversations with the users on this page are counted
+    unread = unread_counts(session['email'], {private_conversation_id(session['email'], user['email']) for user in found})
+    return jsonify({'status': 'success', 'users': [{
+        'username': user['username'],
+        'unread': unread.get(private_conversation_id(session['email'], user['email']), 0)
+    } for user in found], 'next': next_cursor})
+
+@bp.route('/rooms')
+def rooms():
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    joined = set(rooms_for_user(session['email']))
+    return jsonify({'status': 'success', 'rooms': [{
+        'name': room['name'],
+        'members': len(room['members']),
+        'joined': room['name'] in joined
+    } for room in list_rooms()]})
+
+@bp.route('/rooms', methods=['POST'])
+def create_room_route():
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    data = request.get_json() or {}
+    name = (data.get('name') or '').strip().lower()
+    if not ROOM_NAME_PATTERN.match(name):
+        return jsonify({'status': 'error', 'message': 'Room names are 1-32 letters, digits, - or _'}), 400
+    
+    if not create_room(name, session['email']):
+        return jsonify({'status': 'error', 'message': 'Room already exists'}), 409
+    return jsonify({'status': 'success', 'room': name})
+
+@bp.route('/rooms/<room>/join', methods=['POST'])
+def join_room_route(room):
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    if not get_room(room):
+        return jsonify({'status': 'error', 'message': 'Room not found'}), 404
+    if room != DEFAULT_ROOM:
+        join_room(room, session['email'])
+    return jsonify({'status': 'success', 'room': room})
+
+@bp.route('/rooms/<room>/leave', methods=['POST'])
+def leave_room_route(room):
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    if not get_room(room):
+        return jsonify({'status': 'error', 'message': 'Room not found'}), 404
+    if room == DEFAULT_ROOM:
+        return jsonify({'status': 'error', 'message': 'Cannot leave the default room'}), 400
+    leave_room(room, session['email'])
+    return jsonify({'status': 'success', 'room': room})
+
+@bp.route('/stream/<room>')
+def stream(room):
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    if not get_room(room):
+        return jsonify({'status': 'error', 'message': 'Room not found'}), 404
+    if not is_room_member(room, session['email']):
+        return jsonify({'status': 'error', 'message': 'Not a member of this room'}), 403
+    return event_stream(room, request.headers.get('Last-Event-ID'))
+
+@bp.route('/stream/chat/<username>')
+def stream_chat(username):
+    if 'email' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'}), 401
+    
+    other = get_user_by_username(username)
+    if not other or other['email'] == session['email']:
+        return jsonify({'status': 'error', 'message': 'User not found'}), 404
+    return event_stream(private_conversation_id(session['email'], other['email']),
+                        request.headers.get('Last-Event-ID'))
+
+# Export and import
+#   flask --app app export backup.ndjson
+#   flask --app app import backup.ndjson
+# The stream is one JSON record per line, tagged by 'type': a header, then
+# users, rooms and each user's read state, then every conversation's messages
+# followed by its patches. Messages are copied line by line in both
+# directions, so memory stays flat however long the history is.
+def export_snapshot():
+    # Each file is captured under the lock the app writes it under: the JSON
+    # documents are read whole, and for each shard only its current size is
+    # noted. Shards are append-only, so the bytes up to that size can be
+    # streamed afterwards without holding any lock. Messages and patches of a
+    # conversation share one lock, so no exported patch refers to a message
+    # that isn't exported.
+    with shard_lock('data/users.json'):
+        with open('data/users.json', 'r') as f:
+            users = json.load(f)['users']
+    with rooms_lock, shard_lock(ROOMS_FILE):
+        load_rooms(reload=True)
+        rooms = [{**rooms_index[name], 'members': sorted(rooms_index[name]['members'])} for name in room_names]
+    with read_state_lock:
+        load_read_state()
+        state = json.loads(json.dumps({'cursors': read_state['cursors'],
+                                       'conversations': read_state['conversations']}))
+    conversations = [room['name'] for room in rooms]
+    conversations += sorted(filename[:-7] for filename in os.listdir('data/private_msgs')
+                            if filename.endswith('.ndjson'))
+    shards = []
+    for conversation in conversations:
+        path = conversation_file(conversation)
+        with shard_lock(path):
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            patches = patch_file(conversation)
+            patch_size = os.path.getsize(patches) if os.path.exists(patches) else 0
+        shards.append((conversation, path, size, patches, patch_size))
+    return users, rooms, state, shards
+
+def export_data(out, progress=None):
+    # Writes the NDJSON stream to the binary file `out`. progress(done, total)
+    # is called with shard bytes copied so far.
+    users, rooms, state, shards = export_snapshot()
+    
+    def write(record):
+        out.write(json.dumps(record).encode() + b'\n')
+    
+    write({'type': 'header', 'version': EXPORT_VERSION, 'exported_at': datetime.now().isoformat()})
+    for user in users:
+        write({'type': 'user', 'user': user})
+    for room in rooms:
+        write({'type': 'room', 'room': room})
+    for email in sorted(set(state['cursors']) | set(state['conversations'])):
+        write({'type': 'read_state', 'email': email, 'cursors': state['cursors'].get(email, {}),
+               'conversations': state['conversations'].get(email, [])})
+    
+    total = sum(size + patch_size for _, _, size, _, patch_size in shards)
+    done = 0
+    counts = {'message': 0, 'patch': 0}
+    for conversation, path, size, patches, patch_size in shards:
+        for kind, source, limit in (('message', path, size), ('patch', patches, patch_size)):
+            if not limit:
+                continue
+            # The stored line is already JSON, so it is spliced in as is
+            prefix = json.dumps({'type': kind, 'conversation': conversation})[:-1].encode() + f', "{kind}": '.encode()
+            with open(source, 'rb') as f:
+                copied = 0
+                for line in f:
+                    if copied + len(line) > limit or not line.endswith(b'\n'):
+                        break
+                    out.write(prefix + line[:-1] + b'}\n')
+                    copied += len(line)
+                    counts[kind] += 1
+                    if progress and counts[kind] % 10000 == 0:
+                        progress(done + copied, total)
+            done += limit
+    if progress:
+        progress(total, total)
+    return {'users': len(users), 'rooms': len(rooms), 'messages': counts['message'], 'patches': counts['patch']}
+
+def check_import_target():
+    with open('data/users.json', 'r') as f:
+        if json.load(f)['users']:
+            return "data/users.json already has users"
+    for folder in (ROOM_FOLDER, 'data/private_msgs', PATCH_FOLDER):
+        for filename in os.listdir(folder):
+            if filename.endswith('.ndjson') and os.path.getsize(f"{folder}/{filename}"):
+                return f"{folder}/{filename} already has messages"
+    return None
+
+def import_data(source, total=None, progress=None):
+    # Loads an export into this instance's data/, which must be empty. Users,
+    # rooms and read state are collected and written at the end; messages and
+    # patches are appended to their shards as they are read, one conversation
+    # at a time.
+    global read_state, read_state_loaded
+    users, rooms, state = [], [], {'cursors': {}, 'conversations': {}}
+    counts = {'message': 0, 'patch': 0}
+    current = None  # (kind, conversation, open shard)
+    done = 0
+    try:
+        for number, line in enumerate(source, 1):
+            done += len(line)
+            try:
+                record = json.loads(line)
+                kind = record['type']
+            except (ValueError, KeyError, TypeError):
+                raise click.ClickException(f"line {number}: not an export record")
+            if kind == 'header':
+                if record.get('version') != EXPORT_VERSION:
+                    raise click.ClickException(f"line {number}: unsupported export version {record.get('version')}")
+            elif kind == 'user':
+                users.append(record['user'])
+            elif kind == 'room':
+                rooms.append(record['room'])
+            elif kind == 'read_state':
+                if record['cursors']:
+                    state['cursors'][record['email']] = record['cursors']
+                if record['conversations']:
+                    state['conversations'][record['email']] = record['conversations']
+            elif kind in counts:
+                conversation = record['conversation']
+                if '/' in conversation or '\\' in conversation or conversation.startswith('.'):
+                    raise click.ClickException(f"line {number}: bad conversation id {conversation!r}")
+                if current is None or current[:2] != (kind, conversation):
+                    if current:
+                        current[2].close()
+                    path = conversation_file(conversation) if kind == 'message' else patch_file(conversation)
+                    current = (kind, conversation, open(path, 'a'))
+                current[2].write(json.dumps(record[kind]) + '\n')
+                counts[kind] += 1
+                if progress and counts[kind] % 10000 == 0:
+                    progress(done, total)
+            else:
+                raise click.ClickException(f"line {number}: unknown record type {kind!r}")
+    finally:
+        if current:
+            current[2].close()
+    
+    with shard_lock('data/users.json'):
+        with open('data/users.json', 'w') as f:
+            json.dump({'users': users}, f, indent=2)
+    with rooms_lock, shard_lock(ROOMS_FILE):
+        tmp_file = ROOMS_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'rooms': rooms}, f, indent=2)
+        os.replace(tmp_file, ROOMS_FILE)
+        load_rooms(reload=True)
+    with read_state_lock:
+        read_state = state
+        read_state_loaded = True
+        message_counts.clear()
+        count_offsets.clear()
+    flush_read_state()
+    with user_directory_lock:
+        load_user_directory(reload=True)
+    if progress:
+        progress(done, total)
+    return {'users': len(users), 'rooms': len(rooms), 'messages': counts['message'], 'patches': counts['patch']}
+
+def progress_printer(label):
+    # progress(done, total) callback that prints to stderr at most once per
+    # PROGRESS_INTERVAL, plus once when done reaches total
+    start = last = time.monotonic()
+    
+    def progress(done, total):
+        nonlocal last
+        now = time.monotonic()
+        if now - last < PROGRESS_INTERVAL and done != total:
+            return
+        last = now
+        percent = f" ({done / total:.0%})" if total else ''
+        click.echo(f"{label} {done / 1024 / 1024:.1f} MB{percent} in {now - start:.1f}s", err=True)
+    return progress
+
+@bp.cli.command('export')
+@click.argument('output', type=click.File('wb'), default='-')
+@click.option('--quiet', is_flag=True, help='Do not report progress.')
+def export_command(output, quiet):
+    """Write all users, rooms and messages to OUTPUT as NDJSON."""
+    totals = export_data(output, None if quiet else progress_printer('exported'))
+    output.flush()
+    click.echo(f"Exported {totals['users']} users, {totals['rooms']} rooms, "
+               f"{totals['messages']} messages and {totals['patches']} edits/deletes", err=True)
+
+@bp.cli.command('import')
+@click.argument('source', type=click.File('rb'), default='-')
+@click.option('--quiet', is_flag=True, help='Do not report progress.')
+def import_command(source, quiet):
+    """Load an export from SOURCE into an empty data directory."""
+    problem = check_import_target()
+    if problem:
+        raise click.ClickException(f"{problem}; import into an empty data directory")
+    try:
+        total = os.fstat(source.fileno()).st_size or None
+    except (AttributeError, OSError, ValueError):
+        total = None
+    totals = import_data(source, total, None if quiet else progress_printer('imported'))
+    click.echo(f"Imported {totals['users']} users, {totals['rooms']} rooms, "
+               f"{totals['messages']} messages and {totals['patches']} edits/deletes", err=True)
+
+@bp.cli.command('digests')
+@click.option('--json', 'as_json', is_flag=True, help='Print the figures as JSON.')
+def digests_command(as_json):
+    """Show the offline digest queue's depth and delivery latency."""
+    metrics = digest_metrics()
+    if as_json:
+        click.echo(json.dumps(metrics, indent=2))
+        return
+    click.echo(f"queued: {metrics['jobs']} users ({metrics['jobs_due']} due, {metrics['jobs_failed']} failed), "
+               f"{metrics['messages']} messages, oldest {metrics['oldest_message_age'] or 0:.0f}s")
+    click.echo(f"delivered in the last {DIGEST_METRICS_WINDOW / 60:.0f} min: {metrics['delivered']}")
+    if metrics['delivered']:
+        click.echo(f"  age (queued to sent) p50 {metrics['age_p50']:.1f}s  p99 {metrics['age_p99']:.1f}s")
+        click.echo(f"  lag (due to sent)    p50 {metrics['lag_p50']:.3f}s  p99 {metrics['lag_p99']:.3f}s")
+
+# Lifecycle
+# A worker that is asked to stop (see lifecycle.py) calls start_draining(),
+# waits up to DRAIN_TIMEOUT for active_requests to reach zero and then calls
+# flush_pending_writes(). While draining, requests in progress finish and
+# event streams end with a retry hint; the server closes each connection
+# after its response, so the client's next request goes to another worker.
+# Sessions are signed with a key kept in data/, so they stay valid across
+# restarts and in every worker.
+shutting_down = threading.Event()
+active_requests = 0
+active_requests_lock = threading.Lock()
+
+def track_requests(wsgi_app):
+    # WSGI middleware counting requests until their response has been sent
+    def application(environ, start_response):
+        global active_requests
+        with active_requests_lock:
+            active_requests += 1
+        try:
+            return ClosingIterator(wsgi_app(environ, start_response), request_finished)
+        except BaseException:
+            request_finished()
+            raise
+    
+    return application
+
+def request_finished():
+    global active_requests
+    with active_requests_lock:
+        active_requests -= 1
+
+def start_draining():
+    shutting_down.set()
+    close_streams()
+
+def flush_pending_writes():
+    global thumbnail_pool
+    stop_digest_worker()
+    with thumbnail_pool_lock:
+        if thumbnail_pool is not None:
+            thumbnail_pool.shutdown(wait=True)
+            thumbnail_pool = None
+    flush_read_state()
+    for connection in (bus, ephemeral_bus):
+        if connection is not None:
+            connection.close()
+
+def load_secret_key(app):
+    if app.config.get('SECRET_KEY'):
+        return
+    if not os.path.exists(SECRET_KEY_FILE):
+        # Written aside and linked into place, so workers starting together
+        # all end up with the same key and none reads a half-written file
+        tmp_file = f"{SECRET_KEY_FILE}.{uuid.uuid4().hex}.tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(os.urandom(32).hex())
+        try:
+            os.link(tmp_file, SECRET_KEY_FILE)
+        except FileExistsError:
+            pass  # another process got there first
+        finally:
+            os.remove(tmp_file)
+    with open(SECRET_KEY_FILE, 'r') as f:
+        app.secret_key = f.read().strip()
+
+def prewarm_caches(app):
+    # Optional: load the room index and read state and count every room up
+    # front, so the first requests don't pay for it
+    if not app.config['PREWARM_CACHES']:
+        return
+    with read_state_lock:
+        load_read_state()
+        for room in list_rooms():
+            count_messages(room['name'])
+
+startup_hooks = [ensure_directories, load_secret_key, init_data_files, load_moderation, start_bus, start_digest_worker, prewarm_caches]
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['MESSAGE_BUS_URL'] = MESSAGE_BUS_URL
+    app.config['PREWARM_CACHES'] = PREWARM_CACHES
+    app.config['DIGEST_NOTIFIER'] = DIGEST_NOTIFIER
+    app.config['DIGEST_WORKERS'] = DIGEST_WORKERS
+    app.config['DIGEST_DISPATCHER'] = DIGEST_DISPATCHER
+    if CONFIG_FILE:
+        app.config.from_file(os.path.abspath(CONFIG_FILE), load=json.load)
+    app.config.update(config or {})
+    app.register_blueprint(bp)
+    app.wsgi_app = track_requests(app.wsgi_app)
+    for hook in startup_hooks:
+        hook(app)
+    return app
+
+def __getattr__(name):
+    # `app:app` (waitress-serve, flask run) keeps working; the default app is
+    # only built the first time something asks for it
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    create_app({'DIGEST_DISPATCHER': True}).run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import resource
+
+# Shared helpers for the benchmark scripts. Benchmarks run the app from a
+# scratch working directory (the app keeps its data under ./data), so the repo
+# root is put on sys.path here.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+SCALES = {'1k': 1_000, '10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+
+
+def parse_scale(scale):
+    scale = scale.lower()
+    if scale in SCALES:
+        return SCALES[scale]
+    return int(scale)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def rss_mb():
+    # Current RSS where /proc is available, peak RSS otherwise
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def summarize(latencies, elapsed):
+    return {
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def timed(func, requests, max_seconds):
+    # Runs func up to `requests` times or until max_seconds have passed (but
+    # at least once) and returns the per-call latencies and the elapsed time.
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        t = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t)
+        if time.perf_counter() - start > max_seconds:
+            break
+    return latencies, time.perf_counter() - start
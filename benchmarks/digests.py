@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import atexit
+import random
+import shutil
+import tempfile
+import argparse
+import threading
+
+from common import percentile
+from seed import seed, user_email
+import notify
+
+# Offline digest queue benchmark
+# Sends private messages from many senders to many recipients the way
+# add_private_message does, timing the enqueue step on its own, then starts the
+# dispatcher and measures how long it takes to drain the queue through a
+# notifier that takes --notify-ms per send and fails --fail-rate of them.
+# Every recipient must end up with exactly one digest.
+#
+#   python benchmarks/digests.py
+#   python benchmarks/digests.py --workers 1 --notify-ms 20    # pool size vs slow transport
+
+
+class SlowNotifier:
+    def __init__(self, args):
+        self.delay = args.notify_ms / 1000
+        self.fail_rate = args.fail_rate
+        self.rng = random.Random(7)
+        self.lock = threading.Lock()
+        self.sent = {}
+
+    def send(self, email, digest):
+        time.sleep(self.delay)
+        with self.lock:
+            if self.rng.random() < self.fail_rate:
+                raise ConnectionError('simulated transport failure')
+            self.sent[email] = self.sent.get(email, 0) + 1
+
+    def close(self):
+        pass
+
+
+def enqueue(chat, args):
+    # Sender threads, each posting to its own slice of recipients
+    latencies = []
+    lock = threading.Lock()
+
+    def send(sender):
+        own = []
+        for n in range(args.messages // args.senders):
+            recipient = args.senders + (sender * 7919 + n) % args.recipients
+            message = {'id': f"{sender}-{n}", 'author': user_email(sender), 'content': f"message {n}",
+                       'timestamp': '', 'ts': int(time.time()), 'edited': False}
+            conversation = chat.private_conversation_id(user_email(sender), user_email(recipient))
+            chat.append_message(conversation, message)
+            start = time.perf_counter()
+            chat.queue_digest(user_email(recipient), conversation, message)
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(args.senders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'messages': len(latencies),
+        'messages_per_s': round(len(latencies) / elapsed),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def drain(chat, app, args, notifier):
+    notify.NOTIFIERS['bench'] = lambda url: notifier
+    # Everything falls due now, so lag measures the workers and not the enqueue phase
+    with chat.digest_transaction() as db:
+        db.execute('UPDATE digest_jobs SET due = ?', (time.time(),))
+    start = time.perf_counter()
+    app.config.update(DIGEST_NOTIFIER='bench://', DIGEST_WORKERS=args.workers, DIGEST_DISPATCHER=True)
+    chat.start_digest_worker(app)
+    while True:
+        metrics = chat.digest_metrics()
+        if metrics['jobs'] == metrics['jobs_failed']:
+            break
+        if time.perf_counter() - start > args.timeout:
+            break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    chat.stop_digest_worker()
+    return {
+        'seconds': round(elapsed, 2),
+        'digests_per_s': round(metrics['delivered'] / elapsed, 1),
+        'delivered': metrics['delivered'],
+        'left': metrics['jobs'],
+        'lag_p50_s': metrics['lag_p50'],
+        'lag_p99_s': metrics['lag_p99'],
+        'retried': metrics['process']['retried'],
+        'failed': metrics['process']['failed'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the offline digest queue')
+    parser.add_argument('--senders', type=int, default=8)
+    parser.add_argument('--recipients', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--notify-ms', type=float, default=5)
+    parser.add_argument('--fail-rate', type=float, default=0.05)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='chat-digests-')
+    try:
+        seed(os.path.join(workdir, 'data'), 0, users=args.senders + args.recipients, private_pairs=0)
+        os.chdir(workdir)
+        import app as chat
+        chat.DIGEST_DELAY = 0
+        chat.DIGEST_RETRY_DELAY = 0.05
+        app = chat.create_app({'DIGEST_DISPATCHER': False})
+        notifier = SlowNotifier(args)
+        results = {'enqueue': enqueue(chat, args)}
+        results['drain'] = drain(chat, app, args, notifier)
+        duplicates = sum(1 for count in notifier.sent.values() if count > 1)
+        chat.flush_read_state()
+        atexit.unregister(chat.flush_read_state)
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    e, d = results['enqueue'], results['drain']
+    print(f"  enqueue {e['messages']} messages  {e['messages_per_s']:>7}/s  "
+          f"p50 {e['p50_ms']:.3f} ms  p99 {e['p99_ms']:.3f} ms")
+    print(f"  drain   {d['delivered']} digests in {d['seconds']} s  {d['digests_per_s']}/s  "
+          f"lag p50 {d['lag_p50_s']} s  p99 {d['lag_p99_s']} s  retried {d['retried']}  failed {d['failed']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failures = []
+    if d['left'] > d['failed']:
+        failures.append(f"{d['left']} digests still queued after {args.timeout}s")
+    if duplicates:
+        failures.append(f"{duplicates} recipients got more than one digest")
+    if d['delivered'] + d['failed'] != args.recipients:
+        failures.append(f"{d['delivered'] + d['failed']} digests for {args.recipients} recipients")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
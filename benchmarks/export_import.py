@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import argparse
+import resource
+import subprocess
+
+from common import REPO_ROOT, parse_scale
+from seed import seed, seed_private_conversation, user_email
+
+# Export/import benchmark
+# Seeds each scale, exports it with `flask export`, imports the dump into an
+# empty data directory with `flask import`, and checks that every shard came
+# back byte for byte. Each command runs in its own process so its peak RSS can
+# be reported; with streaming I/O that should stay flat as the scale grows.
+#
+#   python benchmarks/export_import.py                  # 100k and 1m
+#   python benchmarks/export_import.py --scales 1m --output export.json
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def worker(command, workdir, dump):
+    # Runs inside a fresh process with cwd set to the instance's directory
+    os.chdir(workdir)
+    import app as chat
+    app = chat.create_app()
+    baseline_rss = peak_rss_mb()
+    start = time.perf_counter()
+    result = app.test_cli_runner().invoke(args=[command, '--quiet', dump])
+    elapsed = time.perf_counter() - start
+    assert result.exit_code == 0, result.output
+    json.dump({'seconds': round(elapsed, 2), 'peak_rss_mb': round(peak_rss_mb(), 1),
+               'startup_rss_mb': round(baseline_rss, 1)}, sys.stdout)
+
+
+def run_worker(command, workdir, dump):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', command,
+                             '--workdir', workdir, '--dump', dump],
+                            check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output)
+
+
+def shard_digests(data_dir):
+    digests = {}
+    for folder in ('rooms', 'private_msgs', 'patches'):
+        path = os.path.join(data_dir, folder)
+        for filename in sorted(os.listdir(path)) if os.path.isdir(path) else ():
+            if filename.endswith('.ndjson'):
+                digest = hashlib.sha256()
+                with open(os.path.join(path, filename), 'rb') as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(block)
+                digests[f"{folder}/{filename}"] = digest.hexdigest()
+    return digests
+
+
+def run_scale(scale, workdir):
+    messages = parse_scale(scale)
+    source = os.path.join(workdir, 'source')
+    target = os.path.join(workdir, 'target')
+    dump = os.path.join(workdir, 'dump.ndjson')
+    seed(os.path.join(source, 'data'), messages, rooms=('general', 'dev', 'random'))
+    # One long private conversation next to the short ones from seed()
+    seed_private_conversation(os.path.join(source, 'data'), user_email(1), user_email(2), messages // 10)
+    os.makedirs(target)
+
+    export = run_worker('export', source, dump)
+    dump_mb = os.path.getsize(dump) / 1024 / 1024
+    imported = run_worker('import', target, dump)
+    matches = shard_digests(os.path.join(source, 'data')) == shard_digests(os.path.join(target, 'data'))
+    total = messages + messages // 10
+    for result in (export, imported):
+        result['messages_per_s'] = round(total / result['seconds']) if result['seconds'] else 0
+        result['mb_per_s'] = round(dump_mb / result['seconds'], 1) if result['seconds'] else 0.0
+    return {'messages': total, 'dump_mb': round(dump_mb, 1), 'export': export,
+            'import': imported, 'round_trip_ok': matches}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark streaming export and import')
+    parser.add_argument('--scales', default='100k,1m', help='comma separated, e.g. 100k,1m')
+    parser.add_argument('--output')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--dump', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        sys.path.insert(0, REPO_ROOT)
+        worker(args.worker, args.workdir, args.dump)
+        return
+
+    results = {}
+    for scale in args.scales.split(','):
+        print(f"Running {scale}...", file=sys.stderr)
+        workdir = tempfile.mkdtemp(prefix=f'chat-export-{scale}-')
+        try:
+            results[scale] = run_scale(scale, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for scale, r in results.items():
+        print(f"\n== {scale}: {r['messages']} messages, dump {r['dump_mb']} MB ==")
+        for step in ('export', 'import'):
+            s = r[step]
+            print(f"  {step:<7} {s['seconds']:>7.2f} s  {s['messages_per_s']:>8} msg/s  {s['mb_per_s']:>6.1f} MB/s"
+                  f"  peak RSS {s['peak_rss_mb']:>6.1f} MB (after startup {s['startup_rss_mb']:.1f} MB)")
+        print(f"  round trip {'identical' if r['round_trip_ok'] else 'MISMATCH'}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not all(r['round_trip_ok'] for r in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
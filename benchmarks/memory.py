@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import uuid
+import random
+import argparse
+import mimetypes
+import tracemalloc
+import subprocess
+from datetime import datetime, timedelta
+
+from common import REPO_ROOT, parse_scale
+from seed import WORDS, user_email
+
+# Hot window memory benchmark
+# Builds the same synthetic messages, with every field send_message writes
+# (ts, edited, some attachments), two ways and measures the Python heap they
+# occupy with tracemalloc: as plain dicts (what json.loads gives for a
+# shard line) and as CompactMessage records in per-conversation ring buffers,
+# which is how the app's hot window holds them. Each form is built in its own
+# process so one can't reuse the other's freed memory.
+#
+#   python benchmarks/memory.py                  # 1m messages
+#   python benchmarks/memory.py --messages 100k --users 1000
+
+
+# Share of generated messages that were edited, and that carry attachments
+EDITED_RATE = 0.05
+ATTACHMENT_RATE = 0.05
+ATTACHMENT_NAMES = ('photo.jpg', 'screenshot.png', 'notes.txt', 'report.pdf', 'archive.zip')
+
+
+def generate(messages, users, seed=42):
+    # Shard lines, shaped like the records send_message writes
+    rng = random.Random(seed)
+    start = datetime.now() - timedelta(minutes=messages)
+    for i in range(messages):
+        now = start + timedelta(minutes=i, microseconds=rng.randrange(10 ** 6))
+        message = {
+            'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            'author': user_email(rng.randrange(users)),
+            'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15))),
+            'timestamp': now.isoformat(),
+            'ts': int(now.timestamp()),
+            'edited': rng.random() < EDITED_RATE
+        }
+        if rng.random() < ATTACHMENT_RATE:
+            name = rng.choice(ATTACHMENT_NAMES)
+            message['attachments'] = [{
+                'sha256': '%064x' % rng.getrandbits(256),
+                'name': name,
+                'size': rng.randrange(1024, 10 * 1024 * 1024),
+                'type': mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            }]
+        yield json.dumps(message)
+
+
+def worker(form, messages, users):
+    from collections import deque
+    import app as chat
+
+    lines = list(generate(messages, users))
+    tracemalloc.start()
+    if form == 'dict':
+        held = [json.loads(line) for line in lines]
+    else:
+        # Enough windows to hold every message, filled the way the app does
+        windows = [deque(maxlen=chat.HOT_WINDOW_SIZE) for _ in range(-(-messages // chat.HOT_WINDOW_SIZE))]
+        offset = 0
+        for i, line in enumerate(lines):
+            windows[i // chat.HOT_WINDOW_SIZE].append(chat.CompactMessage(json.loads(line), offset))
+            offset += len(line) + 1
+        held = windows
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    json.dump({'bytes': current, 'bytes_per_message': round(current / messages, 1), 'held': len(held)}, sys.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure memory per cached message')
+    parser.add_argument('--messages', default='1m')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--output')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    messages = parse_scale(args.messages)
+
+    if args.worker:
+        sys.path.insert(0, REPO_ROOT)
+        worker(args.worker, messages, args.users)
+        return
+
+    results = {'messages': messages, 'users': args.users}
+    for form in ('dict', 'compact'):
+        print(f"Measuring {form}...", file=sys.stderr)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', form,
+                                 '--messages', str(messages), '--users', str(args.users)],
+                                check=True, stdout=subprocess.PIPE, text=True).stdout
+        results[form] = json.loads(output)
+
+    for form in ('dict', 'compact'):
+        r = results[form]
+        print(f"  {form:<8} {r['bytes'] / 1024 / 1024:>8.1f} MB  {r['bytes_per_message']:>7.1f} bytes/message")
+    print(f"  compact uses {results['compact']['bytes'] / results['dict']['bytes']:.0%} of the dict form")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
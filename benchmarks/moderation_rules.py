@@ -0,0 +1,214 @@
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import random
+import shutil
+import tempfile
+import argparse
+import threading
+
+from common import parse_scale, percentile
+from seed import seed, user_email, PASSWORD, WORDS
+
+# Moderation benchmark
+# Check cost: per-message time to check text against rule sets of growing
+# size, compiled into one RuleSet, next to looping over one regex per rule.
+# Send path: /send-message p50/p99 with no rules and with --send-rules rules,
+# then again while the rules file is rewritten with a new set of the same
+# size, which the app compiles in the background. Senders must keep going
+# while it compiles and the new rules must be in force afterwards.
+#
+#   python benchmarks/moderation_rules.py
+#   python benchmarks/moderation_rules.py --rules 10,1k,10k,100k --loop-max 1k
+
+
+def make_rules(count, rng):
+    # Made-up words, with one in ten a link domain and one in a hundred a pattern
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    rules = set()
+    while len(rules) < count:
+        word = ''.join(rng.choice(letters) for _ in range(rng.randint(5, 12)))
+        kind = rng.random()
+        if kind < 0.1:
+            rules.add(f"link:{word}.example")
+        elif kind < 0.11:
+            rules.add(rf"re:\b{word[:5]}\d{{3,}}")
+        else:
+            rules.add(word)
+    return sorted(rules)
+
+
+def make_messages(count, rules, rng, blocked_share):
+    # Chat-like text, some with an allowed link, a share with a blocked word
+    words = [rule for rule in rules if not rule.startswith(('link:', 're:'))]
+    messages = []
+    for _ in range(count):
+        text = [rng.choice(WORDS) for _ in range(rng.randint(3, 30))]
+        if rng.random() < 0.2:
+            text.insert(rng.randrange(len(text)), 'https://docs.python.org/3/library/re.html')
+        if words and rng.random() < blocked_share:
+            text.insert(rng.randrange(len(text)), rng.choice(words))
+        messages.append(' '.join(text))
+    return messages
+
+
+def naive(rules):
+    # One compiled regex per rule, tried in turn
+    compiled = []
+    for rule in rules:
+        if rule.startswith('link:'):
+            compiled.append(re.compile(rf"(?<![\w.-])(?:[\w-]+\.)*{re.escape(rule[5:])}(?![\w-]|\.[\w-])", re.I))
+        elif rule.startswith('re:'):
+            compiled.append(re.compile(rule[3:], re.I))
+        else:
+            compiled.append(re.compile(rf"(?<!\w){re.escape(rule)}(?!\w)", re.I))
+    return lambda text: any(pattern.search(text) for pattern in compiled)
+
+
+def us_per_message(check, messages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        blocked = sum(1 for text in messages if check(text))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None or elapsed < best else best
+    return round(best / len(messages) * 1e6, 2), blocked
+
+
+def bench_check(args):
+    import moderation
+
+    rng = random.Random(42)
+    results = []
+    for count in args.rules:
+        rules = make_rules(count, rng)
+        messages = make_messages(args.messages, rules, rng, args.blocked)
+        start = time.perf_counter()
+        rule_set = moderation.RuleSet(rules)
+        row = {'rules': count, 'compile_ms': round((time.perf_counter() - start) * 1000, 1)}
+        row['compiled_us'], blocked = us_per_message(rule_set.check, messages, args.repeat)
+        line = (f"  {count:>7} rules  compile {row['compile_ms']:>8.1f} ms  "
+                f"compiled {row['compiled_us']:>7.2f} us/message")
+        if count <= args.loop_max:
+            row['loop_us'], loop_blocked = us_per_message(naive(rules), messages[:args.loop_messages], 1)
+            line += f"  loop {row['loop_us']:>9.2f} us/message"
+            if loop_blocked != sum(1 for text in messages[:args.loop_messages] if rule_set.check(text)):
+                print(f"FAIL: compiled and looped rules disagree at {count} rules")
+                sys.exit(1)
+        print(f"{line}  blocked {blocked}/{len(messages)}")
+        results.append(row)
+    return results
+
+
+def bench_send(args):
+    rng = random.Random(7)
+    workdir = tempfile.mkdtemp(prefix='chat-moderation-')
+    try:
+        seed(os.path.join(workdir, 'data'), 1000, users=2, private_pairs=0)
+        os.chdir(workdir)
+        import app as chat
+        chat.MODERATION_RELOAD_INTERVAL = 0.05
+        app = chat.create_app()
+        client = app.test_client()
+        client.post('/login', data={'email': user_email(0), 'password': PASSWORD})
+
+        def write_rules(rules):
+            with open(chat.MODERATION_FILE + '.tmp', 'w') as f:
+                json.dump({'rules': {'*': rules}}, f)
+            os.replace(chat.MODERATION_FILE + '.tmp', chat.MODERATION_FILE)
+
+        def send_all(messages):
+            latencies, blocked = [], 0
+            for text in messages:
+                start = time.perf_counter()
+                response = client.post('/send-message', json={'content': text})
+                latencies.append(time.perf_counter() - start)
+                blocked += response.status_code == 400
+            return latencies, blocked
+
+        def phase(latencies, blocked):
+            return {'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+                    'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+                    'max_ms': round(max(latencies) * 1000, 3), 'blocked': blocked}
+
+        rules = make_rules(args.send_rules, rng)
+        messages = make_messages(args.sends, rules, rng, 0)
+        results = {'no_rules': phase(*send_all(messages))}
+
+        write_rules(rules)
+        chat.load_moderation()
+        results['rules'] = phase(*send_all(messages))
+
+        # Reload under load: a new rule set of the same size, one of whose
+        # words the senders use from the start
+        new_rules = make_rules(args.send_rules, random.Random(8))
+        probe = next(rule for rule in new_rules if not rule.startswith(('link:', 're:')))
+        write_rules(new_rules)
+        start = time.perf_counter()
+        latencies, reloaded_at = [], None
+        while time.perf_counter() - start < args.reload_timeout:
+            t = time.perf_counter()
+            response = client.post('/send-message', json={'content': f"{rng.choice(WORDS)} {probe}"})
+            latencies.append(time.perf_counter() - t)
+            if response.status_code == 400:
+                reloaded_at = time.perf_counter() - start
+                break
+        results['reload'] = {**phase(latencies, 0), 'sends_during_reload': len(latencies) - 1,
+                             'reload_s': reloaded_at and round(reloaded_at, 3)}
+        chat.flush_read_state()
+        atexit.unregister(chat.flush_read_state)
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for name in ('no_rules', 'rules'):
+        r = results[name]
+        label = 'no rules' if name == 'no_rules' else f"{args.send_rules} rules"
+        print(f"  send {label:<12} p50 {r['p50_ms']:>7.3f} ms  p99 {r['p99_ms']:>7.3f} ms  blocked {r['blocked']}")
+    r = results['reload']
+    print(f"  reload {args.send_rules} rules took {r['reload_s']} s with {r['sends_during_reload']} sends meanwhile, "
+          f"p50 {r['p50_ms']:.3f} ms  p99 {r['p99_ms']:.3f} ms  max {r['max_ms']:.3f} ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark moderation rules on the send path')
+    parser.add_argument('--rules', type=lambda s: [parse_scale(n) for n in s.split(',')],
+                        default=[10, 100, 1000, 10000], help='comma separated rule counts')
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--blocked', type=float, default=0.05, help='share of messages that break a rule')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--loop-max', type=parse_scale, default=10000, help='largest rule count to time the loop on')
+    parser.add_argument('--loop-messages', type=int, default=200)
+    parser.add_argument('--send-rules', type=parse_scale, default=10000)
+    parser.add_argument('--sends', type=int, default=1000)
+    parser.add_argument('--reload-timeout', type=float, default=30)
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed send p99 increase, 0.5 = 50%%')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    results = {'check': bench_check(args), 'send': bench_send(args)}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    send = results['send']
+    failures = []
+    if send['rules']['p99_ms'] > send['no_rules']['p99_ms'] * (1 + args.tolerance):
+        failures.append(f"send p99 {send['no_rules']['p99_ms']} -> {send['rules']['p99_ms']} ms "
+                        f"with {args.send_rules} rules exceeds {args.tolerance:.0%} tolerance")
+    if send['reload']['reload_s'] is None:
+        failures.append(f"new rules not in force after {args.reload_timeout}s")
+    elif not send['reload']['sends_during_reload']:
+        failures.append('no message was sent while the rules were reloading')
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+from common import parse_scale, summarize, timed
+from seed import record_count, seed, seed_private_conversation, user_email, PASSWORD
+
+# Private chat first-render benchmark
+# Renders /chat/<username> for conversations of increasing length and checks
+# that the render cost stays flat: the slowest p50, and the slowest first
+# render of a fresh process, may each be at most --max-ratio times the
+# fastest. The full-history read the page used to need
+# (get_private_messages) is timed alongside for comparison.
+#
+#   python benchmarks/private_chat.py --lengths 1k,100k,1m
+
+def run_length(length, workdir, requests):
+    # Runs inside the per-length worker process; the parent removes workdir
+    messages = parse_scale(length)
+    seed(os.path.join(workdir, 'data'), 0, users=2, private_pairs=0)
+    count = seed_private_conversation(os.path.join(workdir, 'data'), user_email(0), user_email(1), messages)
+    record_count(os.path.join(workdir, 'data'), f"{user_email(0)}-{user_email(1)}", count)
+    os.chdir(workdir)
+    import app as chat
+    client = chat.app.test_client()
+    client.post('/login', data={'email': user_email(0), 'password': PASSWORD})
+
+    def render():
+        response = client.get('/chat/user1')
+        assert response.status_code == 200, response.status_code
+
+    # The cold render also loads the read state and catches its stored count
+    # of the conversation up to the end of the shard
+    start = time.perf_counter()
+    render()
+    cold_ms = (time.perf_counter() - start) * 1000
+    result = {'messages': messages, 'cold_ms': round(cold_ms, 3), 'render': summarize(*timed(render, requests, 10))}
+    full_read = lambda: chat.get_private_messages(user_email(0), user_email(1))
+    result['full_read'] = summarize(*timed(full_read, max(1, requests // 10), 10))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark private chat first render')
+    parser.add_argument('--lengths', default='1k,100k,1m', help='comma separated conversation lengths')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--max-ratio', type=float, default=2.0)
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        json.dump(run_length(args.worker, args.workdir, args.requests), sys.stdout)
+        return
+
+    results = {}
+    for length in args.lengths.split(','):
+        print(f"Running {length}...", file=sys.stderr)
+        workdir = tempfile.mkdtemp(prefix=f'chat-private-{length}-')
+        try:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--requests', str(args.requests),
+                                     '--worker', length, '--workdir', workdir],
+                                    check=True, stdout=subprocess.PIPE, text=True).stdout
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        results[length] = json.loads(output)
+
+    print(f"{'length':>10} {'render p50':>12} {'render p99':>12} {'cold':>10} {'full read p50':>15}")
+    for length, r in results.items():
+        print(f"{length:>10} {r['render']['p50_ms']:>9.2f} ms {r['render']['p99_ms']:>9.2f} ms"
+              f" {r['cold_ms']:>7.1f} ms {r['full_read']['p50_ms']:>12.1f} ms")
+
+    failed = False
+    for name, values in (('render p50', [r['render']['p50_ms'] for r in results.values()]),
+                         ('cold render', [r['cold_ms'] for r in results.values()])):
+        ratio = max(values) / min(values)
+        if ratio > args.max_ratio:
+            print(f"FAIL: {name} grows {ratio:.2f}x with conversation length (max {args.max_ratio}x)")
+            failed = True
+        else:
+            print(f"OK: {name} varies {ratio:.2f}x across lengths (max {args.max_ratio}x)")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import sys
+import json
+import time
+import argparse
+import statistics
+from datetime import datetime
+
+from common import parse_scale
+from seed import user_email
+from memory import generate
+
+# Render loop micro-benchmark
+# Times turning stored messages into display fields and HTML, per message:
+#   time_parse        what the app used to do for the time: fromisoformat +
+#                     strftime on every message of every render
+#   time_cached       the time and day label from 'ts' through the caches
+#   time_cached_tz    the same, shown in a named timezone
+#   display_legacy    display_message on records without 'ts'
+#   display_ts        display_message on records written with 'ts'
+#   render_page       display_message + render_messages, the whole loop
+#
+#   python benchmarks/render.py --messages 10k --repeat 5
+
+
+def parse_per_render(timestamp):
+    # The old format_time
+    dt = datetime.fromisoformat(timestamp)
+    return dt.strftime("%I:%M %p").lower().replace(" 0", " ")
+
+
+def measure(func, repeat):
+    # Median seconds of `repeat` runs; the first run also fills the caches,
+    # like the first render of a page after startup
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return statistics.median(runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the message render loop')
+    parser.add_argument('--messages', default='10k')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--timezone', default='America/New_York')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    import app as chat
+
+    count = parse_scale(args.messages)
+    legacy = [json.loads(line) for line in generate(count, 100)]
+    with_ts = [{**m, 'ts': int(datetime.fromisoformat(m['timestamp']).timestamp())} for m in legacy]
+    today = chat.local_today(None)
+    today_tz = chat.local_today(args.timezone)
+    own = user_email(0)
+
+    def cached_times(tz, today):
+        for m in with_ts:
+            time_text, day, day_key = chat.local_minute(tz, m['ts'] // 60)
+            chat.day_label(day, today)
+
+    cases = {
+        'time_parse': lambda: [parse_per_render(m['timestamp']) for m in legacy],
+        'time_cached': lambda: cached_times(None, today),
+        'time_cached_tz': lambda: cached_times(args.timezone, today_tz),
+        'display_legacy': lambda: [chat.display_message(m, 'user', m['author'] == own, None, today) for m in legacy],
+        'display_ts': lambda: [chat.display_message(m, 'user', m['author'] == own, None, today) for m in with_ts],
+        'render_page': lambda: chat.render_messages(
+            [chat.display_message(m, 'user', m['author'] == own, None, today) for m in with_ts]),
+    }
+    results = {}
+    for name, func in cases.items():
+        seconds = measure(func, args.repeat)
+        results[name] = {'ms': round(seconds * 1000, 2), 'us_per_message': round(seconds / count * 1e6, 3)}
+        print(f"  {name:<18} {results[name]['ms']:>9.2f} ms  {results[name]['us_per_message']:>7.3f} us/message")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'messages': count, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common import REPO_ROOT, parse_scale, rss_mb, summarize, timed
+from seed import seed, user_email, PASSWORD
+
+# Chat server benchmark
+# Seeds each scale into a scratch data directory, then drives the main routes
+# through Flask's test client and over real HTTP against waitress, recording
+# throughput, p50/p99 latency and RSS. Results are written as JSON and compared
+# against a stored baseline; any regression beyond the tolerance exits 1, as
+# does an endpoint that got fewer than MIN_SAMPLES requests in its time budget.
+#
+#   python benchmarks/run.py                          # 1k and 100k, compare
+#   python benchmarks/run.py --scales 1k,100k,1m
+#   python benchmarks/run.py --save-baseline          # record a new baseline
+#
+# Each scale runs in its own process so RSS and app state don't carry over.
+
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, 'benchmarks', 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(REPO_ROOT, 'benchmarks', 'results.json')
+ENDPOINTS = ('index', 'send_message', 'login', 'settings')
+MIN_SAMPLES = 100  # per endpoint, for p99 to be more than the slowest request or two
+
+
+def make_calls(get, post):
+    # One callable per endpoint. /login posts without a session so that
+    # every attempt actually checks credentials instead of redirecting.
+    return {
+        'index': lambda: get('/'),
+        'send_message': lambda: post('/send-message', json={'content': 'benchmark *message*'}),
+        'login': lambda: post('/login', data={'email': user_email(1), 'password': PASSWORD}, anonymous=True),
+        'settings': lambda: get('/settings'),
+    }
+
+
+def bench_test_client(app, requests, max_seconds):
+    client = app.test_client()
+    anonymous_client = app.test_client(use_cookies=False)
+    client.post('/login', data={'email': user_email(0), 'password': PASSWORD})
+
+    def get(path):
+        response = client.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+
+    def post(path, anonymous=False, **kwargs):
+        response = (anonymous_client if anonymous else client).post(path, **kwargs)
+        assert response.status_code in (200, 302), (path, response.status_code)
+
+    results = {}
+    for name, call in make_calls(get, post).items():
+        call()  # warm up
+        results[name] = summarize(*timed(call, requests, max_seconds))
+    return results
+
+
+def bench_http(app, requests, max_seconds, concurrency):
+    import requests as http
+    from waitress import create_server
+
+    server = create_server(app, host='127.0.0.1', port=0, threads=max(4, concurrency))
+    base = f"http://127.0.0.1:{server.effective_port}"
+    threading.Thread(target=server.run, daemon=True).start()
+    sessions = threading.local()
+
+    def session():
+        if not hasattr(sessions, 'client'):
+            sessions.client = http.Session()
+            sessions.client.post(base + '/login', data={'email': user_email(0), 'password': PASSWORD})
+        return sessions.client
+
+    def get(path):
+        response = session().get(base + path)
+        assert response.status_code == 200, (path, response.status_code)
+
+    def post(path, anonymous=False, **kwargs):
+        if anonymous:
+            response = http.post(base + path, allow_redirects=False, **kwargs)
+        else:
+            response = session().post(base + path, allow_redirects=False, **kwargs)
+        assert response.status_code in (200, 302), (path, response.status_code)
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(concurrency) as pool:
+            for name, call in make_calls(get, post).items():
+                call()
+                per_worker = max(1, requests // concurrency)
+                start = time.perf_counter()
+                runs = list(pool.map(lambda _: timed(call, per_worker, max_seconds), range(concurrency)))
+                elapsed = time.perf_counter() - start
+                results[name] = summarize([l for latencies, _ in runs for l in latencies], elapsed)
+    finally:
+        server.close()
+    return results
+
+
+def run_scale(scale, args):
+    # Runs inside the per-scale worker process; the parent removes workdir
+    messages = parse_scale(scale)
+    start = time.perf_counter()
+    seed(os.path.join(args.workdir, 'data'), messages, users=args.users)
+    seed_seconds = time.perf_counter() - start
+
+    os.chdir(args.workdir)
+    import app as chat
+    app = chat.app
+    result = {'messages': messages, 'users': args.users, 'seed_seconds': round(seed_seconds, 2)}
+    result['test_client'] = bench_test_client(app, args.requests, args.max_seconds)
+    result['test_client']['rss_mb'] = round(rss_mb(), 1)
+    # Store reads per request, from the app's per-endpoint counters
+    result['store_reads'] = {endpoint.split('.')[-1]: round(stats['reads'] / stats['requests'], 2)
+                             for endpoint, stats in chat.store_stats.items() if stats['requests']}
+    if args.http:
+        result['http'] = bench_http(app, args.requests, args.max_seconds, args.concurrency)
+        result['http']['rss_mb'] = round(rss_mb(), 1)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    # Latency and RSS may grow, and throughput may drop, by at most `tolerance`
+    regressions = []
+    for scale, modes in results['scales'].items():
+        for mode, endpoints in modes.items():
+            if mode == 'store_reads' or not isinstance(endpoints, dict):
+                continue
+            before_endpoints = baseline.get('scales', {}).get(scale, {}).get(mode, {})
+            for endpoint, after in endpoints.items():
+                before = before_endpoints.get(endpoint)
+                if before is None:
+                    continue
+                if endpoint == 'rss_mb':
+                    checks = [('rss_mb', before, after, True)]
+                else:
+                    checks = [('p50_ms', before['p50_ms'], after['p50_ms'], True),
+                              ('p99_ms', before['p99_ms'], after['p99_ms'], True),
+                              ('throughput_rps', before['throughput_rps'], after['throughput_rps'], False)]
+                for metric, old, new, lower_is_better in checks:
+                    if not old:
+                        continue
+                    change = (new - old) / old
+                    if (change if lower_is_better else -change) > tolerance:
+                        regressions.append(f"{scale} {mode} {endpoint} {metric}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def too_few_samples(results, minimum):
+    return [f"{scale} {mode} {endpoint}: {stats['requests']} requests"
+            for scale, modes in results['scales'].items()
+            for mode, endpoints in modes.items() if mode in ('test_client', 'http')
+            for endpoint, stats in endpoints.items()
+            if isinstance(stats, dict) and stats['requests'] < minimum]
+
+
+def print_results(results):
+    for scale, modes in results['scales'].items():
+        print(f"\n== {scale} messages ==")
+        if 'store_reads' in modes:
+            print("  store reads per request: " + ', '.join(f"{endpoint} {reads}" for endpoint, reads in modes['store_reads'].items()))
+        for mode in ('test_client', 'http'):
+            if mode not in modes:
+                continue
+            print(f"  {mode} (rss {modes[mode]['rss_mb']} MB)")
+            for endpoint in ENDPOINTS:
+                r = modes[mode][endpoint]
+                print(f"    {endpoint:<14} {r['throughput_rps']:>10.1f} req/s"
+                      f"  p50 {r['p50_ms']:>9.2f} ms  p99 {r['p99_ms']:>9.2f} ms  (n={r['requests']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the chat server')
+    parser.add_argument('--scales', default='1k,100k', help='comma separated, e.g. 1k,100k,1m')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per endpoint')
+    parser.add_argument('--max-seconds', type=float, default=20.0, help='time budget per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4, help='HTTP client threads')
+    parser.add_argument('--no-http', dest='http', action='store_false', help='skip the waitress run')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression, 0.25 = 25%%')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--keep-data', action='store_true')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        json.dump(run_scale(args.worker, args), sys.stdout)
+        return
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+        },
+        'scales': {}
+    }
+    worker_args = [a for a in sys.argv[1:] if a != '--save-baseline']
+    for scale in args.scales.split(','):
+        print(f"Running {scale}...", file=sys.stderr)
+        workdir = tempfile.mkdtemp(prefix=f'chat-bench-{scale}-')
+        try:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), *worker_args,
+                                     '--worker', scale, '--workdir', workdir],
+                                    check=True, stdout=subprocess.PIPE, text=True).stdout
+        finally:
+            if args.keep_data:
+                print(f"Data for {scale} kept in {workdir}", file=sys.stderr)
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+        results['scales'][scale] = json.loads(output)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print_results(results)
+    print(f"\nResults written to {args.output}")
+
+    # A timed-out endpoint's percentiles are noise; neither record nor gate on them
+    minimum = min(MIN_SAMPLES, args.requests)
+    sparse = too_few_samples(results, minimum)
+    if sparse:
+        print(f"\nFewer than {minimum} samples (raise --max-seconds or fix the endpoint):")
+        for line in sparse:
+            print(f"  {line}")
+        sys.exit(1)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\nREGRESSIONS against {args.baseline} (tolerance {args.tolerance:.0%}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+    else:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one")
+
+
+if __name__ == '__main__':
+    main()
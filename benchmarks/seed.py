@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import uuid
+import random
+import argparse
+from datetime import datetime, timedelta
+
+from common import parse_scale
+
+# Seeds synthetic users and message history straight into a data directory in
+# the app's on-disk format. Every seeded user has the password 'bench'.
+#
+#   python benchmarks/seed.py 100k --data-dir data
+
+PASSWORD = 'bench'
+EPOCH = datetime(2025, 1, 1)  # seeded history ends here, so every run writes the same data
+WORDS = ('hello', 'there', 'how', 'is', 'everyone', 'doing', 'today', 'the',
+         'build', 'passed', 'lunch', 'meeting', 'moved', 'to', 'three', 'ok')
+
+
+def user_email(i):
+    return f"user{i}@bench.local"
+
+
+def seed(data_dir, messages, users=100, rooms=('general',), private_pairs=10, seed=42):
+    rng = random.Random(seed)
+    os.makedirs(f'{data_dir}/rooms', exist_ok=True)
+    os.makedirs(f'{data_dir}/private_msgs', exist_ok=True)
+
+    with open(f'{data_dir}/users.json', 'w') as f:
+        json.dump({'users': [{
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'username': f"user{i}",
+            'email': user_email(i),
+            'password': PASSWORD,
+            'profile': {'avatar': None, 'joined_at': EPOCH.isoformat()},
+            'settings': {'dark_mode': False}
+        } for i in range(users)]}, f, indent=2)
+
+    with open(f'{data_dir}/rooms.json', 'w') as f:
+        json.dump({'rooms': [{
+            'name': name,
+            'created_by': None,
+            'created_at': EPOCH.isoformat(),
+            'members': [] if name == 'general' else [user_email(i) for i in range(users)]
+        } for name in rooms]}, f, indent=2)
+
+    # Messages are spread over the rooms, oldest first, one minute apart
+    start = EPOCH - timedelta(minutes=messages)
+    shards = {name: open(f'{data_dir}/rooms/{name}.ndjson', 'w') for name in rooms}
+    try:
+        for i in range(messages):
+            room = rooms[i % len(rooms)]
+            shards[room].write(json.dumps({
+                'id': str(uuid.UUID(int=rng.getrandbits(128))),
+                'author': user_email(rng.randrange(users)),
+                'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15))),
+                'timestamp': (start + timedelta(minutes=i)).isoformat(),
+                'edited': False
+            }) + '\n')
+        # The message counts a running server would have stored with its
+        # read state, so the first request doesn't count every shard
+        counts = {name: [len(range(i, messages, len(rooms))), shards[name].tell()] for i, name in enumerate(rooms)}
+    finally:
+        for shard in shards.values():
+            shard.close()
+
+    # A few short private conversations so the sidebar has unread state
+    conversations = {}
+    for i in range(min(private_pairs, users - 1)):
+        conversation = '-'.join(sorted([user_email(0), user_email(i + 1)]))
+        counts[conversation] = seed_private_conversation(data_dir, user_email(0), user_email(i + 1), 10, rng)
+        for email in (user_email(0), user_email(i + 1)):
+            conversations.setdefault(email, []).append(conversation)
+    with open(f'{data_dir}/read_state.json', 'w') as f:
+        json.dump({'cursors': {}, 'conversations': conversations, 'counts': counts}, f)
+
+
+def record_count(data_dir, conversation, count):
+    # Adds a conversation seeded after seed() to the stored message counts
+    with open(f'{data_dir}/read_state.json', 'r') as f:
+        read_state = json.load(f)
+    read_state.setdefault('counts', {})[conversation] = count
+    with open(f'{data_dir}/read_state.json', 'w') as f:
+        json.dump(read_state, f)
+
+
+def seed_private_conversation(data_dir, email_a, email_b, messages, rng=None):
+    # Writes a private conversation shard and returns its [count, size]; the
+    # caller registers membership and the count
+    rng = rng or random.Random(42)
+    participants = sorted([email_a, email_b])
+    start = EPOCH - timedelta(minutes=messages)
+    os.makedirs(f'{data_dir}/private_msgs', exist_ok=True)
+    with open(f"{data_dir}/private_msgs/{participants[0]}-{participants[1]}.ndjson", 'w') as f:
+        for j in range(messages):
+            f.write(json.dumps({
+                'id': str(uuid.UUID(int=rng.getrandbits(128))),
+                'author': participants[j % 2],
+                'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15))),
+                'timestamp': (start + timedelta(minutes=j)).isoformat(),
+                'edited': False
+            }) + '\n')
+        return [messages, f.tell()]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Seed synthetic chat data')
+    parser.add_argument('scale', help='number of messages: 1k, 100k, 1m or an integer')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--users', type=int, default=100)
+    args = parser.parse_args()
+    if os.path.exists(f'{args.data_dir}/users.json'):
+        sys.exit(f"{args.data_dir} already has data; seed into an empty directory")
+    seed(args.data_dir, parse_scale(args.scale), users=args.users)
+    print(f"Seeded {args.scale} messages and {args.users} users into {args.data_dir}/")
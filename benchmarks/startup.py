@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import statistics
+import subprocess
+
+from common import REPO_ROOT
+from seed import seed, user_email, PASSWORD
+
+# Startup benchmark
+# Starts fresh processes against a seeded data directory and records how long
+# `import app` takes, how long create_app() takes, and the time to the first
+# response, both inside the process and wall clock from spawn. Runs with and
+# without cache pre-warming. Results are compared against a stored baseline
+# like benchmarks/run.py does.
+#
+#   python benchmarks/startup.py --runs 10 --messages 100000
+
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, 'benchmarks', 'startup_baseline.json')
+METRICS = ('import_ms', 'create_app_ms', 'first_request_ms', 'wall_ms')
+
+
+def worker(prewarm):
+    # Runs inside a fresh process with cwd set to the seeded directory
+    start = time.perf_counter()
+    import app as chat
+    imported = time.perf_counter()
+    app = chat.create_app({'PREWARM_CACHES': prewarm})
+    created = time.perf_counter()
+    client = app.test_client()
+    client.post('/login', data={'email': user_email(0), 'password': PASSWORD})
+    response = client.get('/')
+    assert response.status_code == 200, response.status_code
+    done = time.perf_counter()
+    json.dump({
+        'import_ms': (imported - start) * 1000,
+        'create_app_ms': (created - imported) * 1000,
+        'first_request_ms': (done - created) * 1000,
+        'pil_loaded': 'PIL' in sys.modules,
+    }, sys.stdout)
+
+
+def measure(workdir, prewarm, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', str(int(prewarm))],
+                                cwd=workdir, check=True, stdout=subprocess.PIPE, text=True).stdout
+        sample = json.loads(output)
+        sample['wall_ms'] = (time.perf_counter() - start) * 1000
+        samples.append(sample)
+    result = {metric: round(statistics.median(s[metric] for s in samples), 2) for metric in METRICS}
+    result['pil_loaded'] = any(s['pil_loaded'] for s in samples)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark app startup')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=10_000)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        sys.path.insert(0, REPO_ROOT)
+        worker(args.worker == '1')
+        return
+
+    workdir = tempfile.mkdtemp(prefix='chat-startup-')
+    try:
+        seed(os.path.join(workdir, 'data'), args.messages)
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        results = {
+            'interpreter_ms': round((time.perf_counter() - start) * 1000, 2),
+            'cold': measure(workdir, False, args.runs),
+            'prewarmed': measure(workdir, True, args.runs),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"interpreter start {results['interpreter_ms']:.1f} ms (median of {args.runs} runs below)")
+    for mode in ('cold', 'prewarmed'):
+        r = results[mode]
+        print(f"  {mode:<10} import {r['import_ms']:>7.1f} ms  create_app {r['create_app_ms']:>7.1f} ms"
+              f"  first request {r['first_request_ms']:>7.1f} ms  wall {r['wall_ms']:>7.1f} ms"
+              f"  PIL loaded: {r['pil_loaded']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = [f"{mode} {metric}: {baseline[mode][metric]} -> {results[mode][metric]}"
+                       for mode in ('cold', 'prewarmed') for metric in METRICS
+                       if results[mode][metric] > baseline[mode][metric] * (1 + args.tolerance)]
+        if regressions:
+            print(f"REGRESSIONS against {args.baseline} (tolerance {args.tolerance:.0%}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import atexit
+import time
+import queue
+import shutil
+import tempfile
+import argparse
+import threading
+
+from common import percentile
+from seed import seed, user_email, PASSWORD
+
+# Typing indicator load test
+# Measures message delivery latency (send request start to the event reaching
+# a stream subscriber of the room) with no other traffic, then again while
+# many users type in the same room. Typists press a key every --keystroke-ms
+# and post /typing the way the browser does: at most once per TYPING_THROTTLE
+# while typing, and "stopped" after TYPING_IDLE without keys. The run fails
+# if typing makes message p50 or p99 worse than the tolerance allows or if
+# any message is lost.
+#
+#   python benchmarks/typing_load.py
+#   python benchmarks/typing_load.py --every-keystroke --typists 40   # misbehaving clients
+
+
+def login(app, i):
+    client = app.test_client()
+    client.post('/login', data={'email': user_email(i), 'password': PASSWORD})
+    return client
+
+
+def run_phase(chat, app, args, typists):
+    subscriber = chat.subscribe(chat.DEFAULT_ROOM)
+    sent_at = {}
+    latencies = []
+    typing_seen = [0]
+    done = threading.Event()
+
+    def listen():
+        while not done.is_set() or not subscriber.empty():
+            try:
+                event = subscriber.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if event['type'] == 'message' and event['message']['content'] in sent_at:
+                latencies.append(time.perf_counter() - sent_at[event['message']['content']])
+            elif event['type'] == 'typing':
+                typing_seen[0] += 1
+
+    def send(i):
+        client = login(app, i)
+        for n in range(args.messages):
+            content = f"probe-{i}-{n}"
+            sent_at[content] = time.perf_counter()
+            response = client.post('/send-message', json={'content': content})
+            assert response.status_code == 200, response.status_code
+            time.sleep(args.send_interval_ms / 1000)
+
+    typing_posts = [0]
+    stop_typing = threading.Event()
+
+    def post_typing(client, typing):
+        client.post('/typing', json={'room': chat.DEFAULT_ROOM, 'typing': typing})
+        typing_posts[0] += 1
+
+    def type_keys(i):
+        # Bursts of keystrokes separated by pauses longer than TYPING_IDLE
+        client = login(app, i)
+        sent_at = 0
+        while not stop_typing.is_set():
+            for _ in range(args.burst):
+                now = time.monotonic()
+                if args.every_keystroke or now - sent_at > chat.TYPING_THROTTLE:
+                    post_typing(client, True)
+                    sent_at = now
+                time.sleep(args.keystroke_ms / 1000)
+            if stop_typing.wait(chat.TYPING_IDLE):
+                break
+            post_typing(client, False)
+            sent_at = 0
+
+    listener = threading.Thread(target=listen)
+    listener.start()
+    typing_threads = [threading.Thread(target=type_keys, args=(args.senders + i,)) for i in range(typists)]
+    for thread in typing_threads:
+        thread.start()
+    start = time.perf_counter()
+    senders = [threading.Thread(target=send, args=(i,)) for i in range(args.senders)]
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop_typing.set()
+    for thread in typing_threads:
+        thread.join()
+    time.sleep(0.2)
+    done.set()
+    listener.join()
+    chat.unsubscribe(chat.DEFAULT_ROOM, subscriber)
+
+    return {
+        'messages_sent': len(sent_at),
+        'messages_delivered': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'typing_posts_per_s': round(typing_posts[0] / elapsed, 1),
+        'typing_events_delivered': typing_seen[0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test typing indicators against message delivery')
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=200, help='per sender')
+    parser.add_argument('--send-interval-ms', type=float, default=5)
+    parser.add_argument('--typists', type=int, default=200)
+    parser.add_argument('--keystroke-ms', type=float, default=100)
+    parser.add_argument('--burst', type=int, default=30, help='keystrokes between pauses')
+    parser.add_argument('--every-keystroke', action='store_true', help='post on every key, no client throttle')
+    parser.add_argument('--throttle', type=float, help='override TYPING_THROTTLE (seconds)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p50 and p99 increase, 0.25 = 25%%')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='chat-typing-')
+    try:
+        seed(os.path.join(workdir, 'data'), 1000, users=args.senders + args.typists)
+        os.chdir(workdir)
+        import app as chat
+        if args.throttle is not None:
+            chat.TYPING_THROTTLE = args.throttle
+        app = chat.create_app()
+        results = {
+            'quiet': run_phase(chat, app, args, 0),
+            'typing': run_phase(chat, app, args, args.typists),
+        }
+        # Flush now, while data/ still exists
+        chat.flush_read_state()
+        atexit.unregister(chat.flush_read_state)
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for phase, r in results.items():
+        print(f"  {phase:<7} delivered {r['messages_delivered']}/{r['messages_sent']}"
+              f"  p50 {r['p50_ms']:>7.2f} ms  p99 {r['p99_ms']:>7.2f} ms"
+              f"  typing posts {r['typing_posts_per_s']:>7.1f}/s  typing events {r['typing_events_delivered']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    quiet, busy = results['quiet'], results['typing']
+    failures = []
+    if busy['messages_delivered'] < busy['messages_sent']:
+        failures.append(f"{busy['messages_sent'] - busy['messages_delivered']} messages lost under typing load")
+    for metric in ('p50_ms', 'p99_ms'):
+        if busy[metric] > quiet[metric] * (1 + args.tolerance):
+            failures.append(f"{metric[:3]} {quiet[metric]} -> {busy[metric]} ms exceeds {args.tolerance:.0%} tolerance")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("Message delivery unaffected by typing load")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+import os
+import sys
+import json
+import time
+import select
+import signal
+import socket
+import shutil
+import tempfile
+import argparse
+import threading
+import subprocess
+
+from msgbus import Broker
+
+# Process manager
+# Runs the app as waitress worker processes that all accept connections from
+# one listening socket opened here, so workers can be replaced while the port
+# stays open the whole time.
+#
+#   SIGTERM, SIGINT  drain every worker, then exit
+#   SIGHUP           re-read the config file and replace the workers one at a
+#                    time: each new worker must report ready before an old
+#                    one is drained
+#
+# A worker told to stop stops accepting, lets requests in progress finish,
+# ends its event streams (browsers reconnect to another worker and are sent
+# the messages they missed), closes idle keep-alive connections, flushes read
+# state and the digest queue, and exits. Workers share realtime events through
+# a broker; unless the config names one, a broker runs inside this process.
+#
+#   python lifecycle.py serve --bind 0.0.0.0:5000 --workers 2 --config chat.json
+#   python lifecycle.py check      # rolling restarts under load
+
+READY_TIMEOUT = 30.0  # seconds a new worker has to start serving
+STOP_TIMEOUT = 45.0  # seconds a worker has to drain and exit before it is killed
+LOOP_TIMEOUT = 0.2  # seconds between a worker's checks for a stop request
+RESPAWN_DELAY = 1.0  # seconds before retrying a failed worker start, doubled up to RESPAWN_DELAY_MAX
+RESPAWN_DELAY_MAX = 60.0
+IDLE_GRACE = 1.0  # seconds an idle keep-alive connection stays open once draining
+
+
+def parse_bind(bind):
+    host, _, port = bind.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+def read_config(path):
+    # Checked here before any worker is started with it
+    if not path:
+        return {}
+    with open(path, 'r') as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"{path}: expected a JSON object")
+    return config
+
+
+class Master:
+    def __init__(self, args):
+        self.args = args
+        self.config_path = os.path.abspath(args.config) if args.config else None
+        self.config = read_config(self.config_path)
+        self.workers = []
+        self.reload_requested = False
+        self.stop_requested = False
+        self.wake = threading.Event()
+        self.respawn_at = 0.0
+        self.respawn_delay = RESPAWN_DELAY
+        self.broker = None
+        self.broker_dir = None
+
+        host, port = parse_bind(args.bind)
+        self.sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(args.backlog)
+
+    def bus_url(self):
+        url = self.config.get('MESSAGE_BUS_URL') or os.environ.get('CHAT_BUS_URL', 'memory://')
+        if not url.startswith('memory:'):
+            return url
+        if self.broker is None:
+            self.broker_dir = tempfile.mkdtemp(prefix='chat-bus-')
+            self.broker = Broker(f"unix://{self.broker_dir}/bus.sock")
+            threading.Thread(target=self.broker.serve_forever, daemon=True).start()
+            while not os.path.exists(f"{self.broker_dir}/bus.sock"):
+                time.sleep(0.01)
+        return self.broker.url
+
+    def spawn(self):
+        env = dict(os.environ, CHAT_BUS_URL=self.bus_url())
+        if self.config_path:
+            env['CHAT_CONFIG'] = self.config_path
+        fd = self.sock.fileno()
+        worker = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', '--fd', str(fd),
+                                   '--threads', str(self.args.threads)],
+                                  pass_fds=(fd,), stdout=subprocess.PIPE, text=True, env=env)
+        ready, _, _ = select.select([worker.stdout], [], [], READY_TIMEOUT)
+        if not ready or worker.stdout.readline().strip() != 'ready':
+            worker.kill()
+            worker.wait()
+            raise RuntimeError(f"worker {worker.pid} did not start")
+        return worker
+
+    def stop_workers(self, workers):
+        for worker in workers:
+            worker.send_signal(signal.SIGTERM)
+        for worker in workers:
+            try:
+                worker.wait(STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+                worker.wait()
+
+    def rolling_restart(self):
+        try:
+            self.config = read_config(self.config_path)
+        except (OSError, ValueError) as e:
+            print(f"Config not reloaded, keeping the running workers: {e}", file=sys.stderr, flush=True)
+            return
+        for old in list(self.workers):
+            try:
+                new = self.spawn()
+            except RuntimeError as e:
+                print(f"Restart stopped: {e}", file=sys.stderr, flush=True)
+                return
+            self.workers.append(new)
+            self.workers.remove(old)
+            self.stop_workers([old])
+        print('reloaded', flush=True)
+
+    def replace_workers(self):
+        # Starts workers until there are enough again. A start that fails is
+        # retried with backoff while the remaining workers keep serving.
+        while len(self.workers) < self.args.workers and time.monotonic() >= self.respawn_at:
+            try:
+                self.workers.append(self.spawn())
+                self.respawn_delay = RESPAWN_DELAY
+            except (RuntimeError, OSError) as e:
+                print(f"Could not replace a worker, retrying in {self.respawn_delay:g}s: {e}",
+                      file=sys.stderr, flush=True)
+                self.respawn_at = time.monotonic() + self.respawn_delay
+                self.respawn_delay = min(self.respawn_delay * 2, RESPAWN_DELAY_MAX)
+
+    def request(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reload_requested = True
+        else:
+            self.stop_requested = True
+        self.wake.set()
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self.request)
+        host, port = self.sock.getsockname()[:2]
+        try:
+            self.workers = [self.spawn() for _ in range(self.args.workers)]
+            print(f"listening on {host}:{port}", flush=True)
+            while not self.stop_requested:
+                self.wake.wait(1.0)
+                self.wake.clear()
+                if self.reload_requested and not self.stop_requested:
+                    self.reload_requested = False
+                    self.rolling_restart()
+                for worker in list(self.workers):
+                    if worker.poll() is not None and not self.stop_requested:
+                        print(f"worker {worker.pid} exited with {worker.returncode}, replacing it",
+                              file=sys.stderr, flush=True)
+                        self.workers.remove(worker)
+                if not self.stop_requested:
+                    self.replace_workers()
+        finally:
+            self.stop_workers(self.workers)
+            self.sock.close()
+            if self.broker is not None:
+                self.broker.stop()
+                shutil.rmtree(self.broker_dir, ignore_errors=True)
+
+
+def run_worker(fd, threads):
+    from waitress import create_server, wasyncore
+    from waitress.channel import HTTPChannel
+    from waitress.task import WSGITask
+    import app as chat
+
+    class DrainingTask(WSGITask):
+        def build_response_header(self):
+            # Once draining, every response closes its connection (and says
+            # so), so the client's next request goes to another worker
+            if chat.shutting_down.is_set():
+                self.set_close_on_finish()
+            return super().build_response_header()
+
+    class DrainingChannel(HTTPChannel):
+        task_class = DrainingTask
+
+    # SIGINT goes to the whole process group on Ctrl-C; the master decides
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+
+    application = chat.create_app({'DIGEST_DISPATCHER': True})
+    socket_map = {}
+    server = create_server(application, map=socket_map, sockets=[socket.socket(fileno=fd)], threads=threads)
+    server.channel_class = DrainingChannel
+
+    def open_connections():
+        return [c for c in list(socket_map.values()) if isinstance(c, HTTPChannel)]
+
+    def close_idle_connections():
+        # A keep-alive connection that was idle when draining began may be
+        # about to carry the client's next request, so it is left open for
+        # IDLE_GRACE: a request on it is served and then the connection closed.
+        # Closing one the client is writing to at that moment would fail a
+        # request that can't safely be retried.
+        cutoff = time.time() - IDLE_GRACE
+        for channel in open_connections():
+            with channel.requests_lock:
+                if not channel.requests and channel.request is None and channel.last_activity < cutoff:
+                    channel.will_close = True
+
+    print('ready', flush=True)
+    deadline = None
+    # The loop runs here rather than in server.run() so that the listening
+    # socket and the connections are only ever touched from this thread
+    while True:
+        wasyncore.loop(timeout=LOOP_TIMEOUT, map=socket_map, use_poll=True, count=1)
+        if stop_requested.is_set() and deadline is None:
+            deadline = time.monotonic() + chat.DRAIN_TIMEOUT
+            # The other workers keep accepting from the shared socket
+            server.del_channel()
+            server.socket.close()
+            chat.start_draining()
+        if deadline is not None:
+            close_idle_connections()
+            if not open_connections() and chat.active_requests == 0:
+                break
+            if time.monotonic() > deadline:
+                print(f"worker {os.getpid()}: {len(open_connections())} connections still open "
+                      f"after {chat.DRAIN_TIMEOUT}s", file=sys.stderr, flush=True)
+                break
+    server.task_dispatcher.shutdown()
+    wasyncore.close_all(socket_map)
+    chat.flush_pending_writes()
+
+
+# Restart check: a server with two workers is restarted twice while clients
+# send messages and follow the room's stream, then stopped. No send may fail,
+# every stream must end up with every message, sessions must survive, and
+# the read state written on the final stop must include the last sends.
+# Requests naming a private conversation with someone who isn't another user
+# must be refused before any of that.
+CHECK_SENDERS = 4
+CHECK_READERS = 2
+CHECK_RESTARTS = 2
+# Recipients every route naming a private conversation must refuse with a 404
+CHECK_BAD_RECIPIENTS = (5, ['x'], '../../etc/evil', 'nobody@example.com', 'user0@example.com')
+CHECK_RECIPIENT_ROUTES = {
+    '/mark-read': {},
+    '/edit-message': {'id': 'x', 'content': 'x'},
+    '/delete-message': {'id': 'x'},
+    '/typing': {'typing': True},
+}
+
+
+def check_reader(base, cookies, received, connected, stop):
+    import requests
+
+    last_id = None
+    while not stop.is_set():
+        headers = {'Last-Event-ID': last_id} if last_id else {}
+        try:
+            with requests.get(f"{base}/stream/general", cookies=cookies, headers=headers,
+                              stream=True, timeout=(5, 20)) as response:
+                connected.set()  # subscribed before the headers went out
+                retry = 1.0
+                event_id = None
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith('retry: '):
+                        retry = int(line[7:]) / 1000
+                    elif line.startswith('id: '):
+                        event_id = line[4:]
+                    elif line.startswith('data: '):
+                        event = json.loads(line[6:])
+                        if event['type'] == 'message':
+                            received.append(event['message']['id'])
+                            last_id = event_id
+                    if stop.is_set():
+                        return
+        except requests.RequestException:
+            retry = 1.0
+        time.sleep(retry)
+
+
+def run_check():
+    import requests
+
+    workdir = tempfile.mkdtemp(prefix='chat-restart-')
+    master = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', '--bind', '127.0.0.1:0',
+                               '--workers', '2'], cwd=workdir, stdout=subprocess.PIPE, text=True)
+    failures = []
+    try:
+        base = 'http://' + master.stdout.readline().split()[-1]
+        sessions = []
+        for i in range(CHECK_SENDERS + CHECK_READERS):
+            session = requests.Session()
+            response = session.post(f"{base}/register", data={'username': f"user{i}", 'email': f"user{i}@example.com",
+                                                              'password': 'password'})
+            assert response.ok, response.status_code
+            sessions.append(session)
+        for path, body in CHECK_RECIPIENT_ROUTES.items():
+            for recipient in CHECK_BAD_RECIPIENTS:
+                response = sessions[0].post(f"{base}{path}", json={**body, 'recipient': recipient})
+                if response.status_code != 404:
+                    failures.append(f"{path} with recipient {recipient!r}: HTTP {response.status_code}")
+
+        stop_sending = threading.Event()
+        stop_reading = threading.Event()
+        sent, errors = [], []
+        received = [[] for _ in range(CHECK_READERS)]
+        connected = [threading.Event() for _ in range(CHECK_READERS)]
+
+        def send(session, name):
+            n = 0
+            while not stop_sending.is_set():
+                try:
+                    response = session.post(f"{base}/send-message", json={'content': f"{name} {n}"}, timeout=30)
+                    if response.status_code == 200:
+                        sent.append(response.json()['message']['id'])
+                    else:
+                        errors.append(f"{name}: HTTP {response.status_code}")
+                except requests.RequestException as e:
+                    errors.append(f"{name}: {e}")
+                n += 1
+                time.sleep(0.01)
+
+        readers = [threading.Thread(target=check_reader, args=(base, sessions[CHECK_SENDERS + i].cookies,
+                                                               received[i], connected[i], stop_reading))
+                   for i in range(CHECK_READERS)]
+        senders = [threading.Thread(target=send, args=(sessions[i], f"user{i}")) for i in range(CHECK_SENDERS)]
+        for thread in readers:
+            thread.start()
+        for event in connected:
+            event.wait(10)
+        for thread in senders:
+            thread.start()
+        time.sleep(1.0)
+        for _ in range(CHECK_RESTARTS):
+            master.send_signal(signal.SIGHUP)
+            if master.stdout.readline().strip() != 'reloaded':
+                failures.append('rolling restart did not finish')
+            time.sleep(1.0)
+        stop_sending.set()
+        for thread in senders:
+            thread.join()
+        time.sleep(2.0)
+        stop_reading.set()
+        for thread in readers:
+            thread.join()
+
+        master.send_signal(signal.SIGTERM)
+        if master.wait(STOP_TIMEOUT + 10) != 0:
+            failures.append(f"server exited with {master.returncode}")
+
+        failures.extend(errors[:10])
+        for i, ids in enumerate(received):
+            missing = set(sent) - set(ids)
+            if missing:
+                failures.append(f"stream {i} missed {len(missing)} of {len(sent)} messages")
+        with open(f"{workdir}/data/rooms/general.ndjson", 'r') as f:
+            stored = {json.loads(line)['id'] for line in f}
+        if set(sent) - stored:
+            failures.append(f"{len(set(sent) - stored)} acknowledged messages not stored")
+        # Every send marks the room read, so the last one leaves a cursor at the end
+        with open(f"{workdir}/data/read_state.json", 'r') as f:
+            read_state = json.load(f)
+        cursors = read_state['cursors']
+        if set(read_state['counts']) != {'general'}:
+            failures.append(f"read state counts unknown conversations: {sorted(set(read_state['counts']) - {'general'})}")
+        if max(cursors.get(f"user{i}@example.com", {}).get('general', 0) for i in range(CHECK_SENDERS)) != len(stored):
+            failures.append('read state of the last sends was not flushed')
+        print(f"{len(sent)} messages sent across {CHECK_RESTARTS} rolling restarts and a shutdown, "
+              f"{len(errors)} errors, streams got {[len(set(ids)) for ids in received]}")
+    finally:
+        if master.poll() is None:
+            master.kill()
+            master.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the chat app under a process manager')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve')
+    serve.add_argument('--bind', default='0.0.0.0:5000')
+    serve.add_argument('--workers', type=int, default=2)
+    serve.add_argument('--threads', type=int, default=8, help='per worker')
+    serve.add_argument('--backlog', type=int, default=1024)
+    serve.add_argument('--config', default=os.environ.get('CHAT_CONFIG'), help='JSON file of app config')
+    worker = commands.add_parser('worker')
+    worker.add_argument('--fd', type=int, required=True)
+    worker.add_argument('--threads', type=int, default=8)
+    commands.add_parser('check')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        Master(args).run()
+    elif args.command == 'worker':
+        run_worker(args.fd, args.threads)
+    else:
+        run_check()
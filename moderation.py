@@ -0,0 +1,176 @@
+import re
+import sys
+import json
+import argparse
+
+# Moderation rules
+# A rule set is a list of rules, each one of:
+#
+#   "word" or "some phrase"   banned as a whole word, case-insensitively; the
+#                             words of a phrase may be split by any whitespace
+#   "link:example.com"        links to the domain or any subdomain of it,
+#                             with or without a scheme
+#   "re:pattern"              a regular expression, searched case-insensitively
+#
+# A rule is at most MAX_RULE_LENGTH characters long.
+#
+# RuleSet compiles the whole list into one regex. Words and domains are laid
+# out as tries, so at each position of a message the regex follows at most
+# one branch per character instead of trying every rule, and checking a
+# message costs about the same with ten rules or ten thousand. Patterns are
+# appended as alternatives; they must not use numbered backreferences, since
+# group numbers change once they are combined.
+#
+# A RuleSet is never changed after it is built, so a new one can be compiled
+# while other threads keep checking messages against the old one.
+#
+#   python moderation.py check data/moderation.json "some text" --room dev
+
+LINK_PREFIX = 'link:'
+MAX_RULE_LENGTH = 256  # the trie pattern recurses once per character of a word
+PATTERN_PREFIX = 're:'
+KINDS = {
+    'word': 'Message contains a blocked word',
+    'link': 'Message links to a blocked site',
+    'pattern': 'Message matches a blocked pattern',
+}
+
+
+class RuleError(ValueError):
+    pass
+
+
+def trie_pattern(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+    return node_pattern(trie)
+
+
+def escape(ch):
+    return r'\s+' if ch == ' ' else re.escape(ch)
+
+
+def is_atom(pattern):
+    # Whether `?` can follow the pattern without a group around it
+    return len(pattern) == 1 or (len(pattern) == 2 and pattern[0] == '\\') or \
+        (pattern.startswith('[') and pattern.endswith(']'))
+
+
+def node_pattern(node):
+    # Recursion depth is the length of the longest word. Characters that end
+    # a word and lead nowhere else are collected into one character class.
+    leaves = sorted(ch for ch, child in node.items() if ch and list(child) == [''])
+    branches = [escape(ch) + node_pattern(child) for ch, child in sorted(node.items())
+                if ch and list(child) != ['']]
+    if len(leaves) == 1:
+        branches.append(re.escape(leaves[0]))
+    elif leaves:
+        branches.append('[' + ''.join(re.escape(ch) for ch in leaves) + ']')
+    if not branches:
+        return ''
+    if len(branches) > 1 or ('' in node and not is_atom(branches[0])):
+        pattern = '(?:' + '|'.join(branches) + ')'
+    else:
+        pattern = branches[0]
+    return pattern + '?' if '' in node else pattern
+
+
+class RuleSet:
+    def __init__(self, rules):
+        self.rules = list(rules)
+        words, domains, patterns = set(), set(), []
+        for rule in self.rules:
+            if not isinstance(rule, str) or not rule.strip():
+                raise RuleError(f"Not a rule: {rule!r}")
+            if len(rule) > MAX_RULE_LENGTH:
+                raise RuleError(f"Rule longer than {MAX_RULE_LENGTH} characters: {rule[:40]!r}...")
+            if rule.startswith(LINK_PREFIX):
+                domain = rule[len(LINK_PREFIX):].strip().lower().strip('.')
+                if not domain or not re.fullmatch(r'[\w.-]+', domain):
+                    raise RuleError(f"Bad domain in {rule!r}")
+                domains.add(domain)
+            elif rule.startswith(PATTERN_PREFIX):
+                pattern = rule[len(PATTERN_PREFIX):]
+                try:
+                    compiled = re.compile(pattern)
+                except re.error as e:
+                    raise RuleError(f"Bad pattern {pattern!r}: {e}") from None
+                if compiled.fullmatch(''):
+                    raise RuleError(f"Pattern {pattern!r} matches empty text")
+                patterns.append(pattern)
+            else:
+                words.add(' '.join(rule.lower().split()))
+        self.counts = {'word': len(words), 'link': len(domains), 'pattern': len(patterns)}
+
+        alternatives = []
+        if words:
+            alternatives.append(rf"(?P<word>(?<!\w){trie_pattern(words)}(?!\w))")
+        if domains:
+            # A host ending in the domain: not preceded by more host
+            # characters unless they end in a dot, not followed by more
+            alternatives.append(rf"(?P<link>(?<![\w.-])(?:[\w-]+\.)*{trie_pattern(domains)}(?![\w-]|\.[\w-]))")
+        if patterns:
+            alternatives.append('(?P<pattern>' + '|'.join(f"(?:{p})" for p in patterns) + ')')
+        try:
+            self.regex = re.compile('|'.join(alternatives), re.IGNORECASE) if alternatives else None
+        except re.error as e:
+            raise RuleError(f"Rules do not combine: {e}") from None
+
+    def __len__(self):
+        return len(self.rules)
+
+    def check(self, text):
+        # (kind, matched text) for the first rule the text breaks, or None
+        if self.regex is None or not text:
+            return None
+        match = self.regex.search(text)
+        if match is None:
+            return None
+        return match.lastgroup, match.group()
+
+
+EMPTY = RuleSet([])
+
+
+def load_rule_sets(path):
+    # {"rules": {"*": [...], "<room>": [...]}} -> {name: RuleSet}. Rules
+    # under "*" apply everywhere; a room's own rules are added to them and
+    # compiled together, so a room is still checked with one search.
+    with open(path, 'r') as f:
+        try:
+            lists = json.load(f)['rules']
+        except (ValueError, KeyError, TypeError) as e:
+            raise RuleError(f"{path}: expected {{\"rules\": {{...}}}}: {e}") from None
+    if not isinstance(lists, dict) or not all(isinstance(rules, list) for rules in lists.values()):
+        raise RuleError(f"{path}: \"rules\" must map rooms to lists of rules")
+    everywhere = lists.get('*', [])
+    rule_sets = {'*': RuleSet(everywhere)}
+    for name, rules in lists.items():
+        if name != '*' and rules:
+            rule_sets[name] = RuleSet(everywhere + rules)
+    return rule_sets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check a moderation rules file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    check = commands.add_parser('check', help='compile a rules file and test text against it')
+    check.add_argument('path')
+    check.add_argument('text', nargs='?')
+    check.add_argument('--room', default='*')
+    args = parser.parse_args()
+
+    try:
+        rule_sets = load_rule_sets(args.path)
+    except (OSError, RuleError) as e:
+        sys.exit(str(e))
+    for name, rule_set in rule_sets.items():
+        print(f"  {name:<20} {len(rule_set):>6} rules  {rule_set.counts}")
+    if args.text is not None:
+        result = rule_sets.get(args.room, rule_sets['*']).check(args.text)
+        print(f"{KINDS[result[0]]}: {result[1]!r}" if result else 'allowed')
+        sys.exit(1 if result else 0)
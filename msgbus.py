@@ -0,0 +1,469 @@
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import threading
+import traceback
+import subprocess
+from collections import deque
+from urllib.parse import urlparse
+
+# Message bus
+# The app publishes every realtime event to a bus and delivers to its own
+# stream clients only from the bus, so all processes see the same events in
+# the same order. Each topic (a room or conversation) has a single sequence
+# number assigned by whoever owns the topic order: the publishing process for
+# the in-process bus, the broker for the socket bus.
+#
+#   memory://                 one process, no broker
+#   tcp://127.0.0.1:7400      broker on a TCP port
+#   unix:///tmp/chat.sock     broker on a Unix socket
+#
+# Run a broker with: python msgbus.py serve tcp://127.0.0.1:7400
+
+RECONNECT_DELAY = 0.5  # seconds, doubled up to RECONNECT_DELAY_MAX
+RECONNECT_DELAY_MAX = 5.0
+CONNECT_TIMEOUT = 5.0  # seconds BrokerBus() waits for a first connection
+SEND_TIMEOUT = 5.0  # seconds a send may stall before its connection is dropped
+OUTBOX_SIZE = 10000  # frames queued for one connection before it is dropped
+
+
+class MessageBus:
+    def publish(self, topic, event):
+        raise NotImplementedError
+
+    def subscribe(self, callback, topic='*'):
+        raise NotImplementedError
+
+    def on_reconnect(self, callback):
+        # callback() runs after a connection to the broker is re-established;
+        # events published in between may have been missed
+        pass
+
+    def close(self):
+        pass
+
+
+class InProcessBus(MessageBus):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.topic_locks = {}
+        self.sequences = {}
+        self.subscribers = []
+
+    def publish(self, topic, event):
+        # Callbacks run in the publisher's thread under the topic lock, which
+        # is what keeps per-topic order. They must not block.
+        with self.topic_locks.setdefault(topic, threading.Lock()):
+            seq = self.sequences[topic] = self.sequences.get(topic, 0) + 1
+            with self.lock:
+                subscribers = list(self.subscribers)
+            for callback, subscribed_topic in subscribers:
+                if subscribed_topic in ('*', topic):
+                    callback(topic, seq, event)
+
+    def subscribe(self, callback, topic='*'):
+        with self.lock:
+            self.subscribers.append((callback, topic))
+
+
+def parse_address(url):
+    parsed = urlparse(url)
+    if parsed.scheme == 'tcp':
+        return socket.AF_INET, (parsed.hostname, parsed.port)
+    if parsed.scheme == 'unix':
+        return socket.AF_UNIX, parsed.path
+    raise ValueError(f"Unsupported bus url: {url}")
+
+
+def send_frame(sock, frame):
+    sock.sendall(json.dumps(frame, separators=(',', ':')).encode() + b'\n')
+
+
+def set_send_timeout(sock):
+    # SO_SNDTIMEO rather than settimeout(), which would also time out the
+    # reads that wait for the next frame
+    seconds = int(SEND_TIMEOUT)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                    struct.pack('ll', seconds, int((SEND_TIMEOUT - seconds) * 10 ** 6)))
+
+
+def shutdown(sock):
+    # Unlike close(), wakes a thread blocked reading or writing the socket
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+class Broker:
+    # Frames are newline-delimited JSON:
+    #   client -> broker  {"op": "sub", "topic": "*"}
+    #                     {"op": "pub", "topic": ..., "event": ...}
+    #   broker -> client  {"op": "subscribed", "topic": ...}
+    #                     {"op": "msg", "topic": ..., "seq": ..., "event": ...}
+    # A topic's sequence number is assigned and the frame queued to every
+    # subscriber under that topic's lock, and each connection has one writer
+    # thread, so every subscriber sees a topic in the same order.
+    # A subscriber with OUTBOX_SIZE frames still queued, or whose socket
+    # stalls for SEND_TIMEOUT, is disconnected rather than buffered for; its
+    # process reconnects and its streams resync from storage.
+
+    def __init__(self, url):
+        self.url = url
+        self.lock = threading.Lock()
+        self.topic_locks = {}
+        self.sequences = {}
+        self.connections = set()
+        self.server = None
+
+    def serve_forever(self):
+        family, address = parse_address(self.url)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+        self.server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen(128)
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                break
+            set_send_timeout(sock)
+            connection = BrokerConnection(self, sock)
+            with self.lock:
+                self.connections.add(connection)
+            connection.start()
+
+    def stop(self):
+        if self.server:
+            shutdown(self.server)
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close()
+
+    def route(self, topic, event):
+        with self.topic_locks.setdefault(topic, threading.Lock()):
+            seq = self.sequences[topic] = self.sequences.get(topic, 0) + 1
+            frame = {'op': 'msg', 'topic': topic, 'seq': seq, 'event': event}
+            with self.lock:
+                connections = list(self.connections)
+            for connection in connections:
+                if not connection.wants(topic):
+                    continue
+                if len(connection.outbox) >= OUTBOX_SIZE:
+                    print(f"Broker: dropped a subscriber {OUTBOX_SIZE} frames behind", file=sys.stderr, flush=True)
+                    connection.close()
+                else:
+                    connection.outbox.append(frame)
+                    connection.ready.set()
+
+    def disconnected(self, connection):
+        with self.lock:
+            self.connections.discard(connection)
+
+
+class BrokerConnection:
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.topics = set()
+        self.outbox = deque()
+        self.ready = threading.Event()
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self.read_loop, daemon=True).start()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def wants(self, topic):
+        return '*' in self.topics or topic in self.topics
+
+    def read_loop(self):
+        try:
+            for line in self.sock.makefile('rb'):
+                try:
+                    frame = json.loads(line)
+                    if frame['op'] == 'sub':
+                        self.topics.add(frame['topic'])
+                        self.outbox.append({'op': 'subscribed', 'topic': frame['topic']})
+                        self.ready.set()
+                    elif frame['op'] == 'pub':
+                        self.broker.route(frame['topic'], frame['event'])
+                except (ValueError, KeyError, TypeError) as e:
+                    print(f"Broker: skipped malformed frame: {e!r}", file=sys.stderr, flush=True)
+        except OSError:
+            pass
+        self.close()
+
+    def write_loop(self):
+        while not self.closed:
+            self.ready.wait()
+            self.ready.clear()
+            # deque append/popleft are atomic, and route() appends under the topic lock
+            while self.outbox and not self.closed:
+                try:
+                    send_frame(self.sock, self.outbox.popleft())
+                except OSError:
+                    self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ready.set()
+        self.outbox.clear()
+        shutdown(self.sock)
+        self.broker.disconnected(self)
+
+
+class BrokerBus(MessageBus):
+    # Client side of the broker. Events published while the broker is
+    # unreachable are dropped: storage stays the source of truth and the bus
+    # only carries realtime delivery.
+    # The constructor blocks for up to CONNECT_TIMEOUT until the first
+    # connection is made, so a process that starts serving right after it
+    # delivers events from the start; if the broker is down it carries on and
+    # keeps reconnecting in the background. A malformed frame or a failing
+    # callback is reported on stderr and skipped, never ending the reader.
+    # publish() only queues the frame for a writer thread, so it never blocks
+    # its caller (the app publishes under a shard lock). A broker that stalls
+    # for SEND_TIMEOUT or falls OUTBOX_SIZE frames behind is disconnected and
+    # reconnected, like one that went down.
+
+    def __init__(self, url):
+        self.url = url
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.subscribers = []
+        self.acks = {}
+        self.reconnect_callbacks = []
+        self.outbox = deque()
+        self.ready = threading.Event()
+        self.connected = threading.Event()
+        self.has_connected = False
+        self.closed = False
+        threading.Thread(target=self.read_loop, daemon=True).start()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+        self.connected.wait(CONNECT_TIMEOUT)
+
+    def connect(self):
+        family, address = parse_address(self.url)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            if family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            set_send_timeout(sock)
+            with self.send_lock:
+                self.sock = sock
+                self.outbox.clear()  # queued for the last connection, dropped with it
+                for _, topic in self.subscribers:
+                    send_frame(sock, {'op': 'sub', 'topic': topic})
+        except OSError:
+            sock.close()
+            raise
+        self.connected.set()
+        if self.has_connected:
+            for callback in list(self.reconnect_callbacks):
+                try:
+                    callback()
+                except Exception:
+                    print("Message bus: reconnect callback failed:", file=sys.stderr, flush=True)
+                    traceback.print_exc()
+        self.has_connected = True
+        return sock
+
+    def read_loop(self):
+        delay = RECONNECT_DELAY
+        while not self.closed:
+            sock = None
+            try:
+                sock = self.connect()
+                delay = RECONNECT_DELAY
+                for line in sock.makefile('rb'):
+                    self.dispatch(line)
+            except OSError:
+                pass
+            self.connected.clear()
+            if sock is not None:
+                sock.close()
+            if not self.closed:
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+    def dispatch(self, line):
+        try:
+            frame = json.loads(line)
+            if frame['op'] == 'subscribed':
+                with self.send_lock:
+                    waiting = self.acks.pop(frame['topic'], [])
+                for acked in waiting:
+                    acked.set()
+                return
+            topic, seq, event = frame['topic'], frame['seq'], frame['event']
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Message bus: skipped malformed frame: {e!r}", file=sys.stderr, flush=True)
+            return
+        for callback, subscribed_topic in list(self.subscribers):
+            if subscribed_topic in ('*', topic):
+                try:
+                    callback(topic, seq, event)
+                except Exception:
+                    print(f"Message bus: subscriber failed on {topic}:", file=sys.stderr, flush=True)
+                    traceback.print_exc()
+
+    def publish(self, topic, event):
+        if not self.connected.is_set():
+            return
+        if len(self.outbox) >= OUTBOX_SIZE:
+            print(f"Message bus: broker {OUTBOX_SIZE} frames behind, reconnecting", file=sys.stderr, flush=True)
+            self.disconnect()
+            return
+        self.outbox.append({'op': 'pub', 'topic': topic, 'event': event})
+        self.ready.set()
+
+    def write_loop(self):
+        # The only thread that sends pub frames, so they leave in publish order
+        while not self.closed:
+            self.ready.wait()
+            self.ready.clear()
+            while self.outbox and not self.closed:
+                with self.send_lock:
+                    if not self.connected.is_set():
+                        break
+                    try:
+                        send_frame(self.sock, self.outbox.popleft())
+                    except OSError:
+                        self.disconnect()
+
+    def disconnect(self):
+        # Ends the read loop's connection, which then reconnects
+        self.connected.clear()
+        self.outbox.clear()
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def on_reconnect(self, callback):
+        self.reconnect_callbacks.append(callback)
+
+    def subscribe(self, callback, topic='*'):
+        # Returns once the broker has registered the topic, so every event
+        # published after that (by any process) reaches the callback
+        acked = threading.Event()
+        with self.send_lock:
+            self.subscribers.append((callback, topic))
+            if self.sock is None or not self.connected.is_set():
+                return
+            self.acks.setdefault(topic, []).append(acked)
+            try:
+                send_frame(self.sock, {'op': 'sub', 'topic': topic})
+            except OSError:
+                self.disconnect()  # the topic is sent again on reconnect
+                return
+        acked.wait(RECONNECT_DELAY_MAX)
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+        if self.sock is not None:
+            self.sock.close()
+
+
+def create_bus(url):
+    if not url or url.startswith('memory:'):
+        return InProcessBus()
+    return BrokerBus(url)
+
+
+# Multi-process check: a broker, several publisher processes and two
+# subscriber processes. Every subscriber must receive every event, with
+# broker sequence numbers gapless per topic and each publisher's events in the
+# order it sent them.
+CHECK_PUBLISHERS = 4
+CHECK_TOPICS = 8
+CHECK_EVENTS = 500  # per publisher
+
+
+def check_publisher(url, name):
+    bus = BrokerBus(url)
+    for i in range(CHECK_EVENTS):
+        bus.publish(f"room-{i % CHECK_TOPICS}", {'publisher': name, 'n': i})
+    time.sleep(0.5)
+    bus.close()
+
+
+def check_subscriber(url):
+    expected = CHECK_PUBLISHERS * CHECK_EVENTS
+    received = []
+    done = threading.Event()
+
+    def on_event(topic, seq, event):
+        received.append((topic, seq, event))
+        if len(received) == expected:
+            done.set()
+
+    bus = BrokerBus(url)
+    bus.subscribe(on_event)
+    print('ready', flush=True)
+    if not done.wait(30):
+        sys.exit(f"subscriber got {len(received)} of {expected} events")
+
+    last_seq = {}
+    last_n = {}
+    for topic, seq, event in received:
+        if seq != last_seq.get(topic, 0) + 1:
+            sys.exit(f"{topic}: seq {seq} after {last_seq.get(topic, 0)}")
+        last_seq[topic] = seq
+        key = (topic, event['publisher'])
+        if event['n'] <= last_n.get(key, -1):
+            sys.exit(f"{topic}: {event['publisher']} event {event['n']} after {last_n[key]}")
+        last_n[key] = event['n']
+    print('ok', flush=True)
+
+
+def run_check(url):
+    broker = subprocess.Popen([sys.executable, __file__, 'serve', url])
+    try:
+        time.sleep(0.5)
+        subscribers = [subprocess.Popen([sys.executable, __file__, 'check-subscriber', url],
+                                        stdout=subprocess.PIPE, text=True) for _ in range(2)]
+        for subscriber in subscribers:
+            subscriber.stdout.readline()  # 'ready'
+        publishers = [subprocess.Popen([sys.executable, __file__, 'check-publisher', url, f"p{i}"])
+                      for i in range(CHECK_PUBLISHERS)]
+        failed = any(p.wait() for p in publishers)
+        for subscriber in subscribers:
+            failed |= subscriber.wait() != 0
+            print(subscriber.stdout.read().strip())
+    finally:
+        broker.terminate()
+        broker.wait()
+    if failed:
+        sys.exit(1)
+    print(f"{CHECK_PUBLISHERS} publishers x {CHECK_EVENTS} events delivered in order to 2 subscribers")
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    if command == 'serve':
+        url = sys.argv[2] if len(sys.argv) > 2 else 'tcp://127.0.0.1:7400'
+        print(f"Message broker listening on {url}", flush=True)
+        Broker(url).serve_forever()
+    elif command == 'check':
+        run_check(sys.argv[2] if len(sys.argv) > 2 else 'tcp://127.0.0.1:7499')
+    elif command == 'check-publisher':
+        check_publisher(sys.argv[2], sys.argv[3])
+    elif command == 'check-subscriber':
+        check_subscriber(sys.argv[2])
+    else:
+        sys.exit(f"Unknown command: {command}")
@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import threading
+from urllib.parse import urlparse
+
+# Notifiers
+# Deliver offline digests to users. Which one the app uses is chosen by URL,
+# like the message bus:
+#
+#   file://data/digests.ndjson    append each digest as a JSON line (testing)
+#   log://                        print a one-line summary to stderr
+#
+# Other transports (mail, push, webhooks) register a factory for their
+# scheme in NOTIFIERS. send() raises on failure; the digest queue retries
+# with backoff, so a notifier should not retry on its own.
+
+
+class Notifier:
+    def send(self, email, digest):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileNotifier(Notifier):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def send(self, email, digest):
+        line = json.dumps({'email': email, **digest}) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+class LogNotifier(Notifier):
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+
+    def send(self, email, digest):
+        unread = sum(c['unread'] for c in digest['conversations'])
+        print(f"digest for {email}: {unread} unread in {len(digest['conversations'])} conversations",
+              file=self.stream, flush=True)
+
+
+def file_notifier(url):
+    parsed = urlparse(url)
+    # file://data/x.ndjson is relative to the working directory, file:///x absolute
+    return FileNotifier(parsed.netloc + parsed.path)
+
+
+NOTIFIERS = {
+    'file': file_notifier,
+    'log': lambda url: LogNotifier(),
+}
+
+
+def create_notifier(url):
+    scheme = urlparse(url).scheme
+    if scheme not in NOTIFIERS:
+        raise ValueError(f"Unsupported notifier url: {url}")
+    return NOTIFIERS[scheme](url)